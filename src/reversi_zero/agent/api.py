@@ -1,3 +1,8 @@
+import atexit
+import mmap
+import os
+import tempfile
+
 import numpy as np
 
 from multiprocessing import Pipe, connection
@@ -6,8 +11,10 @@ from time import time
 
 from logging import getLogger
 
+from reversi_zero.agent.evaluation_cache import EvaluationCache
 from reversi_zero.agent.model import ReversiModel
 from reversi_zero.config import Config
+from reversi_zero.lib.bitboard import bits_to_arrays
 
 from reversi_zero.lib.model_helpler import reload_newest_next_generation_model_if_changed, load_best_model_weight, \
     save_as_best_model, reload_best_model_weight_if_changed
@@ -26,23 +33,40 @@ class ReversiModelAPI:
         """
         self.config = config
         self.agent_model = agent_model
+        self.predicted_num = 0  # number of predicted states
+        self.predict_sec = 0
 
     def predict(self, x):
-        assert x.ndim in (3, 4)
-        assert x.shape == (2, 8, 8) or x.shape[1:] == (2, 8, 8)
+        """
+
+        :param np.ndarray x: (own, enemy) bitboards. shape=(2, ) or (N, 2), dtype=uint64
+        :return: (policy, value). shape=((64, ), (1, )) or ((N, 64), (N, 1))
+        """
+        assert x.shape == (2, ) or (x.ndim == 2 and x.shape[1] == 2)
         orig_x = x
-        if x.ndim == 3:
-            x = x.reshape(1, 2, 8, 8)
+        x = x.reshape((-1, 2)).astype(np.uint64)
 
+        start_time = time()
         policy, value = self._do_predict(x)
+        self.predict_sec += time() - start_time
+        self.predicted_num += x.shape[0]
 
-        if orig_x.ndim == 3:
+        if orig_x.ndim == 1:
             return policy[0], value[0]
         else:
             return policy, value
 
     def _do_predict(self, x):
-        return self.agent_model.model.predict_on_batch(x)
+        return self.agent_model.model.predict_on_batch(to_planes(x))
+
+
+def to_planes(x):
+    """unpack (own, enemy) bitboards to the input of the model
+
+    :param np.ndarray x: shape=(N, 2), dtype=uint64
+    :return: shape=(N, 2, 8, 8), dtype=float32
+    """
+    return bits_to_arrays(x, dtype=np.float32).reshape((-1, 2, 8, 8))
 
 
 class MultiProcessReversiModelAPIServer:
@@ -56,17 +80,38 @@ class MultiProcessReversiModelAPIServer:
         self.config = config
         self.model = None  # type: ReversiModel
         self.connections = []
+        self.shared_buffers = {}  # connection -> SharedMemoryBuffer
+        self.eval_cache = EvaluationCache(config.play_data.api_eval_cache_size_mb * 1024 * 1024)
+        self.request_num = 0
+        self.predicted_num = 0
+        self.model_sec = 0
 
     def get_api_client(self):
         me, you = Pipe()
         self.connections.append(me)
+        pc = self.config.play_data
+        if pc.api_transport == "shared_memory":
+            buffer = SharedMemoryBuffer.create(pc.api_shared_memory_batch_size)
+            self.shared_buffers[me] = buffer
+            return SharedMemoryReversiModelAPIClient(self.config, None, you, buffer)
         return MultiProcessReversiModelAPIClient(self.config, None, you)
 
+    def get_local_api_client(self):
+        """api client which predicts in the caller's thread, without `start_serve()`.
+
+        :rtype: LocalReversiModelAPIClient
+        """
+        if self.model is None:
+            self.model = self.load_model()
+            self.eval_cache.set_digest(self.model.digest)
+        return LocalReversiModelAPIClient(self.config, self)
+
     def start_serve(self):
         self.model = self.load_model()
         # threading workaround: https://github.com/keras-team/keras/issues/5640
         self.model.model._make_predict_function()
         self.graph = tf.get_default_graph()
+        self.eval_cache.set_digest(self.model.digest)
 
         prediction_worker = Thread(target=self.prediction_worker, name="prediction_worker")
         prediction_worker.daemon = True
@@ -80,24 +125,64 @@ class MultiProcessReversiModelAPIServer:
             if last_model_check_time+60 < time():
                 self.try_reload_model()
                 last_model_check_time = time()
-                logger.debug(f"average_prediction_size={np.average(average_prediction_size)}")
+                logger.debug(f"average_prediction_size={np.average(average_prediction_size)} "
+                             f"eval_cache_size={len(self.eval_cache)} eval_cache_hit_rate={self.eval_cache.hit_rate:.3f}")
                 average_prediction_size = []
-            ready_conns = connection.wait(self.connections, timeout=0.001)  # type: list[Connection]
+            ready_conns = connection.wait(self.connections, timeout=1)  # type: list[Connection]
             if not ready_conns:
                 continue
-            data = []
-            size_list = []
-            for conn in ready_conns:
+            average_prediction_size.append(self.handle_requests(ready_conns))
+
+    def handle_requests(self, ready_conns):
+        """predict the states sent through ready_conns at once and send back the results
+
+        :return: number of predicted states
+        """
+        data = []
+        size_list = []
+        for conn in ready_conns:
+            buffer = self.shared_buffers.get(conn)
+            if buffer is not None:
+                x = buffer.state[:int(conn.recv_bytes())]
+            else:
                 x = conn.recv()
-                data.append(x)  # shape: (k, 2, 8, 8)
-                size_list.append(x.shape[0])  # save k
-            average_prediction_size.append(np.sum(size_list))
-            array = np.concatenate(data, axis=0)
-            policy_ary, value_ary = self.model.model.predict_on_batch(array)
-            idx = 0
-            for conn, s in zip(ready_conns, size_list):
+            data.append(x)  # shape: (k, 2)
+            size_list.append(x.shape[0])  # save k
+        self.request_num += len(ready_conns)
+        policy_ary, value_ary = self.predict_with_cache(np.concatenate(data, axis=0))
+        idx = 0
+        for conn, s in zip(ready_conns, size_list):
+            buffer = self.shared_buffers.get(conn)
+            if buffer is not None:
+                buffer.policy[:s] = policy_ary[idx:idx+s]
+                buffer.value[:s] = value_ary[idx:idx+s]
+                conn.send_bytes(b"")
+            else:
                 conn.send((policy_ary[idx:idx+s], value_ary[idx:idx+s]))
-                idx += s
+            idx += s
+        return idx
+
+    def predict_with_cache(self, x):
+        """
+
+        :param np.ndarray x: (own, enemy) bitboards. shape=(N, 2), dtype=uint64
+        :return: (policy, value). shape=((N, 64), (N, 1))
+        """
+        policy_ary, value_ary, miss = self.eval_cache.get(x)
+        self.predicted_num += x.shape[0]
+        if len(miss) > 0:
+            start_time = time()
+            policy, value = self.model.model.predict_on_batch(to_planes(x[miss]))
+            self.model_sec += time() - start_time
+            policy_ary[miss] = policy
+            value_ary[miss] = value
+            self.eval_cache.put(x[miss], policy, value)
+        return policy_ary, value_ary
+
+    def stats_counters(self):
+        """cumulative counters. see `reversi_zero.lib.self_play_stats.SERVER_COUNTERS`"""
+        return dict(requests=self.request_num, predicted_states=self.predicted_num, model_sec=self.model_sec,
+                    eval_cache_lookups=self.eval_cache.lookup_count, eval_cache_hits=self.eval_cache.hit_count)
 
     def load_model(self):
         from reversi_zero.agent.model import ReversiModel
@@ -123,6 +208,7 @@ class MultiProcessReversiModelAPIServer:
                 reload_best_model_weight_if_changed(self.model, clear_session=True)
         except Exception as e:
             logger.error(e)
+        self.eval_cache.set_digest(self.model.digest)
 
 
 class MultiProcessReversiModelAPIClient(ReversiModelAPI):
@@ -139,3 +225,124 @@ class MultiProcessReversiModelAPIClient(ReversiModelAPI):
     def _do_predict(self, x):
         self.connection.send(x)
         return self.connection.recv()
+
+
+class LocalReversiModelAPIClient(ReversiModelAPI):
+    """predict by the model of the server in the same process. The model is reloaded every 60 seconds."""
+
+    def __init__(self, config: Config, server):
+        """
+
+        :param config:
+        :param MultiProcessReversiModelAPIServer server:
+        """
+        super().__init__(config, None)
+        self.server = server
+        self.last_model_check_time = time()
+
+    def _do_predict(self, x):
+        if self.last_model_check_time + 60 < time():
+            self.server.try_reload_model()
+            self.last_model_check_time = time()
+        self.server.request_num += 1
+        return self.server.predict_with_cache(x)
+
+
+class SharedMemoryReversiModelAPIClient(ReversiModelAPI):
+    """send states and receive (policy, value) through SharedMemoryBuffer.
+
+    The pipe is used only for notifying the number of states and the completion.
+    """
+    def __init__(self, config: Config, agent_model, conn, buffer):
+        """
+
+        :param config:
+        :param reversi_zero.agent.model.ReversiModel agent_model:
+        :param Connection conn:
+        :param SharedMemoryBuffer buffer:
+        """
+        super().__init__(config, agent_model)
+        self.connection = conn
+        self.buffer = buffer
+
+    def _do_predict(self, x):
+        buffer = self.buffer
+        n = x.shape[0]
+        policy = np.empty((n, 64), dtype=np.float32)
+        value = np.empty((n, 1), dtype=np.float32)
+        for start in range(0, n, buffer.max_batch_size):
+            end = min(start + buffer.max_batch_size, n)
+            k = end - start
+            buffer.state[:k] = x[start:end]
+            self.connection.send_bytes(str(k).encode())
+            self.connection.recv_bytes()
+            policy[start:end] = buffer.policy[:k]
+            value[start:end] = buffer.value[:k]
+        return policy, value
+
+
+class SharedMemoryBuffer:
+    """input and output arrays of one api client on a file-backed shared memory.
+
+    Only the file path is pickled, so that the buffer can be passed to other processes.
+    """
+    def __init__(self, path, max_batch_size):
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self._mmap = None
+        self._arrays = None
+
+    @classmethod
+    def create(cls, max_batch_size):
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="reversi_zero_api_", dir=shm_dir)
+        os.ftruncate(fd, cls.calc_size(max_batch_size))
+        os.close(fd)
+        atexit.register(_remove_file, path)
+        return cls(path, max_batch_size)
+
+    @staticmethod
+    def calc_size(max_batch_size):
+        return max_batch_size * (2 * 8 + 64 * 4 + 4)  # state(uint64 * 2), policy(float32 * 64), value(float32)
+
+    def _open(self):
+        with open(self.path, "r+b") as f:
+            self._mmap = mmap.mmap(f.fileno(), self.calc_size(self.max_batch_size))
+        n = self.max_batch_size
+        state = np.frombuffer(self._mmap, dtype=np.uint64, count=n * 2, offset=0).reshape((n, 2))
+        policy = np.frombuffer(self._mmap, dtype=np.float32, count=n * 64, offset=state.nbytes).reshape((n, 64))
+        value = np.frombuffer(self._mmap, dtype=np.float32, count=n,
+                              offset=state.nbytes + policy.nbytes).reshape((n, 1))
+        self._arrays = (state, policy, value)
+
+    @property
+    def state(self):
+        """(own, enemy) bitboards. shape=(max_batch_size, 2)"""
+        if self._arrays is None:
+            self._open()
+        return self._arrays[0]
+
+    @property
+    def policy(self):
+        if self._arrays is None:
+            self._open()
+        return self._arrays[1]
+
+    @property
+    def value(self):
+        if self._arrays is None:
+            self._open()
+        return self._arrays[2]
+
+    def __getstate__(self):
+        return dict(path=self.path, max_batch_size=self.max_batch_size)
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_batch_size"])
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
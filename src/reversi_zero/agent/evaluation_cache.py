@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+# policy(float32 * 64) + value(float32) + approx. overhead of the key and the OrderedDict entry
+ENTRY_BYTES = 64 * 4 + 4 + 200
+
+
+class EvaluationCache:
+    """LRU cache of (policy, value) of the model, keyed by (own, enemy) bitboards.
+
+    Symmetric positions are separate entries, so that the random symmetry of the evaluation
+    in ReversiPlayer.expand_and_evaluate gives different evaluations of them.
+    Entries are valid only for the model whose digest is `digest`, see `set_digest()`.
+    """
+
+    def __init__(self, max_bytes):
+        """
+
+        :param int max_bytes: memory budget. 0 disables the cache.
+        """
+        self.capacity = max(int(max_bytes // ENTRY_BYTES), 0)
+        self.digest = None
+        self.policy = np.zeros((self.capacity, 64), dtype=np.float32)
+        self.value = np.zeros((self.capacity, 1), dtype=np.float32)
+        self._rows = OrderedDict()  # (own, enemy) -> row of policy/value, in LRU order
+        self._free_rows = list(reversed(range(self.capacity)))
+        self.lookup_count = 0
+        self.hit_count = 0
+
+    def set_digest(self, digest):
+        """clear the cache if digest of the model is changed"""
+        if digest != self.digest:
+            if self._rows:
+                logger.debug(f"clear evaluation cache: {len(self._rows)} entries")
+            self.clear()
+            self.digest = digest
+
+    def clear(self):
+        self._rows.clear()
+        self._free_rows = list(reversed(range(self.capacity)))
+
+    def get(self, x):
+        """
+
+        :param np.ndarray x: (own, enemy) bitboards. shape=(N, 2), dtype=uint64
+        :return: (policy, value, miss_index). policy and value of miss_index are undefined.
+        """
+        n = x.shape[0]
+        policy = np.empty((n, 64), dtype=np.float32)
+        value = np.empty((n, 1), dtype=np.float32)
+        if not self.capacity:
+            return policy, value, np.arange(n)
+
+        hit, hit_rows, miss = [], [], []
+        for i, key in enumerate(map(tuple, x.tolist())):
+            row = self._rows.get(key)
+            if row is None:
+                miss.append(i)
+                continue
+            self._rows.move_to_end(key)
+            hit.append(i)
+            hit_rows.append(row)
+        policy[hit] = self.policy[hit_rows]
+        value[hit] = self.value[hit_rows]
+        self.lookup_count += n
+        self.hit_count += n - len(miss)
+        return policy, value, np.array(miss, dtype=np.int64)
+
+    def put(self, x, policy, value):
+        """
+
+        :param np.ndarray x: (own, enemy) bitboards. shape=(N, 2), dtype=uint64
+        :param np.ndarray policy: shape=(N, 64)
+        :param np.ndarray value: shape=(N, 1)
+        """
+        if not self.capacity:
+            return
+        for i, key in enumerate(map(tuple, x.tolist())):
+            row = self._rows.get(key)
+            if row is None:
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                else:
+                    _, row = self._rows.popitem(last=False)
+                self._rows[key] = row
+            else:
+                self._rows.move_to_end(key)
+            self.policy[row] = policy[i]
+            self.value[row] = value[i]
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def hit_rate(self):
+        if self.lookup_count == 0:
+            return 0
+        return self.hit_count / self.lookup_count
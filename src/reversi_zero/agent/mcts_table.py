@@ -0,0 +1,216 @@
+from logging import getLogger
+
+import numpy as np
+
+from reversi_zero.lib.util import resized_array
+
+logger = getLogger(__name__)
+
+
+class MCTSTable:
+    """N, W, P statistics of MCTS nodes in preallocated arrays.
+
+    Each position (black, white, next_player) gets one slot id.
+    The statistics of the slot are `n[slot]`, `w[slot]`, `p[slot]` (float32, shape=(64, )).
+    Slot ids are looked up by an open-addressing (linear probing) hash table.
+    Slot ids do not change until `retain()`, even when the table grows or slots are evicted.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+
+        :param int capacity: initial number of slots. The table grows automatically.
+        """
+        self.capacity = 0
+        self.size = 0
+        self.lookup_count = 0
+        self.hit_count = 0
+        self.evicted_count = 0
+        self.generation = 0  # incremented by the user, e.g. per search. see `last_used`
+
+        self.black = self.white = self.next_player = None  # keys of slots
+        self.n = self.w = self.p = None
+        self.expanded = None
+        self.seen_transforms = None  # bit flags of symmetry transforms evaluated or visited after expanded
+        self.last_used = None  # generation of the last `get()` of the slot
+        self._free_slots = []  # evicted slot ids (next_player == 0) to be reused
+        self._index = None  # hash bucket -> slot id (-1 means empty)
+        self._mask = 0
+        self._allocate(_ceil_pow2(max(capacity, 16)))
+
+    def _allocate(self, capacity):
+        size = self.size
+        self.black = resized_array(self.black, capacity, size, np.uint64)
+        self.white = resized_array(self.white, capacity, size, np.uint64)
+        self.next_player = resized_array(self.next_player, capacity, size, np.int8)
+        self.n = resized_array(self.n, (capacity, 64), size, np.float32)
+        self.w = resized_array(self.w, (capacity, 64), size, np.float32)
+        self.p = resized_array(self.p, (capacity, 64), size, np.float32)
+        self.expanded = resized_array(self.expanded, capacity, size, np.bool_)
+        self.seen_transforms = resized_array(self.seen_transforms, capacity, size, np.uint8)
+        self.last_used = resized_array(self.last_used, capacity, size, np.uint32)
+        self.capacity = capacity
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        """insert all live slots to a new index at once.
+
+        In each round, every pending slot tries its current bucket; one slot wins each empty bucket,
+        and the others move to the next bucket only if it is occupied, as `_probe()` does one by one.
+        """
+        index = self._index = np.full(self.capacity * 2, -1, dtype=np.int32)  # load factor <= 0.5
+        mask = self._mask = self.capacity * 2 - 1
+        pending = np.nonzero(self.next_player[:self.size])[0]  # evicted slots have next_player == 0
+        buckets = (_key_hash(self.black[pending], self.white[pending], self.next_player[pending]) &
+                   np.uint64(mask)).astype(np.int64)
+        while len(pending) > 0:
+            empty = np.nonzero(index[buckets] < 0)[0]
+            _, first = np.unique(buckets[empty], return_index=True)
+            winners = empty[first]
+            index[buckets[winners]] = pending[winners]
+            rest = np.ones(len(pending), dtype=np.bool_)
+            rest[winners] = False
+            pending, buckets = pending[rest], buckets[rest]
+            buckets = np.where(index[buckets] >= 0, (buckets + 1) & mask, buckets)
+
+    def _probe(self, black, white, next_player):
+        """return (bucket, slot). slot is -1 if the key is not found, and then bucket is the empty one to insert."""
+        index = self._index
+        mask = self._mask
+        bucket = _key_hash(black, white, next_player) & mask
+        while True:
+            slot = index[bucket]
+            if slot < 0:
+                return bucket, -1
+            if self.next_player[slot] == next_player and int(self.black[slot]) == black and \
+                    int(self.white[slot]) == white:
+                return bucket, int(slot)
+            bucket = (bucket + 1) & mask
+
+    def find(self, key, count=True):
+        """
+
+        :param key: (black, white, next_player)
+        :param bool count: count this lookup in `hit_rate`
+        :return: slot id, or -1 if not exists
+        """
+        _, slot = self._probe(*key)
+        if count:
+            self.lookup_count += 1
+            if slot >= 0:
+                self.hit_count += 1
+        return slot
+
+    def get(self, key):
+        """return slot id of the key. new slot is allocated if not exists.
+
+        :param key: (black, white, next_player)
+        :rtype: int
+        """
+        self.lookup_count += 1
+        bucket, slot = self._probe(*key)
+        if slot >= 0:
+            self.hit_count += 1
+            self.last_used[slot] = self.generation
+            return slot
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self.size >= self.capacity:
+                self._allocate(self.capacity * 2)
+                bucket, _ = self._probe(*key)
+            slot = self.size
+            self.size += 1
+        self.black[slot], self.white[slot], self.next_player[slot] = key
+        self.last_used[slot] = self.generation
+        self._index[bucket] = slot
+        return slot
+
+    def evict(self, num, policy="least_visited", protected=()):
+        """free `num` slots. Ids of the other slots are not changed.
+
+        :param int num: number of slots to evict
+        :param str policy: "least_visited" evicts slots of the smallest sum of N,
+                           "oldest" evicts slots of the oldest `last_used` generation.
+        :param protected: slot ids never evicted
+        """
+        live = np.nonzero(self.next_player[:self.size])[0]
+        if policy == "least_visited":
+            score = np.sum(self.n[live], axis=1)
+        elif policy == "oldest":
+            score = self.last_used[live]
+        else:
+            raise ValueError(f"unknown eviction policy: {policy}")
+        candidates = live[np.argsort(score, kind="mergesort")]  # stable
+        candidates = candidates[~np.isin(candidates, list(protected))][:max(num, 0)]
+        if len(candidates) == 0:
+            return
+
+        self.black[candidates] = self.white[candidates] = self.next_player[candidates] = 0
+        self.n[candidates] = self.w[candidates] = self.p[candidates] = 0
+        self.expanded[candidates] = False
+        self.seen_transforms[candidates] = 0
+        self._free_slots.extend(int(x) for x in candidates)
+        self.evicted_count += len(candidates)
+        self._rebuild_index()
+
+    def retain(self, slots):
+        """drop all slots except `slots`. The kept slots are renumbered 0, 1, ... in the order of `slots`.
+
+        The arrays shrink when less than a quarter of them is used.
+        :param list[int] slots: ids of slots in use
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        capacity = self.capacity
+        while capacity > 16 and len(slots) * 4 <= capacity:
+            capacity //= 2
+        arrays = [self.black, self.white, self.next_player, self.n, self.w, self.p, self.expanded,
+                  self.seen_transforms, self.last_used]
+        (self.black, self.white, self.next_player, self.n, self.w, self.p, self.expanded,
+         self.seen_transforms, self.last_used) = [a[slots] for a in arrays]
+        self.size = len(slots)
+        self._free_slots = []
+        self._allocate(capacity)
+
+    def q(self, slot):
+        return self.w[slot] / (self.n[slot] + 1e-5)
+
+    def __len__(self):
+        return self.size - len(self._free_slots)
+
+    def __contains__(self, key):
+        return self._probe(*key)[1] >= 0
+
+    @property
+    def nbytes(self):
+        arrays = [self.black, self.white, self.next_player, self.n, self.w, self.p, self.expanded,
+                  self.seen_transforms, self.last_used, self._index]
+        return sum(a.nbytes for a in arrays)
+
+    @property
+    def hit_rate(self):
+        if self.lookup_count == 0:
+            return 0
+        return self.hit_count / self.lookup_count
+
+
+_HASH_MUL1 = 0x9E3779B97F4A7C15
+_HASH_MUL2 = 0xC2B2AE3D27D4EB4F
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def _key_hash(black, white, next_player):
+    """hash of keys for the index. The same value for python ints and for uint64 arrays (element-wise)."""
+    if isinstance(black, np.ndarray):
+        with np.errstate(over="ignore"):
+            h = (black.astype(np.uint64) * np.uint64(_HASH_MUL1)) ^ \
+                (white.astype(np.uint64) * np.uint64(_HASH_MUL2)) ^ next_player.astype(np.uint64)
+        return h ^ (h >> np.uint64(32))
+    h = ((black * _HASH_MUL1) ^ (white * _HASH_MUL2) ^ next_player) & _UINT64_MASK
+    return h ^ (h >> 32)
+
+
+def _ceil_pow2(x):
+    return 1 << (int(x) - 1).bit_length()
+
@@ -1,38 +1,47 @@
-from _asyncio import Future
-from asyncio.queues import Queue
-from collections import defaultdict, namedtuple
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
+from threading import Event
+from time import time
 import asyncio
 
 import numpy as np
 from numpy.random import random
 
 from reversi_zero.agent.api import ReversiModelAPI
+from reversi_zero.agent.mcts_table import MCTSTable
 from reversi_zero.config import Config
 from reversi_zero.env.reversi_env import ReversiEnv, Player, Winner, another_player
-from reversi_zero.lib.bitboard import find_correct_moves, bit_to_array, flip_vertical, rotate90, dirichlet_noise_of_mask
+from reversi_zero.lib.bitboard_backend import find_correct_moves, bit_to_array, flip_vertical, rotate90, \
+    dirichlet_noise_of_mask
+from reversi_zero.lib.symmetry import canonicalize, ACTION_PERMUTATIONS
 # from reversi_zero.lib.reversi_solver import ReversiSolver
 from reversi_zero.lib.alt.reversi_solver import ReversiSolver
 
 
 CounterKey = namedtuple("CounterKey", "black white next_player")
+Node = namedtuple("Node", "slot transform")  # transform: symmetry transform id from the key to the slot
 QueueItem = namedtuple("QueueItem", "state future")
 HistoryItem = namedtuple("HistoryItem", "action policy values visit enemy_values enemy_visit")
 CallbackInMCTS = namedtuple("CallbackInMCTS", "per_sim callback")
-MCTSInfo = namedtuple("MCTSInfo", "var_n var_w var_p")
 ActionWithEvaluation = namedtuple("ActionWithEvaluation", "action n q")
+SolverResult = namedtuple("SolverResult", "action score exact")  # exact=False: only the sign of the score is proven
 
 logger = getLogger(__name__)
 
 
 class ReversiPlayer:
-    def __init__(self, config: Config, model, play_config=None, enable_resign=True, mtcs_info=None, api=None):
+    def __init__(self, config: Config, model, play_config=None, enable_resign=True, mtcs_info=None, api=None,
+                 batcher=None, solver_cache=None):
         """
 
         :param config:
         :param reversi_zero.agent.model.ReversiModel|None model:
-        :param MCTSInfo mtcs_info:
+        :param MCTSTable mtcs_info:
         :parameter ReversiModelAPI api:
+        :param PredictionBatcher batcher: shared by players searching concurrently on the same event loop.
+                                          if None, the player has its own.
+        :param SharedSolverCache solver_cache: results of the solver shared with other players
         """
         self.config = config
         self.model = model
@@ -40,51 +49,171 @@ class ReversiPlayer:
         self.enable_resign = enable_resign
         self.api = api or ReversiModelAPI(self.config, self.model)
 
-        # key=(own, enemy, action)
-        mtcs_info = mtcs_info or self.create_mtcs_info()
-        self.var_n, self.var_w, self.var_p = mtcs_info
+        # key=(black, white, next_player) -> slot of N, W, P
+        self.table = mtcs_info if mtcs_info is not None else self.create_mtcs_info()
 
-        self.expanded = set(self.var_p.keys())
-        self.now_expanding = set()
-        self.prediction_queue = Queue(self.play_config.prediction_queue_size)
+        self.now_expanding = {}  # slot -> future which is done when the slot is expanded
         self.sem = asyncio.Semaphore(self.play_config.parallel_search_num)
+        self.own_batcher = batcher is None
+        self.batcher = batcher or PredictionBatcher(self.api, self.play_config.prediction_queue_size)
 
         self.moves = []
         self.loop = asyncio.get_event_loop()
         self.running_simulation_num = 0
         self.callback_in_mtcs = None
+        self.symmetry_saved_evaluation_num = 0
+        self.simulation_num = 0  # finished simulations
+        self.solver_sec = 0
+        self.solver_count = 0
 
         self.thinking_history = {}  # for fun
         self.resigned = False
         self.requested_stop_thinking = False
-        self.solver = self.create_solver()
+        self.solver = self.create_solver()  # used only in the thread of solver_executor
+        self.solver_executor = ThreadPoolExecutor(max_workers=1)
+        self.solver_cache = solver_cache
+        self.solver_futures = {}  # key -> Future of the solver started in the simulations of this move
+        self.solver_cancel = Event()  # set to stop the solver started in the simulations of this move
+        self.solver_deadline = 0  # the solver is not started in the simulations after this time
 
     @staticmethod
     def create_mtcs_info():
-        return MCTSInfo(defaultdict(lambda: np.zeros((64,))),
-                        defaultdict(lambda: np.zeros((64,))),
-                        defaultdict(lambda: np.zeros((64,))))
+        return MCTSTable()
 
-    def var_q(self, key):
-        return self.var_w[key] / (self.var_n[key] + 1e-5)
+    def get_node(self, key):
+        """
+
+        :param CounterKey key:
+        :rtype: Node
+        """
+        if not self.play_config.canonicalize_mcts_key:
+            return Node(self.table.get(key), 0)
+        black, white, t = canonicalize(key.black, key.white)
+        return Node(self.table.get(CounterKey(black, white, key.next_player)), t)
+
+    def find_slot(self, key):
+        """slot of the key, or -1 if the node is not created. It is not counted in the hit rate of the table.
+
+        :param CounterKey key:
+        :rtype: int
+        """
+        if self.play_config.canonicalize_mcts_key:
+            black, white, _ = canonicalize(key.black, key.white)
+            key = CounterKey(black, white, key.next_player)
+        return self.table.find(key, count=False)
+
+    def prune_tree(self, root_key):
+        """make root_key the root of the search tree and drop nodes which are not reachable from it.
+
+        Nodes are traced through the actions which have been visited (N > 0),
+        and the another side node of each reached node is kept too.
+        :param CounterKey root_key:
+        """
+        table = self.table
+        size = len(table)
+        root = self.find_slot(root_key)
+        keep = {root} if root >= 0 else set()
+        stack = list(keep)
+        while stack:
+            slot = stack.pop()
+            black, white = int(table.black[slot]), int(table.white[slot])
+            next_player = Player(int(table.next_player[slot]))
+            another_side = self.find_slot(CounterKey(white, black, another_player(next_player).value))
+            if another_side >= 0:
+                keep.add(another_side)
+            for action in np.nonzero(table.n[slot] > 0)[0]:
+                env = ReversiEnv().update(black, white, next_player)
+                env.step(int(action))
+                if env.done:
+                    continue
+                child = self.find_slot(self.counter_key(env))
+                if child >= 0 and child not in keep:
+                    keep.add(child)
+                    stack.append(child)
+        table.retain(sorted(keep))
+        logger.debug(f"prune MCTS nodes: {size} -> {len(table)}")
+
+    def evict_nodes(self, root_key):
+        """evict nodes by `mcts_eviction_policy` if the table exceeds `mcts_node_budget`.
+
+        10% of the budget is freed at once. The root node and the nodes used in this search
+        (`last_used` is the current generation) are never evicted, so that this can be called between simulations.
+        :param CounterKey root_key:
+        """
+        pc = self.play_config
+        table = self.table
+        if not pc.mcts_node_budget or len(table) <= pc.mcts_node_budget:
+            return
+        num = len(table) - int(pc.mcts_node_budget * 0.9)
+        protected = np.nonzero(table.last_used[:table.size] == table.generation)[0]
+        root = self.find_slot(root_key)
+        if root >= 0:
+            protected = np.append(protected, root)
+        table.evict(num, pc.mcts_eviction_policy, protected=protected)
+        logger.debug(f"evict {num} MCTS nodes by {pc.mcts_eviction_policy}")
+
+    @staticmethod
+    def action_index(node, action):
+        """index of the action in the slot"""
+        return action if node.transform == 0 else ACTION_PERMUTATIONS[node.transform][action]
+
+    @staticmethod
+    def _to_actions(node, row):
+        """reorder a row of the slot to the action order of the node"""
+        return row if node.transform == 0 else row[ACTION_PERMUTATIONS[node.transform]]
+
+    def var_n(self, node):
+        return self._to_actions(node, self.table.n[node.slot])
+
+    def var_p(self, node):
+        return self._to_actions(node, self.table.p[node.slot])
+
+    def var_q(self, node):
+        return self._to_actions(node, self.table.q(node.slot))
 
-    def action(self, own, enemy, callback_in_mtcs=None):
+    def update_n_w(self, node, action, n, w):
+        idx = self.action_index(node, action)
+        self.table.n[node.slot, idx] += n
+        self.table.w[node.slot, idx] += w
+
+    def set_p(self, node, p):
+        if node.transform == 0:
+            self.table.p[node.slot] = p
+        else:
+            self.table.p[node.slot, ACTION_PERMUTATIONS[node.transform]] = p
+
+    def action(self, own, enemy, callback_in_mtcs=None, solver_callback=None):
         """
 
         :param own: BitBoard
         :param enemy:  BitBoard
         :param CallbackInMCTS callback_in_mtcs:
+        :param solver_callback: called with SolverResult when the solver proves a result of this move
         :return action=move pos=0 ~ 63 (0=top left, 7 top right, 63 bottom right)
         """
-        action_with_eval = self.action_with_evaluation(own, enemy, callback_in_mtcs=callback_in_mtcs)
+        action_with_eval = self.action_with_evaluation(own, enemy, callback_in_mtcs=callback_in_mtcs,
+                                                       solver_callback=solver_callback)
         return action_with_eval.action
 
-    def action_with_evaluation(self, own, enemy, callback_in_mtcs=None):
+    def action_with_evaluation(self, own, enemy, callback_in_mtcs=None, solver_callback=None):
+        """
+
+        :param own: BitBoard
+        :param enemy:  BitBoard
+        :param CallbackInMCTS callback_in_mtcs:
+        :param solver_callback: called with SolverResult when the solver proves a result of this move
+        :rtype: ActionWithEvaluation
+        """
+        return self.loop.run_until_complete(self.action_with_evaluation_async(own, enemy, callback_in_mtcs,
+                                                                             solver_callback))
+
+    async def action_with_evaluation_async(self, own, enemy, callback_in_mtcs=None, solver_callback=None):
         """
 
         :param own: BitBoard
         :param enemy:  BitBoard
         :param CallbackInMCTS callback_in_mtcs:
+        :param solver_callback: called with SolverResult when the solver proves a result of this move
         :rtype: ActionWithEvaluation
         :return ActionWithEvaluation(
                     action=move pos=0 ~ 63 (0=top left, 7 top right, 63 bottom right),
@@ -94,34 +223,37 @@ class ReversiPlayer:
         """
         env = ReversiEnv().update(own, enemy, Player.black)
         key = self.counter_key(env)
-        self.callback_in_mtcs = callback_in_mtcs
         pc = self.play_config
+        if pc.reuse_tree:
+            self.prune_tree(key)  # renumbers slots, so get nodes after this
+        node = self.get_node(key)
+        self.callback_in_mtcs = callback_in_mtcs
 
         if pc.use_solver_turn and env.turn >= pc.use_solver_turn:
-            ret = self.action_by_searching(key)
-            if ret:  # not save move as play data
-                return ret
+            solved = await self.solve_by_deepening_async(key, pc.solver_sec_per_move, solver_callback)
+            if solved is not None:  # not save move as play data
+                return self.action_by_searching(key, solved.action, solved.score)
 
         for tl in range(self.play_config.thinking_loop):
             if env.turn > 0:
-                self.search_moves(own, enemy)
+                await self.search_moves_async(own, enemy)
             else:
                 self.bypass_first_move(key)
 
             policy = self.calc_policy(own, enemy)
             action = int(np.random.choice(range(64), p=policy))
-            action_by_value = int(np.argmax(self.var_q(key) + (self.var_n[key] > 0)*100))
-            value_diff = self.var_q(key)[action] - self.var_q(key)[action_by_value]
+            action_by_value = int(np.argmax(self.var_q(node) + (self.var_n(node) > 0)*100))
+            value_diff = self.var_q(node)[action] - self.var_q(node)[action_by_value]
 
             if env.turn <= pc.start_rethinking_turn or self.requested_stop_thinking or \
-                    (value_diff > -0.01 and self.var_n[key][action] >= pc.required_visit_to_decide_action):
+                    (value_diff > -0.01 and self.var_n(node)[action] >= pc.required_visit_to_decide_action):
                 break
 
         # this is for play_gui, not necessary when training.
         self.update_thinking_history(own, enemy, action, policy)
 
         if self.play_config.resign_threshold is not None and\
-                        np.max(self.var_q(key) - (self.var_n[key] == 0)*10) <= self.play_config.resign_threshold:
+                        np.max(self.var_q(node) - (self.var_n(node) == 0)*10) <= self.play_config.resign_threshold:
             self.resigned = True
             if self.enable_resign:
                 if env.turn >= self.config.play.allowed_resign_turn:
@@ -129,37 +261,111 @@ class ReversiPlayer:
                 else:
                     logger.debug(f"Want to resign but disallowed turn {env.turn} < {self.config.play.allowed_resign_turn}")
 
-        saved_policy = self.calc_policy_by_tau_1(key) if self.config.play_data.save_policy_of_tau_1 else policy
-        self.add_data_to_move_buffer_with_8_symmetries(own, enemy, saved_policy)
-        return ActionWithEvaluation(action=action, n=self.var_n[key][action], q=self.var_q(key)[action])
+        saved_policy = self.calc_policy_by_tau_1(node) if self.config.play_data.save_policy_of_tau_1 else policy
+        if self.config.play_data.save_8_symmetries:
+            self.add_data_to_move_buffer_with_8_symmetries(own, enemy, saved_policy)
+        else:  # symmetries are expanded by the trainer
+            self.moves.append([(own, enemy), list(saved_policy)])
+        return ActionWithEvaluation(action=action, n=float(self.var_n(node)[action]),
+                                    q=float(self.var_q(node)[action]))
 
     def update_thinking_history(self, black, white, action, policy):
-        key = CounterKey(black, white, Player.black.value)
-        next_key = self.get_next_key(black, white, action)
+        node = self.get_node(CounterKey(black, white, Player.black.value))
+        next_node = self.get_node(self.get_next_key(black, white, action))
         self.thinking_history[(black, white)] = \
-            HistoryItem(action, policy, list(self.var_q(key)), list(self.var_n[key]),
-                        list(self.var_q(next_key)), list(self.var_n[next_key]))
+            HistoryItem(action, policy, list(self.var_q(node)), list(self.var_n(node)),
+                        list(self.var_q(next_node)), list(self.var_n(next_node)))
 
     def bypass_first_move(self, key):
         legal_array = bit_to_array(find_correct_moves(key.black, key.white), 64)
         action = np.argmax(legal_array)
-        self.var_n[key][action] = 1
-        self.var_w[key][action] = 0
-        self.var_p[key] = legal_array / np.sum(legal_array)
-
-    def action_by_searching(self, key):
-        action, score = self.solver.solve(key.black, key.white, Player(key.next_player), exactly=True)
-        if action is None:
-            return None
+        node = self.get_node(key)
+        idx = self.action_index(node, action)
+        self.table.n[node.slot, idx] = 1
+        self.table.w[node.slot, idx] = 0
+        self.set_p(node, legal_array / np.sum(legal_array))
+
+    def action_by_searching(self, key, action, score):
+        """
+
+        :param CounterKey key:
+        :param action: move solved by the solver
+        :param score: score of the move. only the sign is used
+        :rtype: ActionWithEvaluation
+        """
         # logger.debug(f"action_by_searching: score={score}")
         policy = np.zeros(64)
         policy[action] = 1
-        self.var_n[key][action] = 999
-        self.var_w[key][action] = np.sign(score) * 999
-        self.var_p[key] = policy
+        node = self.get_node(key)
+        idx = self.action_index(node, action)
+        self.table.n[node.slot, idx] = 999
+        self.table.w[node.slot, idx] = np.sign(score) * 999
+        self.set_p(node, policy)
         self.update_thinking_history(key.black, key.white, action, policy)
         return ActionWithEvaluation(action=action, n=999, q=np.sign(score))
 
+    def solve_by_deepening(self, key, timeout, callback=None):
+        return self.loop.run_until_complete(self.solve_by_deepening_async(key, timeout, callback))
+
+    async def solve_by_deepening_async(self, key, timeout, callback=None):
+        """anytime endgame solve: win/loss/draw first, then the exact score, within `timeout` sec in total.
+
+        The exact search reuses the bounds of the win/loss search in the transposition table of the solver,
+        and if it is not finished in time, the win/loss result is returned.
+
+        :param CounterKey key:
+        :param float timeout:
+        :param callback: called with SolverResult as soon as each result is proven
+        :return: SolverResult of the deepest proven search, or None if nothing is proven in time
+        """
+        deadline = time() + timeout
+        result = None
+        for exactly in (False, True):
+            action, score = await asyncio.wrap_future(self.submit_solve(key, exactly, deadline), loop=self.loop)
+            if action is None:
+                break
+            result = SolverResult(action, score, exactly)
+            if callback is not None:
+                callback(result)
+        return result
+
+    def solve(self, key, exactly, timeout=30):
+        """solve the position in the solver thread and wait for the result
+
+        :return: (move, score of next_player), or (None, None) if timeout or no legal moves
+        """
+        return self.submit_solve(key, exactly, time() + timeout).result()
+
+    def submit_solve(self, key, exactly, deadline=None, cancel=None):
+        """start solving the position in the solver thread. Positions are solved one by one in submitted order.
+
+        :param CounterKey key:
+        :param bool exactly:
+        :param float deadline: time to give up solving. 30 sec after now if None
+        :param threading.Event cancel: give up solving when this is set, even if the solve has not started yet
+        :rtype: concurrent.futures.Future
+        """
+        return self.solver_executor.submit(self._solve, key, exactly, deadline or time() + 30, cancel)
+
+    def _solve(self, key, exactly, deadline, cancel=None):
+        if cancel is not None and cancel.is_set():
+            return None, None
+        next_player = Player(key.next_player)
+        if self.solver_cache is not None:
+            ret = self.solver_cache.get(key.black, key.white, next_player, exactly)
+            if ret is not None:
+                return ret
+        start_time = time()
+        if start_time >= deadline:
+            return None, None
+        ret = self.solver.solve(key.black, key.white, next_player, timeout=deadline - start_time, exactly=exactly,
+                                cancel=cancel)
+        self.solver_sec += time() - start_time
+        self.solver_count += 1
+        if self.solver_cache is not None and ret[0] is not None:
+            self.solver_cache.put(key.black, key.white, next_player, exactly, *ret)
+        return ret
+
     def stop_thinking(self):
         self.requested_stop_thinking = True
 
@@ -187,33 +393,48 @@ class ReversiPlayer:
         return self.thinking_history.get((own, enemy))
 
     def search_moves(self, own, enemy):
-        loop = self.loop
-        self.running_simulation_num = 0
+        self.loop.run_until_complete(self.search_moves_async(own, enemy))
+
+    async def search_moves_async(self, own, enemy):
+        self.table.generation += 1
+        self.running_simulation_num = self.play_config.simulation_num_per_move
         self.requested_stop_thinking = False
+        self.solver_deadline = time() + self.play_config.solver_sec_per_move_in_simulation
+        self.batcher.active_players.add(self)
 
         coroutine_list = []
         for it in range(self.play_config.simulation_num_per_move):
             cor = self.start_search_my_move(own, enemy)
             coroutine_list.append(cor)
 
-        coroutine_list.append(self.prediction_worker())
-        loop.run_until_complete(asyncio.gather(*coroutine_list))
+        if self.own_batcher:
+            coroutine_list.append(self.batcher.worker())
+        await asyncio.gather(*coroutine_list)
+        self.cancel_solving()
 
     async def start_search_my_move(self, own, enemy):
-        self.running_simulation_num += 1
         root_key = self.counter_key(ReversiEnv().update(own, enemy, Player.black))
-        with await self.sem:  # reduce parallel search number
+        root_node = self.get_node(root_key)
+        async with self.sem:  # reduce parallel search number
             if self.requested_stop_thinking:
-                self.running_simulation_num -= 1
+                self.finish_simulation()
                 return None
+            self.evict_nodes(root_key)
             env = ReversiEnv().update(own, enemy, Player.black)
             leaf_v = await self.search_my_move(env, is_root_node=True)
-            self.running_simulation_num -= 1
+            self.simulation_num += 1
+            self.finish_simulation()
             if self.callback_in_mtcs and self.callback_in_mtcs.per_sim > 0 and \
                     self.running_simulation_num % self.callback_in_mtcs.per_sim == 0:
-                self.callback_in_mtcs.callback(list(self.var_q(root_key)), list(self.var_n[root_key]))
+                self.callback_in_mtcs.callback(list(self.var_q(root_node)), list(self.var_n(root_node)))
             return leaf_v
 
+    def finish_simulation(self):
+        self.running_simulation_num -= 1
+        if self.running_simulation_num == 0:
+            self.batcher.active_players.discard(self)
+        self.batcher.notify()
+
     async def search_my_move(self, env: ReversiEnv, is_root_node=False):
         """
 
@@ -232,66 +453,104 @@ class ReversiPlayer:
                 return 0
 
         key = self.counter_key(env)
-        another_side_key = self.another_side_counter_key(env)
+        table = self.table
+        node = self.get_node(key)
+        another_side_node = self.get_node(self.another_side_counter_key(env))
 
         if self.config.play.use_solver_turn_in_simulation and \
                 env.turn >= self.config.play.use_solver_turn_in_simulation:
-            action, score = self.solver.solve(key.black, key.white, Player(key.next_player), exactly=False)
-            if action:
+            action, score = await self.solve_in_simulation(key)
+            if action is not None:
                 score = score if env.next_player == Player.black else -score
                 leaf_v = np.sign(score)
                 leaf_p = np.zeros(64)
                 leaf_p[action] = 1
-                self.var_n[key][action] += 1
-                self.var_w[key][action] += leaf_v
-                self.var_p[key] = leaf_p
-                self.var_n[another_side_key][action] += 1
-                self.var_w[another_side_key][action] -= leaf_v
-                self.var_p[another_side_key] = leaf_p
+                self.update_n_w(node, action, 1, leaf_v)
+                self.set_p(node, leaf_p)
+                self.update_n_w(another_side_node, action, 1, -leaf_v)
+                self.set_p(another_side_node, leaf_p)
                 return np.sign(score)
 
-        while key in self.now_expanding:
-            await asyncio.sleep(self.config.play.wait_for_expanding_sleep_sec)
+        expanding = self.now_expanding.get(node.slot)
+        if expanding is not None:  # another simulation is evaluating the same leaf
+            await self.batcher.wait(expanding)
 
         # is leaf?
-        if key not in self.expanded:  # reach leaf node
-            leaf_v = await self.expand_and_evaluate(env)
+        if not table.expanded[node.slot]:  # reach leaf node
+            leaf_v = await self.expand_and_evaluate(env, node, another_side_node)
             if env.next_player == Player.black:
                 return leaf_v  # Value for black
             else:
                 return -leaf_v  # Value for white == -Value for black
+        elif self.play_config.canonicalize_mcts_key:
+            transform_bit = 1 << node.transform
+            if not table.seen_transforms[node.slot] & transform_bit:  # this position is not evaluated by NN
+                table.seen_transforms[node.slot] |= transform_bit
+                self.symmetry_saved_evaluation_num += 1
 
         virtual_loss = self.config.play.virtual_loss
         virtual_loss_for_w = virtual_loss if env.next_player == Player.black else -virtual_loss
 
-        action_t = self.select_action_q_and_u(env, is_root_node)
+        action_t = self.select_action_q_and_u(env, node, is_root_node)
         _, _ = env.step(action_t)
 
-        self.var_n[key][action_t] += virtual_loss
-        self.var_w[key][action_t] -= virtual_loss_for_w
+        self.update_n_w(node, action_t, virtual_loss, -virtual_loss_for_w)
         leaf_v = await self.search_my_move(env)  # next move
 
         # on returning search path
         # update: N, W
-        self.var_n[key][action_t] += - virtual_loss + 1
-        self.var_w[key][action_t] += virtual_loss_for_w + leaf_v
+        self.update_n_w(node, action_t, - virtual_loss + 1, virtual_loss_for_w + leaf_v)
         # update another side info(flip color and player)
-        self.var_n[another_side_key][action_t] += 1
-        self.var_w[another_side_key][action_t] -= leaf_v  # must flip the sign.
+        self.update_n_w(another_side_node, action_t, 1, -leaf_v)  # must flip the sign.
         return leaf_v
 
-    async def expand_and_evaluate(self, env):
+    def cancel_solving(self):
+        """cancel the solver started in the simulations of this move, so that the next solve starts at once"""
+        for future in self.solver_futures.values():
+            future.cancel()
+        self.solver_cancel.set()  # stops the running one and the ones which are about to start
+        self.solver_cancel = Event()
+        self.solver_futures = {}
+
+    def close(self):
+        """stop the solver thread. The player cannot search after this."""
+        self.cancel_solving()
+        self.solver_executor.shutdown(wait=False)
+
+    async def solve_in_simulation(self, key):
+        """win/loss result of the position by the solver, without blocking other simulations.
+
+        The solver is started if the position is not being solved and the time budget of this move remains.
+        If `wait_solver_in_simulation` is False, the simulation does not wait for the solver,
+        and the position is evaluated by the model until it is solved.
+
+        :param CounterKey key:
+        :return: (move, score of next_player), or (None, None) if not solved
+        """
+        future = self.solver_futures.get(key)
+        if future is None:
+            if time() >= self.solver_deadline:
+                return None, None
+            future = self.solver_futures[key] = self.submit_solve(key, exactly=False, deadline=self.solver_deadline,
+                                                                  cancel=self.solver_cancel)
+        if not future.done():
+            if not self.play_config.wait_solver_in_simulation:
+                return None, None
+            await self.batcher.wait(asyncio.wrap_future(future, loop=self.loop), is_prediction=False)
+        return future.result()
+
+    async def expand_and_evaluate(self, env, node, another_side_node):
         """expand new leaf
 
-        update var_p, return leaf_v
+        update P, return leaf_v
 
         :param ReversiEnv env:
+        :param Node node: node of env
+        :param Node another_side_node:
         :return: leaf_v
         """
 
-        key = self.counter_key(env)
-        another_side_key = self.another_side_counter_key(env)
-        self.now_expanding.add(key)
+        expanding = self.now_expanding[node.slot] = self.loop.create_future()
 
         black, white = env.board.black, env.board.white
 
@@ -304,12 +563,8 @@ class ReversiPlayer:
         for i in range(rotate_right_num):
             black, white = rotate90(black), rotate90(white)  # rotate90: rotate bitboard RIGHT 1 time
 
-        black_ary = bit_to_array(black, 64).reshape((8, 8))
-        white_ary = bit_to_array(white, 64).reshape((8, 8))
-        state = [black_ary, white_ary] if env.next_player == Player.black else [white_ary, black_ary]
-        future = await self.predict(np.array(state))  # type: Future
-        await future
-        leaf_p, leaf_v = future.result()
+        state = (black, white) if env.next_player == Player.black else (white, black)
+        leaf_p, leaf_v = await self.batcher.predict(state)
 
         # reverse rotate and flip about leaf_p
         if rotate_right_num > 0 or is_flip_vertical:  # reverse rotation and flip. rot -> flip.
@@ -320,39 +575,13 @@ class ReversiPlayer:
                 leaf_p = np.flipud(leaf_p)
             leaf_p = leaf_p.reshape((64, ))
 
-        self.var_p[key] = leaf_p  # P is value for next_player (black or white)
-        self.var_p[another_side_key] = leaf_p
-        self.expanded.add(key)
-        self.now_expanding.remove(key)
-        return float(leaf_v)
-
-    async def prediction_worker(self):
-        """For better performance, queueing prediction requests and predict together in this worker.
-
-        speed up about 45sec -> 15sec for example.
-        :return:
-        """
-        q = self.prediction_queue
-        margin = 10  # avoid finishing before other searches starting.
-        while self.running_simulation_num > 0 or margin > 0:
-            if q.empty():
-                if margin > 0:
-                    margin -= 1
-                await asyncio.sleep(self.config.play.prediction_worker_sleep_sec)
-                continue
-            item_list = [q.get_nowait() for _ in range(q.qsize())]  # type: list[QueueItem]
-            #logger.debug(f"predicting {len(item_list)} items")
-            data = np.array([x.state for x in item_list])
-            policy_ary, value_ary = self.api.predict(data)  # shape=(N, 2, 8, 8)
-            #logger.debug(f"predicted {len(item_list)} items")
-            for p, v, item in zip(policy_ary, value_ary, item_list):
-                item.future.set_result((p, v))
-
-    async def predict(self, x):
-        future = self.loop.create_future()
-        item = QueueItem(x, future)
-        await self.prediction_queue.put(item)
-        return future
+        self.set_p(node, leaf_p)  # P is value for next_player (black or white)
+        self.set_p(another_side_node, leaf_p)
+        self.table.expanded[node.slot] = True
+        self.table.seen_transforms[node.slot] = 1 << node.transform
+        del self.now_expanding[node.slot]
+        expanding.set_result(None)
+        return float(leaf_v[0])
 
     def finish_game(self, z):
         """
@@ -372,17 +601,18 @@ class ReversiPlayer:
         """
         pc = self.play_config
         env = ReversiEnv().update(own, enemy, Player.black)
-        key = self.counter_key(env)
+        node = self.get_node(self.counter_key(env))
         if env.turn < pc.change_tau_turn:
-            return self.calc_policy_by_tau_1(key)
+            return self.calc_policy_by_tau_1(node)
         else:
-            action = np.argmax(self.var_n[key])  # tau = 0
+            action = np.argmax(self.var_n(node))  # tau = 0
             ret = np.zeros(64)
             ret[action] = 1
             return ret
 
-    def calc_policy_by_tau_1(self, key):
-        return self.var_n[key] / np.sum(self.var_n[key])  # tau = 1
+    def calc_policy_by_tau_1(self, node):
+        n = self.var_n(node).astype(np.float64)
+        return n / np.sum(n)  # tau = 1
 
     @staticmethod
     def counter_key(env: ReversiEnv):
@@ -392,19 +622,21 @@ class ReversiPlayer:
     def another_side_counter_key(env: ReversiEnv):
         return CounterKey(env.board.white, env.board.black, another_player(env.next_player).value)
 
-    def select_action_q_and_u(self, env, is_root_node):
+    def select_action_q_and_u(self, env, node, is_root_node):
         key = self.counter_key(env)
         if env.next_player == Player.black:
             legal_moves = find_correct_moves(key.black, key.white)
         else:
             legal_moves = find_correct_moves(key.white, key.black)
         # noinspection PyUnresolvedReferences
-        xx_ = np.sqrt(np.sum(self.var_n[key]))  # SQRT of sum(N(s, b); for all b)
+        var_n = self.var_n(node)
+        xx_ = np.sqrt(np.sum(var_n))  # SQRT of sum(N(s, b); for all b)
         xx_ = max(xx_, 1)  # avoid u_=0 if N is all 0
-        p_ = self.var_p[key]
+        p_ = self.var_p(node)
+        legal_array = bit_to_array(legal_moves, 64)
 
         # re-normalize in legal moves
-        p_ = p_ * bit_to_array(legal_moves, 64)
+        p_ = p_ * legal_array
         if np.sum(p_) > 0:
             # decay policy gradually in the end phase
             _pc = self.config.play
@@ -416,12 +648,12 @@ class ReversiPlayer:
             noise = dirichlet_noise_of_mask(legal_moves, self.play_config.dirichlet_alpha)
             p_ = (1 - self.play_config.noise_eps) * p_ + self.play_config.noise_eps * noise
 
-        u_ = self.play_config.c_puct * p_ * xx_ / (1 + self.var_n[key])
+        u_ = self.play_config.c_puct * p_ * xx_ / (1 + var_n)
         if env.next_player == Player.black:
-            v_ = (self.var_q(key) + u_ + 1000) * bit_to_array(legal_moves, 64)
+            v_ = (self.var_q(node) + u_ + 1000) * legal_array
         else:
             # When enemy's selecting action, flip Q-Value.
-            v_ = (-self.var_q(key) + u_ + 1000) * bit_to_array(legal_moves, 64)
+            v_ = (-self.var_q(node) + u_ + 1000) * legal_array
 
         # noinspection PyTypeChecker
         action_t = int(np.argmax(v_))
@@ -433,5 +665,84 @@ class ReversiPlayer:
         return pp / np.sum(pp)
 
     def create_solver(self):
-        return ReversiSolver()
+        return ReversiSolver(self.play_config.solver_table_bits)
+
+
+class PredictionBatcher:
+    """queue prediction requests of players searching on the same event loop, and predict them together."""
+
+    def __init__(self, api, queue_size, loop=None):
+        """
+
+        :param ReversiModelAPI api:
+        :param int queue_size: flush the queue when it reaches this size
+        """
+        self.api = api
+        self.queue_size = queue_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = []  # type: list[QueueItem]
+        self.event = asyncio.Event()
+        self.active_players = set()  # type: set[ReversiPlayer]  # players which have running simulations
+        self.blocked_simulation_num = 0  # simulations waiting for the worker
+        self.stopped = False
+
+        # prediction stats
+        self.batch_size_counter = Counter()  # batch size -> count
+        self.prediction_wait_sec = 0
+        self.prediction_wait_count = 0
+
+    async def worker(self, until_stopped=False):
+        """For better performance, queueing prediction requests and predict together in this worker.
+
+        The queue is flushed when it reaches `queue_size`
+        or when all searching simulations are waiting for predictions.
+        speed up about 45sec -> 15sec for example.
+        :param bool until_stopped: if False, return when no player is searching. if True, run until `stop()`.
+        :return:
+        """
+        while (not self.stopped) if until_stopped else self.active_players:
+            await self.event.wait()
+            self.event.clear()
+            if not self.queue:
+                continue
+            item_list, self.queue = self.queue, []
+            self.batch_size_counter[len(item_list)] += 1
+            data = np.array([x.state for x in item_list], dtype=np.uint64)
+            try:
+                policy_ary, value_ary = self.api.predict(data)  # shape=(N, 2)
+            except Exception as e:  # raise it in the waiting simulations, not only in this worker
+                for item in item_list:
+                    item.future.set_exception(e)
+                continue
+            for p, v, item in zip(policy_ary, value_ary, item_list):
+                item.future.set_result((p, v))
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+
+    def notify(self):
+        searching_num = sum(min(p.play_config.parallel_search_num, p.running_simulation_num)
+                            for p in self.active_players)
+        if len(self.queue) >= self.queue_size or self.blocked_simulation_num >= searching_num:
+            self.event.set()
 
+    async def predict(self, x):
+        future = self.loop.create_future()
+        self.queue.append(QueueItem(x, future))
+        await self.wait(future)
+        return future.result()
+
+    async def wait(self, future, is_prediction=True):
+        """wait for the future as a blocked simulation, so that the queue is flushed if all simulations are blocked.
+
+        :param bool is_prediction: if False, the time is not counted as the prediction wait time
+        """
+        start_time = time()
+        self.blocked_simulation_num += 1
+        self.notify()
+        await future
+        self.blocked_simulation_num -= 1
+        if is_prediction:
+            self.prediction_wait_sec += time() - start_time
+            self.prediction_wait_count += 1
@@ -45,7 +45,8 @@ class ResourceConfig(ConfigBase):
         self.next_generation_model_weight_filename = "model_weight.h5"
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
-        self.play_data_filename_tmpl = "play_%s.json"
+        self.play_data_filename_tmpl = "play_%s.bin"  # binary format of lib.data_helper
+        self.replay_store_path = os.path.join(self.play_data_dir, "replay_store.bin")
         self.self_play_ggf_data_dir = os.path.join(self.data_dir, "self_play-ggf")
         self.ggf_filename_tmpl = "self_play-%s.ggf"
 
@@ -53,6 +54,7 @@ class ResourceConfig(ConfigBase):
         self.main_log_path = os.path.join(self.log_dir, "main.log")
         self.tensorboard_log_dir = os.path.join(self.log_dir, 'tensorboard')
         self.self_play_log_dir = os.path.join(self.tensorboard_log_dir, "self_play")
+        self.self_play_stats_path = os.path.join(self.log_dir, "self_play_stats.jsonl")
         self.force_learing_rate_file = os.path.join(self.data_dir, ".force-lr")
         self.force_simulation_num_file = os.path.join(self.data_dir, ".force-sim")
         self.self_play_game_idx_file = os.path.join(self.data_dir, ".self-play-game-idx")
@@ -98,6 +100,8 @@ class NBoardConfig(ConfigBase):
         self.read_stdin_timeout = 0.1
         self.simulation_num_per_depth_about = 20
         self.hint_callback_per_sim = 10
+        self.use_solver_turn = 44  # replaces PlayConfig.use_solver_turn unless it disables the solver
+        self.solver_sec_per_move = 10  # time budget of the endgame solver per `go` or `hint`
 
 
 class EvaluateConfig(ConfigBase):
@@ -115,20 +119,34 @@ class EvaluateConfig(ConfigBase):
 
 class PlayDataConfig(ConfigBase):
     def __init__(self):
-        # Max Training Data Size = nb_game_in_file * max_file_num * 8
+        # Max Training Data Size = nb_game_in_file * max_file_num * (8 if save_8_symmetries else 1)
         self.multi_process_num = 16
+        self.parallel_game_num = 1  # games played concurrently in each self-play process, sharing prediction batches
+        self.single_process = False  # self-play in one process calling the model directly, without the API server
+        self.solver_cache_size = 1 << 20  # solver results shared by self-play workers (24 bytes each). 0: disabled
+        self.stats_interval_sec = 60  # interval of logging throughput of self-play. see ResourceConfig.self_play_stats_path
         self.nb_game_in_file = 2
         self.max_file_num = 800
         self.save_policy_of_tau_1 = True
+        self.save_8_symmetries = False  # if False, save 1 sample per move and TrainerConfig.symmetry_augmentation is used
+        self.use_replay_store = False  # append samples to ResourceConfig.replay_store_path instead of play data files
+        self.replay_store_capacity = 500000  # max samples in the replay store
         self.enable_ggf_data = True
         self.nb_game_in_ggf_file = 100
         self.drop_draw_game_rate = 0
+        self.api_transport = "shared_memory"  # "shared_memory" or "pipe"
+        self.api_shared_memory_batch_size = 64  # max states in one request through shared memory
+        self.api_eval_cache_size_mb = 256  # LRU cache of model outputs in the api server. 0 disables it
 
 
 class PlayConfig(ConfigBase):
     def __init__(self):
         self.simulation_num_per_move = 200
         self.share_mtcs_info_in_self_play = True
+        self.canonicalize_mcts_key = False  # share MCTS nodes among the 8 symmetric positions
+        self.reuse_tree = False  # keep only the subtree of the current position before searching a move
+        self.mcts_node_budget = None  # max number of MCTS nodes checked before each simulation. None means no limit
+        self.mcts_eviction_policy = "least_visited"  # "least_visited" or "oldest"
         self.reset_mtcs_info_per_game = 1
         self.thinking_loop = 10
         self.required_visit_to_decide_action = 400
@@ -138,10 +156,8 @@ class PlayConfig(ConfigBase):
         self.dirichlet_alpha = 0.5
         self.change_tau_turn = 4
         self.virtual_loss = 3
-        self.prediction_queue_size = 16
+        self.prediction_queue_size = 16  # flush predictions when the queue reaches this size
         self.parallel_search_num = 8
-        self.prediction_worker_sleep_sec  = 0.0001
-        self.wait_for_expanding_sleep_sec = 0.00001
         self.resign_threshold = -0.9
         self.allowed_resign_turn = 20
         self.disable_resignation_rate = 0.1
@@ -153,6 +169,10 @@ class PlayConfig(ConfigBase):
         # Using a solver is a kind of cheating!
         self.use_solver_turn = 50
         self.use_solver_turn_in_simulation = 50
+        self.solver_sec_per_move = 30  # time budget of the solver at use_solver_turn. see also NBoardConfig
+        self.solver_sec_per_move_in_simulation = 10  # time budget of the solver in the simulations of one move
+        self.wait_solver_in_simulation = True  # if False, the model evaluates positions which are being solved
+        self.solver_table_bits = 18  # transposition table of the solver has 2^solver_table_bits entries (24 bytes each)
 
         #
         self.schedule_of_simulation_num_per_move = [
@@ -168,7 +188,7 @@ class PlayConfig(ConfigBase):
 
 class TrainerConfig(ConfigBase):
     def __init__(self):
-        self.wait_after_save_model_ratio = 1  # wait after saving model
+        self.wait_after_save_model_ratio = 1  # wait after saving model. ignored if the sampling is weighted
         self.batch_size = 256  # 2048
         self.min_data_size_to_learn = 100000
         self.epoch_to_checkpoint = 1
@@ -177,6 +197,15 @@ class TrainerConfig(ConfigBase):
         self.use_tensorboard = True
         self.logging_per_steps = 100
         self.delete_self_play_after_number_of_training = 0  # control ratio of train:self data.
+        # transform samples in each batch: "random" (1 of 8 symmetries), "all" (8 symmetries) or None
+        self.symmetry_augmentation = "random"
+        self.prefetch_batch_num = 10  # batches prepared in background while training
+        self.load_data_process_num = 4  # processes to decode JSON play data files
+        # sampling weight of training data. uniform if both are None/0
+        self.recency_half_life = None  # the weight of a sample halves when this number of newer samples are added
+        # weight by (loss of the sample) ** alpha. The loss is refreshed after each epoch for the trained samples.
+        # not supported with PlayDataConfig.use_replay_store
+        self.loss_priority_alpha = 0
         self.lr_schedules = [
             (0, 0.01),
             (150000, 0.001),
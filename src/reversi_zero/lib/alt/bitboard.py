@@ -0,0 +1,4 @@
+import pyximport
+pyximport.install()
+
+from .bitboard_cython import *
@@ -0,0 +1,109 @@
+# C level bitboard primitives. `include` this file to call them without the overhead of python calls.
+# They are `nogil`, so that they can be called while the GIL is released.
+
+
+cdef inline int _bit_count(unsigned long long x) nogil:
+    """SWAR popcount. Compiler builtins are not portable (MSVC has no __builtin_popcountll)."""
+    x = x - ((x >> 1) & 0x5555555555555555ULL)
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL)
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0FULL
+    return <int>((x * 0x0101010101010101ULL) >> 56)
+
+
+cdef inline unsigned long long _find_correct_moves(unsigned long long own, unsigned long long enemy) nogil:
+    """return legal moves"""
+    cdef unsigned long long left_right_mask = 0x7e7e7e7e7e7e7e7eULL  # Both most left-right edge are 0, else 1
+    cdef unsigned long long top_bottom_mask = 0x00ffffffffffff00ULL  # Both most top-bottom edge are 0, else 1
+    cdef unsigned long long mask = left_right_mask & top_bottom_mask
+    cdef unsigned long long mobility = 0
+    mobility |= search_offset_left(own, enemy, left_right_mask, 1)  # Left
+    mobility |= search_offset_left(own, enemy, mask, 9)  # Left Top
+    mobility |= search_offset_left(own, enemy, top_bottom_mask, 8)  # Top
+    mobility |= search_offset_left(own, enemy, mask, 7)  # Top Right
+    mobility |= search_offset_right(own, enemy, left_right_mask, 1)  # Right
+    mobility |= search_offset_right(own, enemy, mask, 9)  # Bottom Right
+    mobility |= search_offset_right(own, enemy, top_bottom_mask, 8)  # Bottom
+    mobility |= search_offset_right(own, enemy, mask, 7)  # Left bottom
+    return mobility
+
+
+cdef inline unsigned long long _calc_flip(int pos, unsigned long long own, unsigned long long enemy) nogil:
+    cdef unsigned long long f1 = _calc_flip_half(pos, own, enemy)
+    cdef unsigned long long f2 = _calc_flip_half(63 - pos, _rotate180(own), _rotate180(enemy))
+    return f1 | _rotate180(f2)
+
+
+cdef inline unsigned long long _calc_flip_half(int pos, unsigned long long own, unsigned long long enemy) nogil:
+    cdef unsigned long long el[4]
+    cdef unsigned long long masks[4]
+    cdef unsigned long long flipped = 0, outflank, e, mask
+    cdef int i
+    el[0] = enemy
+    el[1] = el[2] = el[3] = enemy & 0x7e7e7e7e7e7e7e7eULL
+    masks[0] = 0x0101010101010100ULL << pos
+    masks[1] = 0x00000000000000feULL << pos
+    masks[2] = 0x0002040810204080ULL << pos
+    masks[3] = 0x8040201008040200ULL << pos
+    for i in range(4):
+        e = el[i]
+        mask = masks[i]
+        outflank = mask & ((e | ~mask) + 1) & own
+        flipped |= (outflank - (outflank != 0)) & mask
+    return flipped
+
+
+cdef inline unsigned long long search_offset_left(unsigned long long own, unsigned long long enemy,
+                                                  unsigned long long mask, int offset) nogil:
+    cdef unsigned long long e = enemy & mask
+    cdef unsigned long long blank = ~(own | enemy)
+    cdef unsigned long long t = e & (own >> offset)
+    t |= e & (t >> offset)
+    t |= e & (t >> offset)
+    t |= e & (t >> offset)
+    t |= e & (t >> offset)
+    t |= e & (t >> offset)  # Up to six stones can be turned at once
+    return blank & (t >> offset)  # Only the blank squares can be started
+
+
+cdef inline unsigned long long search_offset_right(unsigned long long own, unsigned long long enemy,
+                                                   unsigned long long mask, int offset) nogil:
+    cdef unsigned long long e = enemy & mask
+    cdef unsigned long long blank = ~(own | enemy)
+    cdef unsigned long long t = e & (own << offset)
+    t |= e & (t << offset)
+    t |= e & (t << offset)
+    t |= e & (t << offset)
+    t |= e & (t << offset)
+    t |= e & (t << offset)  # Up to six stones can be turned at once
+    return blank & (t << offset)  # Only the blank squares can be started
+
+
+cdef inline unsigned long long _flip_vertical(unsigned long long x) nogil:
+    cdef unsigned long long k1 = 0x00FF00FF00FF00FFULL
+    cdef unsigned long long k2 = 0x0000FFFF0000FFFFULL
+    x = ((x >> 8) & k1) | ((x & k1) << 8)
+    x = ((x >> 16) & k2) | ((x & k2) << 16)
+    x = (x >> 32) | (x << 32)
+    return x
+
+
+cdef inline unsigned long long _flip_diag_a1h8(unsigned long long x) nogil:
+    cdef unsigned long long k1 = 0x5500550055005500ULL
+    cdef unsigned long long k2 = 0x3333000033330000ULL
+    cdef unsigned long long k4 = 0x0f0f0f0f00000000ULL
+    cdef unsigned long long t
+    t = k4 & (x ^ (x << 28))
+    x ^= t ^ (t >> 28)
+    t = k2 & (x ^ (x << 14))
+    x ^= t ^ (t >> 14)
+    t = k1 & (x ^ (x << 7))
+    x ^= t ^ (t >> 7)
+    return x
+
+
+cdef inline unsigned long long _rotate90(unsigned long long x) nogil:
+    return _flip_diag_a1h8(_flip_vertical(x))
+
+
+cdef inline unsigned long long _rotate180(unsigned long long x) nogil:
+    return _rotate90(_rotate90(x))
@@ -1,173 +1,255 @@
+# cython: legacy_implicit_noexcept=True
 from time import time
 
+import numpy as np
+from libc.stdlib cimport calloc, free
+
 from reversi_zero.env.reversi_env import Player
-from .bitboard_cython import bit_count, find_correct_moves, calc_flip
+
+include "bitboard_core.pxi"
 
 # CONST
 DEF BLACK = 1
 DEF WHITE = 2
+DEF MAX_SCORE = 64
+DEF ORDER_BY_MOBILITY_EMPTIES = 7  # order moves by the enemy mobility if empties are more than this
+DEF TIME_CHECK_INTERVAL = 4096  # nodes
+DEF TT_MIN_EMPTIES = 5  # nodes of fewer empties are not stored in the transposition table
 
-# TYPE
-cdef struct SolveResult:
-    int move
-    int score
+# quadrants of the board, for the parity ordering
+cdef unsigned long long QUADRANTS[4]
+QUADRANTS[:] = [0x000000000F0F0F0FULL, 0x00000000F0F0F0F0ULL, 0x0F0F0F0F00000000ULL, 0xF0F0F0F000000000ULL]
+cdef unsigned long long CORNERS = 0x8100000000000081ULL
+
+# zobrist keys per byte of own and enemy bitboards (tabulation hashing)
+cdef unsigned long long ZOBRIST[16][256]
+_random = np.random.RandomState(20180327).randint(0, 1 << 32, size=(2, 16, 256)).astype(np.uint64)
+_zobrist = (_random[0] << np.uint64(32)) | _random[1]
+for _i in range(16):
+    for _j in range(256):
+        ZOBRIST[_i][_j] = _zobrist[_i, _j]
 
-cdef struct Env:
+
+# TYPE
+cdef struct TTEntry:
     unsigned long long own
     unsigned long long enemy
-    int next_player
-    unsigned long long legal_moves
-    int finished
-    int parent_action
-    int best_move
-    int best_score
-    int next_search_action
-
+    signed char lower  # lower bound of the score
+    signed char upper  # upper bound of the score
+    signed char move  # best move, -1 if unknown
+    unsigned char empties  # depth of the search. 0 means empty entry
+    unsigned int generation  # `solve()` count when the entry is stored
 
-# cdef Env create_env(unsigned long long own, unsigned long long enemy, int next_player):
-#     legal_moves = find_correct_moves(own, enemy)
-#     return Env(own, enemy, next_player, legal_moves, 0, -1, best_move=-1, best_score=-100, next_search_action=0)
-#
 
 cdef class ReversiSolver:
-    cdef dict cache
-    cdef int last_is_exactly
+    """negamax alpha-beta endgame solver.
+
+    Moves are searched in the order of fewer enemy mobility (fastest-first) and corners first,
+    and near the end, moves in the quadrants of odd empties first (parity).
+    Scores are disc difference of the end of the game for the player to move.
+
+    The search releases the GIL, so that other threads run while solving.
+
+    Bounds of searched positions are kept in a fixed size transposition table across `solve()` calls,
+    and shared by exact and win/loss searches.
+    An entry is replaced by a deeper search result (more empties) or by a result of a newer `solve()`.
+    """
+    cdef TTEntry *table
+    cdef unsigned long long table_mask
+    cdef unsigned int generation
+    cdef double start_time
+    cdef double timeout
+    cdef long node_count
+    cdef int timed_out
+    cdef object cancel
+    cdef public long tt_lookup_count
+    cdef public long tt_hit_count
+
+    def __cinit__(self, int table_bits=18):
+        self.table = <TTEntry *>calloc(1 << table_bits, sizeof(TTEntry))
+        if self.table == NULL:
+            raise MemoryError()
+        self.table_mask = (1 << table_bits) - 1
+
+    def __dealloc__(self):
+        free(self.table)
+
+    def __init__(self, int table_bits=18):
+        """
 
-    def __init__(self):
-        self.cache = {}
-        self.last_is_exactly = 0
+        :param int table_bits: the transposition table has 2^table_bits entries (24 bytes each)
+        """
+        self.generation = 0
+        self.node_count = 0
+        self.timed_out = 0
+        self.tt_lookup_count = 0
+        self.tt_hit_count = 0
 
-    def solve(self, black, white, next_player, timeout=30, exactly=False):
+    def solve(self, black, white, next_player, timeout=30, exactly=False, cancel=None):
         """
 
         :param black:
         :param white:
         :param Player next_player: 1=Black, 2=White
         :param timeout:
-        :param exactly:
-        :return:
+        :param exactly: if False, the score is only correct in the sign (win, draw or loss)
+        :param threading.Event cancel: stop solving as timeout when this is set (from another thread)
+        :return: (move, score of next_player), or (None, None) if timeout, cancelled or no legal moves
         """
-        if not self.last_is_exactly and exactly:
-            self.cache = {}
-        self.last_is_exactly = exactly
-
-        # print("start solving")
-        start_time = time()
-        result = self.find_winning_move_and_score(black, white, next_player.value, exactly, int(timeout))
-        # print(f"finish solving({time() - start_time:.4f} sec) {result}")
-        if result.move < 0:
-            return None, None
-        else:
-            return result.move, result.score
-
-    cdef SolveResult find_winning_move_and_score(self, unsigned long long black, unsigned long long white, int next_player, int exactly, int timeout):
-        cdef Env* child_env = NULL
-        cdef Env* env
-        cdef Env* next_env
-        cdef EnvStack stack = EnvStack()
-        cdef unsigned long long next_own, next_enemy
-        cdef int root_next_player = next_player
-        cdef Env* root_env
-
-        if next_player == BLACK:
-            root_env = stack.add(black, white, next_player)
+        cdef unsigned long long own, enemy
+        cdef int move = -1
+        cdef int score
+        cdef int bound = MAX_SCORE if exactly else 1
+        if next_player.value == BLACK:
+            own, enemy = black, white
         else:
-            root_env = stack.add(white, black, next_player)
-
-        start_time = time()
-        while stack.size():
-            if time() - start_time > timeout:
-                return SolveResult(-1, -100)
-
-            env = stack.top()
-
-            cache_key = (env.own, env.enemy, env.next_player)
-            if cache_key in self.cache:
-                obj = <SolveResult>self.cache[cache_key]
-                env.best_move = obj.move
-                env.best_score = obj.score
-                child_env = stack.pop()
-                child_env.finished = 1
-                continue
-
-            if child_env and child_env.finished:
-                child_env.finished = 0
-                child_score = child_env.best_score
-                if child_env.next_player != env.next_player:
-                    child_score = -child_score
-                if env.best_score < child_score:
-                    # print(("=" * stack.size()) + f"> update best score ({child_env.parent_action},{child_score})")
-                    env.best_move = child_env.parent_action
-                    env.best_score = child_score
-
-            action = next_action(env)
-            # print(("=" * stack.size()) + f"> ID={env.id} NP={env.next_player}:{action} best=({env.best_move},{env.best_score})")
-            if action == -1 or (not exactly and env.best_score > 0):
-                child_env = stack.pop()
-                child_env.finished = 1
-                self.cache[cache_key] = SolveResult(move=env.best_move, score=env.best_score)
-                continue
-
-            flipped = calc_flip(action, env.own, env.enemy)
-            next_own = (env.own ^ flipped) | (1 << action)
-            next_enemy = env.enemy ^ flipped
-
-            if find_correct_moves(next_enemy, next_own) > 0:
-                next_env = stack.add(next_enemy, next_own, 3 - env.next_player)  # next_player: 2 => 1, 1 => 2
-                next_env.parent_action = action
-            elif find_correct_moves(next_own, next_enemy) > 0:
-                next_env = stack.add(next_own, next_enemy, env.next_player)
-                next_env.parent_action = action
-            else:
-                score = bit_count(next_own) - bit_count(next_enemy)
-                if env.best_score < score:
-                    env.best_move = action
-                    env.best_score = score
-
-        return SolveResult(root_env.best_move, root_env.best_score)
-
-
-cdef int next_action(Env *env):
-    for i in range(env.next_search_action, 64):
-        if env.legal_moves & (1 << i):
-            env.next_search_action = i+1
-            return i
-    return -1
-
-
-cdef class EnvStack:
-    cdef Env stack[64]
-    cdef int pos
-
-    def __init__(self):
-        self.pos = 0
-
-    cdef Env* add(self, unsigned long long own, unsigned long long enemy, int next_player):
-        cdef Env* env = &self.stack[self.pos]
-        env.own = own
-        env.enemy = enemy
-        env.next_player = next_player
-        env.legal_moves = find_correct_moves(own, enemy)
-        env.finished = 0
-        env.parent_action = -1
-        env.best_move = -1
-        env.best_score = -100
-        env.next_search_action = 0
-        self.pos += 1
-        return env
-
-    cdef Env* top(self):
-        return &(self.stack[self.pos - 1])
-
-    cdef Env* pop(self):
-        ret = self.top()
-        self.pos -= 1
-        # print(f"pop: {ret.id} from pos: {self.pos}")
-        return ret
-
-    cdef int size(self):
-        return self.pos
-
-    cdef debug(self):
-        for i in range(self.pos):
-            print(f"{i}: {self.stack[i].id}")
+            own, enemy = white, black
+        if _find_correct_moves(own, enemy) == 0 or (cancel is not None and cancel.is_set()):
+            return None, None
+
+        self.start_time = time()
+        self.timeout = timeout
+        self.cancel = cancel
+        self.timed_out = 0
+        self.generation += 1
+        with nogil:
+            score = self.search(own, enemy, -bound, bound, 0, &move)
+        self.cancel = None
+        if self.timed_out:
+            return None, None
+        return move, score
+
+    @property
+    def nodes(self):
+        return self.node_count
+
+    @property
+    def tt_hit_rate(self):
+        if self.tt_lookup_count == 0:
+            return 0
+        return self.tt_hit_count / self.tt_lookup_count
+
+    cdef int search(self, unsigned long long own, unsigned long long enemy, int alpha, int beta, int passed,
+                    int *best_move) nogil:
+        cdef unsigned long long legal_moves, flipped
+        cdef int moves[64]
+        cdef int n, i, v, best, move
+        cdef int empties = 64 - _bit_count(own | enemy)
+        cdef int tt_move = -1
+        cdef int searched_alpha, searched_beta
+        cdef TTEntry *entry = NULL
+
+        self.node_count += 1
+        if self.node_count % TIME_CHECK_INTERVAL == 0:
+            with gil:
+                if time() - self.start_time > self.timeout or (self.cancel is not None and self.cancel.is_set()):
+                    self.timed_out = 1
+        if self.timed_out:
+            return 0
+
+        legal_moves = _find_correct_moves(own, enemy)
+        if legal_moves == 0:
+            if passed or _find_correct_moves(enemy, own) == 0:
+                return _bit_count(own) - _bit_count(enemy)
+            return -self.search(enemy, own, -beta, -alpha, 1, NULL)
+
+        if empties >= TT_MIN_EMPTIES:
+            entry = &self.table[zobrist_hash(own, enemy) & self.table_mask]
+            self.tt_lookup_count += 1
+            if entry.empties and entry.own == own and entry.enemy == enemy:
+                self.tt_hit_count += 1
+                tt_move = entry.move
+                if best_move == NULL:  # the root needs the best move
+                    if entry.lower >= beta or entry.lower == entry.upper:
+                        return entry.lower
+                    if entry.upper <= alpha:
+                        return entry.upper
+                    alpha = max(alpha, entry.lower)
+                    beta = min(beta, entry.upper)
+        searched_alpha, searched_beta = alpha, beta
+
+        n = order_moves(own, enemy, legal_moves, moves, tt_move)
+        best = -MAX_SCORE - 1
+        move = -1
+        for i in range(n):
+            flipped = _calc_flip(moves[i], own, enemy)
+            if i == 0 or beta - alpha == 1:
+                v = -self.search(enemy ^ flipped, own ^ flipped | (1ULL << moves[i]), -beta, -alpha, 0, NULL)
+            else:  # principal variation search: prove that the move is worse by a null window
+                v = -self.search(enemy ^ flipped, own ^ flipped | (1ULL << moves[i]), -alpha - 1, -alpha, 0, NULL)
+                if alpha < v < beta:
+                    v = -self.search(enemy ^ flipped, own ^ flipped | (1ULL << moves[i]), -beta, -v, 0, NULL)
+            if self.timed_out:
+                return 0
+            if v > best:
+                best = v
+                move = moves[i]
+                if v > alpha:
+                    alpha = v
+                    if alpha >= beta:
+                        break
+        if best_move != NULL:
+            best_move[0] = move
+
+        if entry != NULL and (entry.empties <= empties or entry.generation != self.generation or
+                              (entry.own == own and entry.enemy == enemy)):
+            if entry.own != own or entry.enemy != enemy or not entry.empties:
+                entry.own, entry.enemy = own, enemy
+                entry.lower, entry.upper = -MAX_SCORE, MAX_SCORE
+            if best < searched_beta:  # upper bound
+                entry.upper = min(entry.upper, best)
+            if best > searched_alpha:  # lower bound
+                entry.lower = max(entry.lower, best)
+            entry.move = move
+            entry.empties = empties
+            entry.generation = self.generation
+        return best
+
+
+cdef inline unsigned long long zobrist_hash(unsigned long long own, unsigned long long enemy) nogil:
+    cdef unsigned long long h = 0
+    cdef int i
+    for i in range(8):
+        h ^= ZOBRIST[i][(own >> (i * 8)) & 0xFF] ^ ZOBRIST[i + 8][(enemy >> (i * 8)) & 0xFF]
+    return h
+
+
+cdef int order_moves(unsigned long long own, unsigned long long enemy, unsigned long long legal_moves, int *moves,
+                     int first_move) nogil:
+    """store legal moves in the search order to `moves` (64 entries) and return the number of them
+
+    first_move (the best move in the transposition table) is searched first if it is legal.
+    """
+    cdef int scores[64]
+    cdef int n = 0, i, move, score
+    cdef unsigned long long empties = ~(own | enemy)
+    cdef unsigned long long odd_quadrants = 0, flipped
+    cdef int by_mobility = _bit_count(empties) > ORDER_BY_MOBILITY_EMPTIES
+
+    for i in range(4):
+        if _bit_count(empties & QUADRANTS[i]) % 2 == 1:
+            odd_quadrants |= QUADRANTS[i]
+
+    for move in range(64):
+        if not legal_moves & (1ULL << move):
+            continue
+        score = 0
+        if move == first_move:
+            score = -1000
+        elif by_mobility:
+            flipped = _calc_flip(move, own, enemy)
+            score = _bit_count(_find_correct_moves(enemy ^ flipped, own ^ flipped | (1ULL << move))) * 4
+            if CORNERS & (1ULL << move):
+                score -= 8
+        if not odd_quadrants & (1ULL << move):
+            score += 1
+        # insertion sort by the score
+        i = n
+        while i > 0 and scores[i - 1] > score:
+            scores[i] = scores[i - 1]
+            moves[i] = moves[i - 1]
+            i -= 1
+        scores[i] = score
+        moves[i] = move
+        n += 1
+    return n
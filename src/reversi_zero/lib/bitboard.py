@@ -133,9 +133,41 @@ def bit_count(x):
     return bin(x).count('1')
 
 
+# _BYTE_TO_BITS[b] = bits of byte b, LSB first
+_BYTE_TO_BITS = np.unpackbits(np.arange(256, dtype=np.uint8).reshape((256, 1)), axis=1)[:, ::-1].copy()
+
+
 def bit_to_array(x, size):
     """bit_to_array(0b0010, 4) -> array([0, 1, 0, 0])"""
-    return np.array(list(reversed((("0" * size) + bin(x)[2:])[-size:])), dtype=np.uint8)
+    nbytes = (size + 7) // 8
+    x = int(x) & ((1 << size) - 1)
+    return _BYTE_TO_BITS[np.frombuffer(x.to_bytes(nbytes, "little"), dtype=np.uint8)].reshape((-1, ))[:size]
+
+
+def bits_to_arrays(x, dtype=np.uint8):
+    """unpack uint64 bitboards to 0/1 arrays.
+
+    bits_to_arrays(np.array([0b0010], dtype=np.uint64))[0, :4] -> array([0, 1, 0, 0])
+    :param np.ndarray x: uint64 array of any shape
+    :param dtype:
+    :return: array of shape x.shape + (64, )
+    """
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    rows = x.astype(np.dtype('<u8')).view(np.uint8).reshape(x.shape + (8, ))  # 1 byte = 1 row of the board
+    return _BYTE_TO_BITS[rows].reshape(x.shape + (64, )).astype(dtype, copy=False)
+
+
+def arrays_to_bits(ary):
+    """pack 0/1 arrays to uint64 bitboards. inverse of bits_to_arrays().
+
+    :param np.ndarray ary: array of shape (..., 64)
+    :return: uint64 array of shape ary.shape[:-1]
+    """
+    ary = np.asarray(ary)
+    shape = ary.shape[:-1]
+    rows = (ary != 0).reshape(shape + (8, 8))[..., ::-1]
+    packed = np.packbits(rows, axis=-1).reshape(shape + (8, ))
+    return np.ascontiguousarray(packed).view(np.dtype('<u8')).reshape(shape).astype(np.uint64)
 
 
 def flip_diag_a1h8(x):
@@ -161,11 +193,6 @@ def rotate180(x):
 
 def dirichlet_noise_of_mask(mask, alpha):
     num_1 = bit_count(mask)
-    noise = list(np.random.dirichlet([alpha] * num_1))
-    ret_list = []
-    for i in range(64):
-        if (1 << i) & mask:
-            ret_list.append(noise.pop(0))
-        else:
-            ret_list.append(0)
-    return np.array(ret_list)
+    ret = np.zeros(64)
+    ret[bit_to_array(mask, 64) == 1] = np.random.dirichlet([alpha] * num_1)
+    return ret
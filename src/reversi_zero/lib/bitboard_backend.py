@@ -0,0 +1,30 @@
+"""Bitboard primitives used by the engine.
+
+The implementation is selected by the environment variable `BITBOARD_BACKEND`.
+
+* `cython` (default): reversi_zero.lib.alt.bitboard_cython (compiled by pyximport)
+* `python`: reversi_zero.lib.bitboard
+
+If the cython module can not be built, the python version is used.
+"""
+import os
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+BACKEND = os.environ.get("BITBOARD_BACKEND", "cython")
+
+if BACKEND == "cython":
+    try:
+        from reversi_zero.lib.alt.bitboard import board_to_string, find_correct_moves, calc_flip, flip_vertical, \
+            b64, bit_count, bit_to_array, bits_to_arrays, arrays_to_bits, flip_diag_a1h8, rotate90, rotate180, \
+            dirichlet_noise_of_mask
+    except ImportError as e:
+        logger.warning(f"cannot load cython bitboard, so use python version: {e}")
+        BACKEND = "python"
+
+if BACKEND != "cython":
+    BACKEND = "python"
+    from reversi_zero.lib.bitboard import board_to_string, find_correct_moves, calc_flip, flip_vertical, \
+        b64, bit_count, bit_to_array, bits_to_arrays, arrays_to_bits, flip_diag_a1h8, rotate90, rotate180, \
+        dirichlet_noise_of_mask
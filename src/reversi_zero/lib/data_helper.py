@@ -1,16 +1,29 @@
 import json
 import os
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
 from logging import getLogger
 
+import numpy as np
+
 from reversi_zero.config import ResourceConfig
 
 logger = getLogger(__name__)
 
+# binary play data format (little endian):
+#   header: magic(4 bytes), version(uint16), reserved(uint16), record num(uint32)
+#   records: state(uint64 * 2 * N; own, enemy), policy(float16 * 64 * N), z(int8 * N)
+PLAY_DATA_MAGIC = b"RZPD"
+PLAY_DATA_VERSION = 1
+_HEADER = struct.Struct("<4sHHI")
+
 
 def get_game_data_filenames(rc: ResourceConfig):
+    """play data files including the old JSON format"""
     pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
-    files = list(sorted(glob(pattern)))
+    files = list(sorted(set(glob(pattern) + get_json_game_data_filenames(rc))))
     return files
 
 
@@ -20,11 +33,136 @@ def get_next_generation_model_dirs(rc: ResourceConfig):
     return dirs
 
 
+def get_json_game_data_filenames(rc: ResourceConfig):
+    """play data files of the old JSON format"""
+    pattern = os.path.join(rc.play_data_dir, os.path.splitext(rc.play_data_filename_tmpl % "*")[0] + ".json")
+    return list(sorted(glob(pattern)))
+
+
+def game_data_to_arrays(data):
+    """
+
+    :param data: list of [(own: bitboard, enemy: bitboard), [policy: float 64 items], z: number]
+    :return: (state, policy, z). shape=((N, 2), (N, 64), (N, )), dtype=(uint64, float32, int8)
+    """
+    state = np.array([state for state, _, _ in data], dtype=np.uint64).reshape((-1, 2))
+    policy = np.array([policy for _, policy, _ in data], dtype=np.float32).reshape((-1, 64))
+    z = np.array([z for _, _, z in data], dtype=np.int8)
+    return state, policy, z
+
+
 def write_game_data_to_file(path, data):
-    with open(path, "wt") as f:
-        json.dump(data, f)
+    """write play data in the binary format, or JSON if path ends with ".json"
+
+    :param str path:
+    :param data: list of [(own: bitboard, enemy: bitboard), [policy: float 64 items], z: number]
+    """
+    if path.endswith(".json"):
+        with open(path, "wt") as f:
+            json.dump(data, f)
+        return
+
+    state, policy, z = game_data_to_arrays(data)
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(PLAY_DATA_MAGIC, PLAY_DATA_VERSION, 0, len(z)))
+        f.write(state.astype("<u8").tobytes())
+        f.write(policy.astype("<f2").tobytes())
+        f.write(z.tobytes())
 
 
 def read_game_data_from_file(path):
-    with open(path, "rt") as f:
-        return json.load(f)
+    """read play data of the binary or JSON format
+
+    :param str path:
+    :return: (state, policy, z). shape=((N, 2), (N, 64), (N, )), dtype=(uint64, float32, int8)
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    if not buf.startswith(PLAY_DATA_MAGIC):
+        return game_data_to_arrays(json.loads(buf.decode()))
+
+    magic, version, _, n = _HEADER.unpack_from(buf)
+    if version != PLAY_DATA_VERSION:
+        raise ValueError(f"unsupported play data version {version}: {path}")
+    offset = _HEADER.size
+    state = np.frombuffer(buf, dtype="<u8", count=n * 2, offset=offset).reshape((n, 2)).astype(np.uint64)
+    offset += state.nbytes
+    policy = np.frombuffer(buf, dtype="<f2", count=n * 64, offset=offset).reshape((n, 64)).astype(np.float32)
+    offset += n * 64 * 2
+    z = np.frombuffer(buf, dtype=np.int8, count=n, offset=offset).copy()
+    return state, policy, z
+
+
+def read_game_data_files(paths, process_num=1):
+    """read play data files. JSON files are decoded by a process pool in parallel if process_num > 1.
+
+    Decoded arrays are passed from the pool through a file on shared memory (/dev/shm) instead of pickling.
+    :param list[str] paths:
+    :param int process_num:
+    :return: generator of (path, data). data is (state, policy, z) like read_game_data_from_file(),
+        or the Exception if failed. The order is not the same as paths.
+    """
+    json_paths = [path for path in paths if path.endswith(".json")] if process_num > 1 else []
+    json_path_set = set(json_paths)
+    other_paths = [path for path in paths if path not in json_path_set]
+    if not json_paths:
+        for path in other_paths:
+            yield path, _try_read_game_data_from_file(path)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(process_num, len(json_paths))) as executor:
+        futures = {executor.submit(_decode_to_shared_memory, path): path for path in json_paths}
+        for path in other_paths:  # binary files are fast enough to read while the pool is working
+            yield path, _try_read_game_data_from_file(path)
+        for future in as_completed(futures):
+            try:
+                yield futures[future], _load_from_shared_memory(future.result())
+            except Exception as e:
+                yield futures[future], e
+
+
+def _try_read_game_data_from_file(path):
+    try:
+        return read_game_data_from_file(path)
+    except Exception as e:
+        return e
+
+
+def _decode_to_shared_memory(path):
+    data = read_game_data_from_file(path)
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, tmp_path = tempfile.mkstemp(prefix="reversi_zero_data_", dir=shm_dir)
+    with os.fdopen(fd, "wb") as f:
+        for ary in data:
+            np.save(f, ary)
+    return tmp_path
+
+
+def _load_from_shared_memory(tmp_path):
+    try:
+        with open(tmp_path, "rb") as f:
+            return tuple(np.load(f) for _ in range(3))
+    finally:
+        os.remove(tmp_path)
+
+
+def convert_json_game_data_files(rc: ResourceConfig, remove=True):
+    """convert play data files of the JSON format to the binary format
+
+    :param ResourceConfig rc:
+    :param bool remove: remove JSON files after converted
+    :return: converted file names
+    """
+    converted = []
+    for json_path in get_json_game_data_filenames(rc):
+        path = os.path.splitext(json_path)[0] + os.path.splitext(rc.play_data_filename_tmpl)[1]
+        if path == json_path:
+            continue
+        with open(json_path, "rt") as f:
+            data = json.load(f)
+        write_game_data_to_file(path, data)
+        if remove:
+            os.remove(json_path)
+        logger.info(f"converted {json_path} to {path}")
+        converted.append(path)
+    return converted
@@ -0,0 +1,118 @@
+from logging import getLogger
+
+import numpy as np
+
+from reversi_zero.lib.util import resized_array
+
+logger = getLogger(__name__)
+
+
+class ReplayBuffer:
+    """training samples of loaded files in preallocated arrays. The state is kept as (own, enemy) bitboards.
+
+    Samples of a file are appended at the end, and removed by moving the last samples into the hole,
+    so that `arrays` is always a contiguous view without concatenating the whole dataset.
+    """
+
+    def __init__(self, capacity=65536):
+        """
+
+        :param int capacity: initial number of samples. The buffer grows automatically.
+        """
+        self.capacity = 0
+        self.size = 0
+        self.state = self.policy = self.z = None
+        self.sequence = None  # order of added samples. see `ages()`
+        self.priority = None  # weight of sampling by the loss. 1 if not given
+        self.added_num = 0
+        self._owner = None  # row -> file id
+        self._rows = {}  # key -> rows of the file
+        self._file_ids = {}  # key -> file id
+        self._keys = {}  # file id -> key
+        self._next_file_id = 0
+        self._allocate(max(capacity, 1))
+
+    def _allocate(self, capacity):
+        size = self.size
+        self.state = resized_array(self.state, (capacity, 2), size, np.uint64)
+        self.policy = resized_array(self.policy, (capacity, 64), size, np.float32)
+        self.z = resized_array(self.z, (capacity, ), size, np.float32)
+        self.sequence = resized_array(self.sequence, (capacity, ), size, np.int64)
+        self.priority = resized_array(self.priority, (capacity, ), size, np.float32)
+        self._owner = resized_array(self._owner, (capacity, ), size, np.int64)
+        self.capacity = capacity
+
+    def add(self, key, state, policy, z, priority=None):
+        """append samples of a file. Samples added later are newer.
+
+        :param key: file name
+        :param np.ndarray state: (own, enemy) bitboards. shape=(N, 2)
+        :param np.ndarray policy: shape=(N, 64)
+        :param np.ndarray z: shape=(N, )
+        :param np.ndarray priority: shape=(N, )
+        """
+        if key in self._rows:
+            self.remove(key)
+        n = len(z)
+        if self.size + n > self.capacity:
+            capacity = self.capacity
+            while self.size + n > capacity:
+                capacity *= 2
+            self._allocate(capacity)
+
+        file_id = self._next_file_id
+        self._next_file_id += 1
+        start, end = self.size, self.size + n
+        self.state[start:end] = state
+        self.policy[start:end] = policy
+        self.z[start:end] = z
+        self.sequence[start:end] = np.arange(self.added_num, self.added_num + n)
+        self.priority[start:end] = 1 if priority is None else priority
+        self._owner[start:end] = file_id
+        self.added_num += n
+        self._rows[key] = np.arange(start, end)
+        self._file_ids[key] = file_id
+        self._keys[file_id] = key
+        self.size = end
+
+    def remove(self, key):
+        """remove samples of a file. cost is O(number of the samples)"""
+        rows = self._rows.pop(key)
+        del self._keys[self._file_ids.pop(key)]
+        new_size = self.size - len(rows)
+        holes = rows[rows < new_size]
+        tail = np.setdiff1d(np.arange(new_size, self.size), rows, assume_unique=True)  # len(tail) == len(holes)
+        if len(holes):
+            self.state[holes] = self.state[tail]
+            self.policy[holes] = self.policy[tail]
+            self.z[holes] = self.z[tail]
+            self.sequence[holes] = self.sequence[tail]
+            self.priority[holes] = self.priority[tail]
+            self._owner[holes] = self._owner[tail]
+            moved_to = np.zeros(self.size - new_size, dtype=np.int64)
+            moved_to[tail - new_size] = holes
+            for file_id in np.unique(self._owner[holes]):
+                other_rows = self._rows[self._keys[file_id]]
+                moved = other_rows >= new_size
+                other_rows[moved] = moved_to[other_rows[moved] - new_size]
+        self.size = new_size
+
+    @property
+    def arrays(self):
+        """(state, policy, z) of all samples. They are views, not copies."""
+        return self.state[:self.size], self.policy[:self.size], self.z[:self.size]
+
+    def ages(self):
+        """number of samples added after each sample. shape=(size, )"""
+        return self.added_num - 1 - self.sequence[:self.size]
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.state, self.policy, self.z, self.sequence, self.priority, self._owner])
+
@@ -0,0 +1,139 @@
+"""ring buffer of self-play samples in one memory-mapped file.
+
+Self-play processes append samples, and the trainer reads random samples without loading the whole file.
+
+file format (little endian):
+  header(64 bytes): magic(4 bytes), version(uint16), reserved(uint16), capacity(uint64), appended num(uint64)
+  records: RECORD_DTYPE * capacity. the i-th appended sample is at `i % capacity`.
+"""
+import os
+import struct
+from contextlib import contextmanager
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+REPLAY_STORE_MAGIC = b"RZRS"
+REPLAY_STORE_VERSION = 1
+HEADER_SIZE = 64
+_HEADER = struct.Struct("<4sHHQQ")
+RECORD_DTYPE = np.dtype([("state", "<u8", (2, )), ("policy", "<f2", (64, )), ("z", "i1")])
+
+
+class ReplayStore:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.appended_num = 0
+        self._records = None  # type: np.memmap
+
+    @classmethod
+    def open(cls, path, capacity):
+        """open the store, or create it if not exists.
+
+        :param str path:
+        :param int capacity: max number of samples. ignored if the store exists.
+        :rtype: ReplayStore
+        """
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(REPLAY_STORE_MAGIC, REPLAY_STORE_VERSION, 0, capacity, 0))
+                f.truncate(HEADER_SIZE + RECORD_DTYPE.itemsize * capacity)
+            try:
+                os.link(tmp_path, path)  # fails if another process has created it
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+
+        store = cls(path, capacity)
+        store.refresh()
+        if store.capacity != capacity:
+            logger.info(f"capacity of {path} is {store.capacity}, not {capacity}")
+        return store
+
+    def refresh(self):
+        """read the number of appended samples
+
+        :return: number of newly appended samples since the last refresh
+        """
+        with open(self.path, "rb") as f:
+            magic, version, _, capacity, appended_num = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != REPLAY_STORE_MAGIC or version != REPLAY_STORE_VERSION:
+            raise ValueError(f"{self.path} is not a replay store of version {REPLAY_STORE_VERSION}")
+        new_num = appended_num - self.appended_num
+        self.capacity = capacity
+        self.appended_num = appended_num
+        return new_num
+
+    def append(self, state, policy, z):
+        """append samples. The oldest samples are overwritten when the store is full.
+
+        :param np.ndarray state: (own, enemy) bitboards. shape=(N, 2)
+        :param np.ndarray policy: shape=(N, 64)
+        :param np.ndarray z: shape=(N, )
+        """
+        records = np.zeros(len(z), dtype=RECORD_DTYPE)
+        records["state"] = state
+        records["policy"] = policy
+        records["z"] = z
+        records = records[-self.capacity:]
+        skipped_num = len(z) - len(records)
+
+        with open(self.path, "r+b") as f, _file_lock(f):
+            _, _, _, capacity, appended_num = _HEADER.unpack(f.read(_HEADER.size))
+            pos = (appended_num + skipped_num) % capacity
+            head = records[:capacity - pos]
+            f.seek(HEADER_SIZE + pos * RECORD_DTYPE.itemsize)
+            f.write(head.tobytes())
+            if len(head) < len(records):  # wrap around
+                f.seek(HEADER_SIZE)
+                f.write(records[len(head):].tobytes())
+            f.seek(0)
+            f.write(_HEADER.pack(REPLAY_STORE_MAGIC, REPLAY_STORE_VERSION, 0, capacity, appended_num + len(z)))
+        self.appended_num = appended_num + len(z)
+
+    def read(self, indices):
+        """
+
+        :param np.ndarray indices: 0 <= index < len(self)
+        :return: (state, policy, z). shape=((N, 2), (N, 64), (N, )), dtype=(uint64, float32, float32)
+        """
+        if self._records is None:
+            self._records = np.memmap(self.path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE,
+                                      shape=(self.capacity, ))
+        records = self._records[np.asarray(indices)]
+        return (records["state"].astype(np.uint64), records["policy"].astype(np.float32),
+                records["z"].astype(np.float32))
+
+    def ages(self):
+        """number of samples appended after each sample. shape=(len(self), )"""
+        return (self.appended_num - 1 - np.arange(len(self))) % self.capacity
+
+    def __len__(self):
+        return min(self.appended_num, self.capacity)
+
+
+@contextmanager
+def _file_lock(f):
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -1,11 +1,13 @@
+from collections import namedtuple
 from time import time
 
 from logging import getLogger
 
-from reversi_zero.env.reversi_env import ReversiEnv, Player
-from reversi_zero.lib.bitboard import find_correct_moves
 import numpy as np
 
+from reversi_zero.env.reversi_env import Player
+from reversi_zero.lib.bitboard_backend import find_correct_moves, calc_flip, bit_count
+
 
 logger = getLogger(__name__)
 
@@ -14,86 +16,184 @@ class Timeout(Exception):
     pass
 
 
+MAX_SCORE = 64
+ORDER_BY_MOBILITY_EMPTIES = 7  # order moves by the enemy mobility if empties are more than this
+TIME_CHECK_INTERVAL = 1024  # nodes
+TT_MIN_EMPTIES = 5  # nodes of fewer empties are not stored in the transposition table
+QUADRANTS = [0x000000000F0F0F0F, 0x00000000F0F0F0F0, 0x0F0F0F0F00000000, 0xF0F0F0F000000000]
+CORNERS = 0x8100000000000081
+# zobrist keys per byte of own and enemy bitboards (tabulation hashing)
+_random = np.random.RandomState(20180327).randint(0, 1 << 32, size=(2, 16, 256)).astype(np.uint64)
+ZOBRIST = ((_random[0] << np.uint64(32)) | _random[1]).tolist()
+
+
+class TranspositionTable:
+    """fixed size table of bounds of scores of searched positions.
+
+    An entry is replaced by a deeper search result (more empties) or by a result of a newer `solve()`.
+    """
+    def __init__(self, bits=16):
+        self.mask = (1 << bits) - 1
+        self.entries = [None] * (1 << bits)  # type: list[TTEntry]
+        self.generation = 0
+        self.lookup_count = 0
+        self.hit_count = 0
+
+    def get(self, own, enemy):
+        self.lookup_count += 1
+        entry = self.entries[zobrist_hash(own, enemy) & self.mask]
+        if entry is not None and entry.own == own and entry.enemy == enemy:
+            self.hit_count += 1
+            return entry
+        return None
+
+    def put(self, own, enemy, lower, upper, move, empties):
+        idx = zobrist_hash(own, enemy) & self.mask
+        entry = self.entries[idx]
+        if entry is not None:
+            if entry.own == own and entry.enemy == enemy:
+                lower, upper = max(lower, entry.lower), min(upper, entry.upper)
+            elif entry.empties > empties and entry.generation == self.generation:
+                return
+        self.entries[idx] = TTEntry(own, enemy, lower, upper, move, empties, self.generation)
+
+    @property
+    def hit_rate(self):
+        if self.lookup_count == 0:
+            return 0
+        return self.hit_count / self.lookup_count
+
+
+TTEntry = namedtuple("TTEntry", "own enemy lower upper move empties generation")
+
+
+def zobrist_hash(own, enemy):
+    h = 0
+    for i in range(8):
+        h ^= ZOBRIST[i][(own >> (i * 8)) & 0xFF] ^ ZOBRIST[i + 8][(enemy >> (i * 8)) & 0xFF]
+    return h
+
+
 class ReversiSolver:
     """calculate which is winner. Not estimation by NN!
 
-    this implementation runs very slow. (^^;
+    negamax alpha-beta search, same as the cython version in `reversi_zero.lib.alt`.
+    Moves are searched in the order of fewer enemy mobility (fastest-first) and corners first,
+    and near the end, moves in the quadrants of odd empties first (parity).
+    Bounds of searched positions are kept in the transposition table across `solve()` calls,
+    and shared by exact and win/loss searches.
     """
-    def __init__(self):
-        self.cache = {}
+    def __init__(self, table_bits=16):
+        self.table = TranspositionTable(table_bits)
         self.start_time = None
         self.timeout = None
-        self.last_is_exactly = False
+        self.cancel = None
+        self.node_count = 0
+
+    def solve(self, black, white, next_player, timeout=30, exactly=False, cancel=None):
+        """
 
-    def solve(self, black, white, next_player, timeout=30, exactly=False):
+        :param int black:
+        :param int white:
+        :param Player next_player:
+        :param timeout:
+        :param exactly: if False, the score is only correct in the sign (win, draw or loss)
+        :param threading.Event cancel: stop solving as timeout when this is set (from another thread)
+        :return: (move, score of next_player), or (None, None) if timeout, cancelled or no legal moves
+        """
+        if cancel is not None and cancel.is_set():
+            return None, None
         self.timeout = timeout
+        self.cancel = cancel
         self.start_time = time()
-        if not self.last_is_exactly and exactly:
-            self.cache = {}
-        self.last_is_exactly = exactly
-        
+        self.table.generation += 1
+        own, enemy = (black, white) if next_player == Player.black else (white, black)
+        if find_correct_moves(own, enemy) == 0:
+            return None, None
+
         try:
-            # logger.debug("start resolving")
-            move, score = self.find_winning_move_and_score(ReversiEnv().update(black, white, next_player),
-                                                           exactly=exactly)
-            if next_player == Player.white:
-                score = -score
-            # logger.debug(f"solve answer=({move},{score})({time()-self.start_time:.3f} seconds)")
-            return move, score
+            window = (-MAX_SCORE, MAX_SCORE) if exactly else (-1, 1)
+            return self.search(own, enemy, *window, passed=False, is_root=True)
         except Timeout:
             return None, None
 
-    def find_winning_move_and_score(self, env: ReversiEnv, exactly=True):
-        if env.done:
-            b, w = env.board.number_of_black_and_white
-            return None, b - w
-        if time() - self.start_time > self.timeout:
-            logger.debug("timeout!")
-            raise Timeout()
-
-        turn = env.turn
-        key = black, white, next_player = env.board.black, env.board.white, env.next_player
-        if key in self.cache:
-            return self.cache[key]
-
-        if next_player == Player.black:
-            legal_moves = find_correct_moves(black, white)
-        else:
-            legal_moves = find_correct_moves(white, black)
-
-        action_list = [idx for idx in range(64) if legal_moves & (1 << idx)]
-        score_list = np.zeros(len(action_list), dtype=int)
-        for i, action in enumerate(action_list):
-            # env.update(black, white, next_player)
-            env.board.black = black
-            env.board.white = white
-            env.next_player = next_player
-            env.turn = turn
-            env.done = False
-            env.winner = None
-            #
-            env.step(action)
-            _, score = self.find_winning_move_and_score(env, exactly=exactly)
-            score_list[i] = score
-
-            if not exactly:
-                # do not need to find the best score move
-                if next_player == Player.black and score > 0:
-                    break
-                elif next_player == Player.white and score < 0:
+    def search(self, own, enemy, alpha, beta, passed, is_root=False):
+        """
+
+        :return: (best move, score for the player to move). The score is a bound if it is not in (alpha, beta).
+        """
+        self.node_count += 1
+        if self.node_count % TIME_CHECK_INTERVAL == 0:
+            if time() - self.start_time > self.timeout or (self.cancel is not None and self.cancel.is_set()):
+                logger.debug("timeout!")
+                raise Timeout()
+
+        legal_moves = find_correct_moves(own, enemy)
+        if legal_moves == 0:
+            if passed or find_correct_moves(enemy, own) == 0:
+                return None, bit_count(own) - bit_count(enemy)
+            return None, -self.search(enemy, own, -beta, -alpha, passed=True)[1]
+
+        empties = 64 - bit_count(own | enemy)
+        use_table = empties >= TT_MIN_EMPTIES
+        entry = self.table.get(own, enemy) if use_table else None
+        if entry is not None and not is_root:  # the root needs the best move
+            if entry.lower >= beta or entry.lower == entry.upper:
+                return entry.move, entry.lower
+            if entry.upper <= alpha:
+                return entry.move, entry.upper
+            alpha, beta = max(alpha, entry.lower), min(beta, entry.upper)
+        searched_alpha, searched_beta = alpha, beta
+
+        best_move, best = None, -MAX_SCORE - 1
+        first_move = entry.move if entry is not None else None
+        for i, move in enumerate(order_moves(own, enemy, legal_moves, first_move)):
+            flipped = calc_flip(move, own, enemy)
+            next_own, next_enemy = enemy ^ flipped, own ^ flipped | (1 << move)
+            if i == 0 or beta - alpha == 1:
+                v = -self.search(next_own, next_enemy, -beta, -alpha, passed=False)[1]
+            else:  # principal variation search: prove that the move is worse by a null window
+                v = -self.search(next_own, next_enemy, -alpha - 1, -alpha, passed=False)[1]
+                if alpha < v < beta:
+                    v = -self.search(next_own, next_enemy, -beta, -v, passed=False)[1]
+            if v > best:
+                best_move, best = move, v
+                alpha = max(alpha, v)
+                if alpha >= beta:
                     break
+        if use_table:
+            lower = best if best > searched_alpha else -MAX_SCORE
+            upper = best if best < searched_beta else MAX_SCORE
+            self.table.put(own, enemy, lower, upper, best_move, empties)
+        return best_move, best
 
-        # print(list(zip(action_list, score_list)))
 
-        if next_player == Player.black:
-            best_action = action_list[int(np.argmax(score_list))]
-            best_score = np.max(score_list)
-        else:
-            best_action = action_list[int(np.argmin(score_list))]
-            best_score = np.min(score_list)
+def order_moves(own, enemy, legal_moves, first_move=None):
+    """legal moves in the search order. first_move is searched first if it is legal."""
+    empties = ~(own | enemy) & 0xFFFFFFFFFFFFFFFF
+    odd_quadrants = 0
+    for q in QUADRANTS:
+        if bit_count(empties & q) % 2 == 1:
+            odd_quadrants |= q
+    by_mobility = bit_count(empties) > ORDER_BY_MOBILITY_EMPTIES
 
-        self.cache[key] = (best_action, best_score)
-        return best_action, best_score
+    scored = []
+    for move in range(64):
+        bit = 1 << move
+        if not legal_moves & bit:
+            continue
+        score = 0
+        if move == first_move:
+            score = -1000
+        elif by_mobility:
+            flipped = calc_flip(move, own, enemy)
+            score = bit_count(find_correct_moves(enemy ^ flipped, own ^ flipped | bit)) * 4
+            if CORNERS & bit:
+                score -= 8
+        if not odd_quadrants & bit:
+            score += 1
+        scored.append((score, move))
+    return [move for _, move in sorted(scored)]
 
 
 if __name__ == '__main__':
@@ -115,7 +215,7 @@ if __name__ == '__main__':
         rr = ReversiSolver()
         print("correct is (57, +2)")
         print(rr.solve(b, w, Player.white, exactly=False))
-        print(len(rr.cache))
+        print(rr.table.hit_rate)
 
     def q2():
         board = '''
@@ -133,7 +233,7 @@ if __name__ == '__main__':
         rr = ReversiSolver()
         print("correct is (4 or 14, -2)")
         print(rr.solve(b, w, Player.black, exactly=False))
-        print(len(rr.cache))
+        print(rr.table.hit_rate)
 
     def q3():  # O: black, X: white
         board = '''
@@ -151,7 +251,7 @@ if __name__ == '__main__':
         rr = ReversiSolver()
         print("correct is (3, +2)")
         print(rr.solve(b, w, Player.white, exactly=True))
-        print(len(rr.cache))
+        print(rr.table.hit_rate)
 
     q3()
 
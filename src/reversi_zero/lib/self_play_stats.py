@@ -0,0 +1,99 @@
+"""throughput stats of self-play.
+
+Each self-play worker publishes its cumulative counters (WORKER_COUNTERS),
+and SelfPlayStatsWriter converts the increase of the counters of all workers and the API server
+to rates per interval, then logs them to TensorBoard and appends them to a JSON lines file.
+"""
+import json
+from collections import Counter
+from logging import getLogger
+from time import time
+
+logger = getLogger(__name__)
+
+WORKER_COUNTERS = [
+    "games", "moves", "move_sec",  # time per move
+    "simulations",  # MCTS simulations
+    "evals", "api_sec",  # states sent to the model API and time of the calls including IPC
+    "symmetry_saved_evals",  # evaluations not needed because a symmetric position is already evaluated
+    "prediction_wait_sec", "prediction_wait_count",  # time of simulations waiting for predictions
+    "solver_sec", "solver_count",
+    "solver_cache_lookups", "solver_cache_hits",  # the solver result cache shared by workers
+    "mcts_lookups", "mcts_hits",
+]
+SERVER_COUNTERS = [
+    "requests", "predicted_states", "model_sec",  # model_sec: time of the model predictions
+    "eval_cache_lookups", "eval_cache_hits",
+]
+
+
+class SelfPlayStatsWriter:
+    def __init__(self, stats_path, interval_sec, tensor_board=None, server=None):
+        """
+
+        :param str stats_path: JSON lines file. one line is appended per interval.
+        :param float interval_sec:
+        :param reversi_zero.lib.tensorboard_logger.TensorBoardLogger tensor_board:
+        :param reversi_zero.agent.api.MultiProcessReversiModelAPIServer server:
+        """
+        self.stats_path = stats_path
+        self.interval_sec = interval_sec
+        self.tensor_board = tensor_board
+        self.server = server
+        self.last_time = time()
+        self.last_totals = Counter()
+        self.step = 0
+
+    def write_if_due(self, worker_counters):
+        if time() - self.last_time >= self.interval_sec:
+            return self.write(worker_counters)
+
+    def write(self, worker_counters):
+        """
+
+        :param dict worker_counters: worker index -> cumulative counters of the worker
+        :return: dict of the stats
+        """
+        now = time()
+        totals = Counter()
+        for counters in worker_counters.values():
+            totals.update(counters)
+        if self.server is not None:
+            totals.update(self.server.stats_counters())
+        d = Counter(totals)
+        d.subtract(self.last_totals)
+        elapsed = max(now - self.last_time, 1e-6)
+        worker_num = max(len(worker_counters), 1)
+        self.last_time, self.last_totals = now, totals
+
+        stats = dict(
+            games_per_hour=d["games"] / elapsed * 3600,
+            simulations_per_sec=d["simulations"] / elapsed,
+            evals_per_sec=d["evals"] / elapsed,
+            symmetry_saved_eval_rate=_ratio(d["symmetry_saved_evals"], d["evals"] + d["symmetry_saved_evals"]),
+            sec_per_move=_ratio(d["move_sec"], d["moves"]),
+            prediction_wait_sec=_ratio(d["prediction_wait_sec"], d["prediction_wait_count"]),
+            api_time_rate=d["api_sec"] / elapsed / worker_num,  # rate of time of workers in model API calls
+            solver_time_rate=d["solver_sec"] / elapsed / worker_num,
+            solver_sec=_ratio(d["solver_sec"], d["solver_count"]),
+            mcts_hit_rate=_ratio(d["mcts_hits"], d["mcts_lookups"]),
+            solver_cache_hit_rate=_ratio(d["solver_cache_hits"], d["solver_cache_lookups"]),
+        )
+        if self.server is not None:
+            stats.update(
+                server_batch_size=_ratio(d["predicted_states"], d["requests"]),
+                server_model_time_rate=d["model_sec"] / elapsed,
+                eval_cache_hit_rate=_ratio(d["eval_cache_hits"], d["eval_cache_lookups"]),
+            )
+
+        self.step += 1
+        if self.tensor_board is not None:
+            self.tensor_board.log_scaler({f"throughput/{k}": v for k, v in stats.items()}, self.step)
+        with open(self.stats_path, "at") as f:
+            f.write(json.dumps(dict(time=now, worker_num=len(worker_counters), **stats)) + "\n")
+        logger.debug(f"self-play stats: {stats}")
+        return stats
+
+
+def _ratio(x, y):
+    return x / y if y else 0
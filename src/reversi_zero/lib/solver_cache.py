@@ -0,0 +1,112 @@
+"""results of the endgame solver shared by self-play processes.
+
+The table is a fixed size array of entries in a file-backed shared memory, indexed by the hash of the position.
+Entries are written without locks: the key is stored xor-ed with the data, so that an entry torn by
+concurrent writes does not match any key and is just a cache miss.
+"""
+import atexit
+import mmap
+import os
+import tempfile
+from logging import getLogger
+
+import numpy as np
+
+from reversi_zero.env.reversi_env import Player
+from reversi_zero.lib.reversi_solver import zobrist_hash
+
+logger = getLogger(__name__)
+
+ENTRY_DTYPE = np.dtype([("own", "<u8"), ("enemy", "<u8"), ("data", "<u8")])
+_EXACT_FLAG = 1 << 16
+
+
+class SharedSolverCache:
+    """(move, score) of solved positions, keyed by (own, enemy) of the player to move.
+
+    Only the file path is pickled, so that the cache can be passed to other processes.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lookup_count = 0
+        self.hit_count = 0
+        self._mmap = None
+        self._entries = None  # type: np.ndarray
+
+    @classmethod
+    def create(cls, size):
+        """
+
+        :param int size: number of entries (24 bytes each)
+        :rtype: SharedSolverCache
+        """
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="reversi_zero_solver_", dir=shm_dir)
+        os.ftruncate(fd, size * ENTRY_DTYPE.itemsize)
+        os.close(fd)
+        atexit.register(_remove_file, path)
+        return cls(path, size)
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            with open(self.path, "r+b") as f:
+                self._mmap = mmap.mmap(f.fileno(), self.size * ENTRY_DTYPE.itemsize)
+            self._entries = np.frombuffer(self._mmap, dtype=ENTRY_DTYPE)
+        return self._entries
+
+    def get(self, black, white, next_player, exactly):
+        """
+
+        :param int black:
+        :param int white:
+        :param Player next_player:
+        :param bool exactly: if True, results of win/loss searches are not returned
+        :return: (move, score of next_player), or None if not cached
+        """
+        own, enemy = (black, white) if next_player == Player.black else (white, black)
+        self.lookup_count += 1
+        data = self._read(own, enemy)
+        if not data or (exactly and not data & _EXACT_FLAG):
+            return None
+        self.hit_count += 1
+        return data & 0xFF, ((data >> 8) & 0xFF) - 128
+
+    def put(self, black, white, next_player, exactly, move, score):
+        """
+
+        :param bool exactly: the score is exact, not only correct in the sign
+        """
+        own, enemy = (black, white) if next_player == Player.black else (white, black)
+        if not exactly and self._read(own, enemy) & _EXACT_FLAG:
+            return  # keep the exact result
+        data = move | ((int(score) + 128) << 8) | (_EXACT_FLAG if exactly else 0)
+        self.entries[zobrist_hash(own, enemy) % self.size] = (own ^ data, enemy ^ data, data)
+
+    def _read(self, own, enemy):
+        """data of the entry of the position, or 0 if not exists"""
+        entry = self.entries[zobrist_hash(own, enemy) % self.size]
+        data = int(entry["data"])
+        if int(entry["own"]) ^ data != own or int(entry["enemy"]) ^ data != enemy:
+            return 0
+        return data
+
+    @property
+    def hit_rate(self):
+        if self.lookup_count == 0:
+            return 0
+        return self.hit_count / self.lookup_count
+
+    def __getstate__(self):
+        return dict(path=self.path, size=self.size)
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["size"])
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
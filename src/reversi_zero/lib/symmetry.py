@@ -0,0 +1,64 @@
+"""8 symmetries (dihedral group) of the board.
+
+transform id `t` = flip * 4 + rot_right: flip vertical if flip, then rotate right `rot_right` times.
+t=0 is identity.
+"""
+import numpy as np
+
+from reversi_zero.lib.bitboard_backend import flip_vertical, rotate90
+
+
+def transform_bitboard(x, t):
+    if t >= 4:
+        x = flip_vertical(x)
+    for _ in range(t % 4):
+        x = rotate90(x)
+    return x
+
+
+def _action_permutations():
+    ret = np.zeros((8, 64), dtype=np.int64)
+    for t in range(8):
+        for action in range(64):
+            ret[t, action] = (transform_bitboard(1 << action, t)).bit_length() - 1
+    return ret
+
+
+# ACTION_PERMUTATIONS[t][action] = action after transform t
+ACTION_PERMUTATIONS = _action_permutations()
+# INVERSE_ACTION_PERMUTATIONS[t][action] = action before transform t
+INVERSE_ACTION_PERMUTATIONS = np.argsort(ACTION_PERMUTATIONS, axis=1)
+
+
+def transform_arrays(x, t):
+    """transform board arrays of samples by each transform id
+
+    :param np.ndarray x: shape=(N, ..., 64)
+    :param np.ndarray t: transform ids. shape=(N, )
+    :return: transformed copy of x
+    """
+    n = x.shape[0]
+    y = x.reshape((n, -1, 64))
+    y = y[np.arange(n)[:, None, None], np.arange(y.shape[1])[None, :, None], INVERSE_ACTION_PERMUTATIONS[t][:, None, :]]
+    return y.reshape(x.shape)
+
+
+def canonicalize(black, white):
+    """return the minimum (black, white) of the 8 transformed pairs and its transform id
+
+    :param int black: bitboard
+    :param int white: bitboard
+    :return: (black, white, t)
+    """
+    best = (black, white)
+    best_t = 0
+    b, w = black, white
+    for t in range(1, 8):
+        if t == 4:
+            b, w = flip_vertical(black), flip_vertical(white)
+        else:
+            b, w = rotate90(b), rotate90(w)
+        if (b, w) < best:
+            best = (b, w)
+            best_t = t
+    return best[0], best[1], best_t
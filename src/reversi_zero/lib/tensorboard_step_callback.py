@@ -29,5 +29,15 @@ class TensorBoardStepCallback(Callback):
             self.writer.add_summary(summary, self.step)
         self.writer.flush()
 
+    def log_scaler(self, info: dict):
+        """log values at the current step
+
+        :param dict info: dict of {<tag>: <value>}
+        """
+        for tag, value in info.items():
+            summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
+            self.writer.add_summary(summary, self.step)
+        self.writer.flush()
+
     def close(self):
         self.writer.close()
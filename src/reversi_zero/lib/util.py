@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def parse_to_bitboards(string: str):
     lines = string.strip().split("\n")
     black = 0
@@ -25,3 +28,11 @@ def parse_ggf_board_to_bitboard(string: str):
         elif ch == "O":
             white |= 1 << i
     return black, white
+
+
+def resized_array(ary, shape, size, dtype):
+    """new zero array of `shape`, with the first `size` rows copied from `ary` (which may be None)"""
+    ret = np.zeros(shape, dtype=dtype)
+    if ary is not None and size:
+        ret[:size] = ary[:size]
+    return ret
@@ -10,7 +10,7 @@ from .config import Config
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'play_gui', 'nboard']
+CMD_LIST = ['self', 'opt', 'eval', 'play_gui', 'nboard', 'convert_play_data']
 
 
 def create_parser():
@@ -63,3 +63,7 @@ def start():
     elif args.cmd == 'nboard':
         from .play_game import nboard
         return nboard.start(config)
+    elif args.cmd == 'convert_play_data':
+        from .lib.data_helper import convert_json_game_data_files
+        converted = convert_json_game_data_files(config.resource)
+        logger.info(f"converted {len(converted)} files")
@@ -5,7 +5,7 @@ from reversi_zero.agent.player import HistoryItem
 from reversi_zero.agent.player import ReversiPlayer
 from reversi_zero.config import Config
 from reversi_zero.env.reversi_env import Player, ReversiEnv
-from reversi_zero.lib.bitboard import find_correct_moves
+from reversi_zero.lib.bitboard_backend import find_correct_moves
 from reversi_zero.lib.model_helpler import load_best_model_weight, reload_newest_next_generation_model_if_changed
 from reversi_zero.play_game.common import load_model
 
@@ -35,6 +35,8 @@ class PlayWithHuman:
     def start_game(self, human_is_black):
         self.human_color = Player.black if human_is_black else Player.white
         self.env = ReversiEnv().reset()
+        if self.ai is not None:
+            self.ai.close()
         self.ai = ReversiPlayer(self.config, self.model)
 
     def play_next_turn(self):
@@ -5,7 +5,7 @@ from collections import namedtuple
 from logging import getLogger, StreamHandler, FileHandler
 from time import time
 
-from reversi_zero.agent.player import ReversiPlayer, CallbackInMCTS
+from reversi_zero.agent.player import ReversiPlayer, CallbackInMCTS, SolverResult
 from reversi_zero.config import Config, PlayWithHumanConfig
 from reversi_zero.env.reversi_env import ReversiEnv, Player
 from reversi_zero.lib.ggf import parse_ggf, convert_to_bitboard_and_actions, convert_move_to_action, \
@@ -31,6 +31,13 @@ def start(config: Config):
     logger.info("finish nboard")
 
 
+def solver_evaluation(result: SolverResult):
+    """disc difference of the exact result, or -1, 0, 1 of the win/loss/draw result"""
+    if result.exact:
+        return result.score
+    return (result.score > 0) - (result.score < 0)
+
+
 class NBoardEngine:
     def __init__(self, config: Config):
         self.config = config
@@ -42,6 +49,9 @@ class NBoardEngine:
         self.env = ReversiEnv().reset()
         self.model = load_model(self.config)
         self.play_config = self.config.play
+        if self.play_config.use_solver_turn:  # keep the solver disabled if so configured
+            self.play_config.use_solver_turn = self.nc.use_solver_turn
+        self.play_config.solver_sec_per_move = self.nc.solver_sec_per_move
         self.player = self.create_player()
         self.turn_of_nboard = None
 
@@ -91,6 +101,7 @@ class NBoardEngine:
             pass
 
     def reset_state(self):
+        self.player.close()
         self.player = self.create_player()
 
     def set_game(self, game_state: GameState):
@@ -121,9 +132,18 @@ class NBoardEngine:
         else:
             states = (board.white, board.black)
         start_time = time()
-        action = self.player.action(*states)
-        item = self.player.ask_thought_about(*states)
-        evaluation = item.values[action]
+        solved = []  # type: list[SolverResult]
+
+        def solver_callback(result):
+            solved.append(result)
+            self.handler.report_solved(result)
+
+        action = self.player.action(*states, solver_callback=solver_callback)
+        if solved:
+            evaluation = solver_evaluation(solved[-1])
+        else:
+            item = self.player.ask_thought_about(*states)
+            evaluation = item.values[action] * 10
         time_took = time() - start_time
         return GoResponse(action, evaluation, time_took)
 
@@ -146,7 +166,12 @@ class NBoardEngine:
             self.handler.report_hint(hint_list)
 
         callback_info = CallbackInMCTS(self.config.nboard.hint_callback_per_sim, hint_report_callback)
-        self.player.action(*states, callback_in_mtcs=callback_info)
+        solved = []  # type: list[SolverResult]
+        self.player.action(*states, callback_in_mtcs=callback_info, solver_callback=solved.append)
+        if solved:  # the solver result is the last report, because NBoard shows the last one as the best
+            for result in solved:
+                self.handler.report_solved(result)
+            return
         item = self.player.ask_thought_about(*states)
         hint_report_callback(item.values, item.visit)
 
@@ -267,6 +292,12 @@ class NBoardProtocolVersion2:
             move = convert_action_to_move(hint.action)
             self.engine.reply(f"search {move} {hint.value} 0 {int(hint.visit)}")
 
+    def report_solved(self, result: SolverResult):
+        """report the result of the endgame solver with the depth code "100%W" (win/loss/draw) or "100%" (exact)"""
+        move = convert_action_to_move(result.action)
+        depth = "100%" if result.exact else "100%W"
+        self.engine.reply(f"search {move} {solver_evaluation(result)} 0 {depth}")
+
     def go(self):
         """Tell the engine to decide what move it would play.
 
@@ -291,7 +322,7 @@ class NBoardProtocolVersion2:
         self.tell_status("thinking...")
         gr = self.engine.go()
         move = convert_action_to_move(gr.action)
-        self.engine.reply(f"=== {move}/{gr.eval * 10}/{gr.time}")
+        self.engine.reply(f"=== {move}/{gr.eval}/{gr.time}")
         self.tell_status("waiting")
 
     def ping(self, n):
@@ -81,6 +81,8 @@ class EvaluateWorker:
             else:
                 action = white.action(observation.white, observation.black)
             observation, info = env.step(action)
+        best_player.close()
+        ng_player.close()
 
         ng_win = None
         if env.winner == Winner.black:
@@ -13,10 +13,13 @@ from reversi_zero.agent.model import ReversiModel, objective_function_for_policy
     objective_function_for_value
 from reversi_zero.config import Config
 from reversi_zero.lib import tf_util
-from reversi_zero.lib.bitboard import bit_to_array
-from reversi_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, \
+from reversi_zero.lib.bitboard import bits_to_arrays
+from reversi_zero.lib.data_helper import get_game_data_filenames, read_game_data_files, \
     get_next_generation_model_dirs
 from reversi_zero.lib.model_helpler import load_best_model_weight
+from reversi_zero.lib.replay_buffer import ReplayBuffer
+from reversi_zero.lib.replay_store import ReplayStore
+from reversi_zero.lib.symmetry import transform_arrays
 from reversi_zero.lib.tensorboard_step_callback import TensorBoardStepCallback
 
 logger = getLogger(__name__)
@@ -32,20 +35,30 @@ class OptimizeWorker:
         self.config = config
         self.model = None  # type: ReversiModel
         self.loaded_filenames = set()
-        self.loaded_data = {}
+        self.replay_buffer = ReplayBuffer()
         self.training_count_of_files = Counter()
         self.dataset = None
+        self.replay_store = None  # type: ReplayStore
         self.optimizer = None
 
     def start(self):
+        if self.config.play_data.use_replay_store and self.config.trainer.loss_priority_alpha:
+            raise ValueError("loss_priority_alpha is not supported with use_replay_store")
         self.model = self.load_model()
         self.training()
 
+    @property
+    def weighted_sampling(self):
+        tc = self.config.trainer
+        return bool(tc.recency_half_life or tc.loss_priority_alpha)
+
     def training(self):
         self.compile_model()
         total_steps = self.config.trainer.start_total_steps
+        # weighted sampling keeps up with self-play data without sleeping
+        wait_ratio = 0 if self.weighted_sampling else self.config.trainer.wait_after_save_model_ratio
         save_model_callback = PerStepCallback(self.config.trainer.save_model_steps, self.save_current_model,
-                                              self.config.trainer.wait_after_save_model_ratio)
+                                              wait_ratio)
         callbacks = [save_model_callback]  # type: list[Callback]
         tb_callback = None  # type: TensorBoardStepCallback
 
@@ -58,7 +71,13 @@ class OptimizeWorker:
             callbacks.append(tb_callback)
 
         while True:
+            start_time = time()
             self.load_play_data()
+            refresh_sec = time() - start_time
+            logger.debug(f"refresh dataset: {refresh_sec:.3f} sec, dataset_size={self.dataset_size}")
+            if tb_callback:
+                tb_callback.log_scaler({"trainer/dataset_refresh_sec": refresh_sec,
+                                        "trainer/dataset_size": self.dataset_size})
             if self.dataset_size < self.config.trainer.min_data_size_to_learn:
                 logger.info(f"dataset_size={self.dataset_size} is less than {self.config.trainer.min_data_size_to_learn}")
                 sleep(10)
@@ -71,14 +90,118 @@ class OptimizeWorker:
             tb_callback.close()
 
     def train_epoch(self, epochs, callbacks):
+        """train by batches which are prepared on a background thread of fit_generator"""
         tc = self.config.trainer
+        if self.replay_store is not None:
+            store = self.replay_store
+            batches = self._generate_batches(len(store),
+                                             lambda idx: store.read(np.sort(idx)),  # sorted for file locality
+                                             weights=self.sample_weights(store.ages()))
+        else:
+            buffer = self.replay_buffer
+            state_ary, policy_ary, z_ary = self.dataset
+            trained_indices = []
+
+            def read_samples(idx):
+                trained_indices.append(idx)
+                return state_ary[idx], policy_ary[idx], z_ary[idx]
+
+            weights = self.sample_weights(buffer.ages(), buffer.priority[:len(buffer)])
+            batches = self._generate_batches(len(buffer), read_samples, weights=weights)
+
+        sample_num = self.dataset_size * (8 if tc.symmetry_augmentation == "all" else 1)
+        steps_per_epoch = max(sample_num // tc.batch_size, 1)
+        self.model.model.fit_generator(batches,
+                                       steps_per_epoch=steps_per_epoch,
+                                       callbacks=callbacks,
+                                       epochs=epochs,
+                                       max_queue_size=tc.prefetch_batch_num,
+                                       workers=1)
+        trained_steps = steps_per_epoch * epochs
+        if self.replay_store is None and tc.loss_priority_alpha and trained_indices:
+            # batches are read in order by one worker, and ones after trained_steps are only prefetched
+            self.update_priority(np.unique(np.concatenate(trained_indices[:trained_steps])))
+        return trained_steps
+
+    def generate_batches(self, bitboard_ary, policy_ary, z_ary, weights=None):
+        """yield shuffled batches whose samples are transformed by symmetry_augmentation
+
+        :param bitboard_ary: (own, enemy) bitboards. shape=(N, 2)
+        :param policy_ary: shape=(N, 64)
+        :param z_ary: shape=(N, )
+        :param weights: sampling probability of each sample. None means uniform without replacement per epoch.
+        """
+        return self._generate_batches(bitboard_ary.shape[0],
+                                      lambda idx: (bitboard_ary[idx], policy_ary[idx], z_ary[idx]),
+                                      weights=weights)
+
+    def _generate_batches(self, sample_num, read_samples, weights=None):
+        """
+
+        :param int sample_num:
+        :param read_samples: function(indices) returns (bitboards, policy, z)
+        :param weights: sampling probability of each sample, or None
+        """
+        tc = self.config.trainer
+        all_symmetries = tc.symmetry_augmentation == "all"
+        n = max(tc.batch_size // 8, 1) if all_symmetries else tc.batch_size
+        if sample_num == 0:
+            raise ValueError("no samples to generate batches")
+        while True:
+            if weights is None and sample_num >= n:
+                indices = np.random.permutation(sample_num)
+            else:  # with replacement. samples fewer than a batch are repeated
+                indices = np.random.choice(sample_num, size=max(sample_num, n), p=weights)
+            for start in range(0, len(indices) - n + 1, n):
+                data = read_samples(indices[start:start+n])
+                if all_symmetries:
+                    data = [np.repeat(a, 8, axis=0) for a in data]
+                state_ary, policy_ary, z_ary = self.convert_to_training_data(data)
+                if all_symmetries:
+                    t = np.tile(np.arange(8), n)
+                elif tc.symmetry_augmentation:
+                    t = np.random.randint(8, size=n)
+                else:
+                    yield state_ary, [policy_ary, z_ary]
+                    continue
+                yield transform_arrays(state_ary, t), [transform_arrays(policy_ary, t), z_ary]
+
+    def sample_weights(self, ages, priority=None):
+        """sampling probability by recency_half_life and loss_priority_alpha
+
+        :param np.ndarray ages: number of samples newer than each sample
+        :param np.ndarray priority: loss of each sample
+        :return: probability of each sample, or None for uniform sampling
+        """
+        tc = self.config.trainer
+        use_priority = tc.loss_priority_alpha and priority is not None
+        if not tc.recency_half_life and not use_priority:
+            return None
+        weights = np.ones(len(ages))
+        if tc.recency_half_life:
+            weights *= 0.5 ** (ages / tc.recency_half_life)
+        if use_priority:
+            weights *= (priority + 1e-3) ** tc.loss_priority_alpha
+        return weights / np.sum(weights)
+
+    def update_priority(self, indices):
+        """refresh the loss priority of the trained samples by the current model
+
+        :param np.ndarray indices: rows of the replay buffer
+        """
         state_ary, policy_ary, z_ary = self.dataset
-        self.model.model.fit(state_ary, [policy_ary, z_ary],
-                             batch_size=tc.batch_size,
-                             callbacks=callbacks,
-                             epochs=epochs)
-        steps = (state_ary.shape[0] // tc.batch_size) * epochs
-        return steps
+        self.replay_buffer.priority[indices] = self.calc_sample_loss(
+            (state_ary[indices], policy_ary[indices], z_ary[indices]))
+
+    def calc_sample_loss(self, data):
+        """loss of each sample by the current model
+
+        :param data: (state, policy, z) of bitboards
+        :return: shape=(N, )
+        """
+        state_ary, policy_ary, z_ary = self.convert_to_training_data(data)
+        policy, value = self.model.model.predict(state_ary, batch_size=self.config.trainer.batch_size)
+        return -np.sum(policy_ary * np.log(policy + 1e-7), axis=1) + (z_ary - value[:, 0]) ** 2
 
     def compile_model(self):
         self.optimizer = SGD(lr=1e-2, momentum=0.9)
@@ -123,23 +246,10 @@ class OptimizeWorker:
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
         self.model.save(config_path, weight_path)
 
-    def collect_all_loaded_data(self):
-        state_ary_list, policy_ary_list, z_ary_list = [], [], []
-        for s_ary, p_ary, z_ary_ in self.loaded_data.values():
-            state_ary_list.append(s_ary)
-            policy_ary_list.append(p_ary)
-            z_ary_list.append(z_ary_)
-
-        if state_ary_list:
-            state_ary = np.concatenate(state_ary_list)
-            policy_ary = np.concatenate(policy_ary_list)
-            z_ary = np.concatenate(z_ary_list)
-            return state_ary, policy_ary, z_ary
-        else:
-            return None
-
     @property
     def dataset_size(self):
+        if self.replay_store is not None:
+            return len(self.replay_store)
         if self.dataset is None:
             return 0
         return len(self.dataset[0])
@@ -163,12 +273,26 @@ class OptimizeWorker:
         return model
 
     def load_play_data(self):
+        pd = self.config.play_data
+        if pd.use_replay_store:
+            if self.replay_store is None:
+                self.replay_store = ReplayStore.open(self.config.resource.replay_store_path, pd.replay_store_capacity)
+            new_num = self.replay_store.refresh()
+            logger.debug(f"{new_num} new samples in the replay store: total {len(self.replay_store)}")
+            return
+
         filenames = get_game_data_filenames(self.config.resource)
         updated = False
-        for filename in filenames:
-            if filename in self.loaded_filenames:
-                continue
-            self.load_data_from_file(filename)
+        new_filenames = [filename for filename in filenames if filename not in self.loaded_filenames]
+        if new_filenames:
+            start_time = time()
+            process_num = self.config.trainer.load_data_process_num
+            loaded = dict(read_game_data_files(new_filenames, process_num=process_num))
+            for filename in new_filenames:  # add in the order of file names, which is the order of creation
+                self.load_data_from_file(filename, loaded.pop(filename))
+            time_spent = time() - start_time
+            logger.info(f"loaded {len(new_filenames)} files in {time_spent:.2f} sec "
+                        f"({len(new_filenames) / max(time_spent, 1e-6):.1f} files/sec, {process_num} processes)")
             updated = True
 
         for filename in (self.loaded_filenames - set(filenames)):
@@ -177,13 +301,22 @@ class OptimizeWorker:
 
         if updated:
             logger.debug("updating training dataset")
-            self.dataset = self.collect_all_loaded_data()
+            self.dataset = self.replay_buffer.arrays if len(self.replay_buffer) else None
 
-    def load_data_from_file(self, filename):
+    def load_data_from_file(self, filename, data):
+        """
+
+        :param str filename:
+        :param data: (state, policy, z) read from the file, or the Exception raised by reading it
+        """
         try:
             logger.debug(f"loading data from {filename}")
-            data = read_game_data_from_file(filename)
-            self.loaded_data[filename] = self.convert_to_training_data(data)
+            if isinstance(data, Exception):
+                raise data
+            priority = None
+            if self.config.trainer.loss_priority_alpha and self.model is not None:
+                priority = self.calc_sample_loss(data)
+            self.replay_buffer.add(filename, *data, priority=priority)
             self.loaded_filenames.add(filename)
         except Exception as e:
             logger.warning(str(e))
@@ -191,14 +324,14 @@ class OptimizeWorker:
     def unload_data_of_file(self, filename):
         logger.debug(f"removing data about {filename} from training set")
         self.loaded_filenames.remove(filename)
-        if filename in self.loaded_data:
-            del self.loaded_data[filename]
+        if filename in self.replay_buffer:
+            self.replay_buffer.remove(filename)
         if filename in self.training_count_of_files:
             del self.training_count_of_files[filename]
 
     def count_up_training_count_and_delete_self_play_data_files(self):
         limit = self.config.trainer.delete_self_play_after_number_of_training
-        if not limit:
+        if not limit or self.weighted_sampling:  # old samples are sampled less instead
             return
 
         for filename in self.loaded_filenames:
@@ -213,22 +346,15 @@ class OptimizeWorker:
 
     @staticmethod
     def convert_to_training_data(data):
-        """
+        """unpack bitboards to the input planes of the model
 
-        :param data: format is SelfPlayWorker.buffer
-            list of [(own: bitboard, enemy: bitboard), [policy: float 64 items], z: number]
-        :return:
+        :param data: (state, policy, z) returned by read_game_data_from_file()
+            state: (own: bitboard, enemy: bitboard) shape=(N, 2), policy: shape=(N, 64), z: shape=(N, )
+        :return: (state, policy, z). shape=((N, 2, 8, 8), (N, 64), (N, ))
         """
-        state_list = []
-        policy_list = []
-        z_list = []
-        for state, policy, z in data:
-            own, enemy = bit_to_array(state[0], 64).reshape((8, 8)), bit_to_array(state[1], 64).reshape((8, 8))
-            state_list.append([own, enemy])
-            policy_list.append(policy)
-            z_list.append(z)
-
-        return np.array(state_list), np.array(policy_list), np.array(z_list)
+        bitboards, policy_ary, z_ary = data
+        state_ary = bits_to_arrays(bitboards).reshape((-1, 2, 8, 8))
+        return state_ary, policy_ary, z_ary.astype(np.float32)
 
 
 class PerStepCallback(Callback):
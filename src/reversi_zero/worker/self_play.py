@@ -1,6 +1,8 @@
+import asyncio
 import cProfile
 import os
-from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait
 from datetime import datetime
 from logging import getLogger
 from random import random
@@ -12,14 +14,17 @@ from multiprocessing import Manager, Lock
 
 
 from reversi_zero.agent.api import MultiProcessReversiModelAPIServer
-from reversi_zero.agent.player import ReversiPlayer
+from reversi_zero.agent.player import ReversiPlayer, PredictionBatcher
 from reversi_zero.config import Config
 from reversi_zero.env.reversi_env import Board, Winner
 from reversi_zero.env.reversi_env import ReversiEnv, Player
 from reversi_zero.lib import tf_util
-from reversi_zero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from reversi_zero.lib.data_helper import get_game_data_filenames, write_game_data_to_file, game_data_to_arrays
 from reversi_zero.lib.file_util import read_as_int
 from reversi_zero.lib.ggf import convert_action_to_move, make_ggf_string
+from reversi_zero.lib.replay_store import ReplayStore
+from reversi_zero.lib.self_play_stats import SelfPlayStatsWriter
+from reversi_zero.lib.solver_cache import SharedSolverCache
 from reversi_zero.lib.tensorboard_logger import TensorBoardLogger
 
 logger = getLogger(__name__)
@@ -28,6 +33,20 @@ logger = getLogger(__name__)
 def start(config: Config):
     tf_util.set_session_config(per_process_gpu_memory_fraction=0.3)
     api_server = MultiProcessReversiModelAPIServer(config)
+    rc = config.resource
+    stats_writer = SelfPlayStatsWriter(rc.self_play_stats_path, config.play_data.stats_interval_sec,
+                                       TensorBoardLogger(os.path.join(rc.self_play_log_dir, "throughput")),
+                                       server=api_server)
+    solver_cache = None
+    if config.play_data.solver_cache_size:
+        solver_cache = SharedSolverCache.create(config.play_data.solver_cache_size)
+    if config.play_data.single_process:
+        game_idx = read_as_int(config.resource.self_play_game_idx_file) or 0
+        play_worker = SelfPlayWorker(config, env=ReversiEnv(), api=api_server.get_local_api_client(),
+                                     shared_var=LocalVar(game_idx=game_idx), solver_cache=solver_cache)
+        play_worker.stats_writer = stats_writer
+        return play_worker.start()
+
     process_num = config.play_data.multi_process_num
     api_server.start_serve()
 
@@ -37,8 +56,10 @@ def start(config: Config):
             futures = []
             for i in range(process_num):
                 play_worker = SelfPlayWorker(config, env=ReversiEnv(), api=api_server.get_api_client(),
-                                             shared_var=shared_var, worker_index=i)
+                                             shared_var=shared_var, worker_index=i, solver_cache=solver_cache)
                 futures.append(executor.submit(play_worker.start))
+            while wait(futures, timeout=config.play_data.stats_interval_sec).not_done:
+                stats_writer.write(shared_var.stats)
 
 
 class SharedVar:
@@ -50,6 +71,7 @@ class SharedVar:
         """
         self._lock = manager.Lock()
         self._game_idx = manager.Value('i', game_idx)  # type: multiprocessing.managers.ValueProxy
+        self._stats = manager.dict()  # worker index -> cumulative counters
 
     @property
     def game_idx(self):
@@ -60,9 +82,31 @@ class SharedVar:
             self._game_idx.value += n
             return self._game_idx.value
 
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def set_stats(self, worker_index, counters):
+        self._stats[worker_index] = counters
+
+
+class LocalVar:
+    """SharedVar of single process self-play"""
+
+    def __init__(self, game_idx: int):
+        self.game_idx = game_idx
+        self.stats = {}
+
+    def incr_game_idx(self, n=1):
+        self.game_idx += n
+        return self.game_idx
+
+    def set_stats(self, worker_index, counters):
+        self.stats[worker_index] = counters
+
 
 class SelfPlayWorker:
-    def __init__(self, config: Config, env, api, shared_var, worker_index=0):
+    def __init__(self, config: Config, env, api, shared_var, worker_index=0, solver_cache=None):
         """
 
         :param config:
@@ -70,6 +114,7 @@ class SelfPlayWorker:
         :param ReversiModelAPI|None api:
         :param SharedVar shared_var:
         :param int worker_index:
+        :param SharedSolverCache solver_cache: results of the solver shared by all workers
         """
         self.config = config
         self.env = env
@@ -84,6 +129,13 @@ class SelfPlayWorker:
         self.tensor_board = None  # type: TensorBoardLogger
         self.move_history = None  # type: MoveHistory
         self.move_history_buffer = []  # type: list[MoveHistory]
+        self.replay_store = None  # type: ReplayStore
+        self.local_idx = 0
+        self.start_time = None
+        self.counters = Counter()  # see reversi_zero.lib.self_play_stats.WORKER_COUNTERS
+        self.shared_batcher = None  # type: PredictionBatcher
+        self.stats_writer = None  # type: SelfPlayStatsWriter
+        self.solver_cache = solver_cache
 
     def start(self):
         try:
@@ -99,68 +151,143 @@ class SelfPlayWorker:
         self.tensor_board = TensorBoardLogger(os.path.join(self.config.resource.self_play_log_dir, worker_name))
 
         self.buffer = []
-        mtcs_info = None
-        local_idx = 0
+        self.local_idx = 0
+        self.start_time = time()
+
+        parallel_game_num = self.config.play_data.parallel_game_num
+        if parallel_game_num > 1:
+            self.start_parallel_games(parallel_game_num)
+            return
 
+        mtcs_info = None
         while True:
             np.random.seed(None)
-            local_idx += 1
-            game_idx = self.shared_var.game_idx
-
-            start_time = time()
-            if mtcs_info is None and self.config.play.share_mtcs_info_in_self_play:
-                mtcs_info = ReversiPlayer.create_mtcs_info()
-
-            # play game
-            env = self.start_game(local_idx, game_idx, mtcs_info)
-
-            game_idx = self.shared_var.incr_game_idx()
-            # just log
-            end_time = time()
-            time_spent = end_time - start_time
-            logger.debug(f"play game {game_idx} time={time_spent} sec, "
-                         f"turn={env.turn}:{env.board.number_of_black_and_white}:{env.winner}")
-
-            # log play info to tensor board
-            prefix = "self"
-            log_info = {f"{prefix}/time": time_spent, f"{prefix}/turn": env.turn}
-            if mtcs_info:
-                log_info[f"{prefix}/mcts_buffer_size"] = len(mtcs_info.var_p)
-            self.tensor_board.log_scaler(log_info, game_idx)
-
-            # reset MCTS info per X games
-            if self.config.play.reset_mtcs_info_per_game and local_idx % self.config.play.reset_mtcs_info_per_game == 0:
-                logger.debug("reset MCTS info")
-                mtcs_info = None
-
-            with open(self.config.resource.self_play_game_idx_file, "wt") as f:
-                f.write(str(game_idx))
+            mtcs_info = self.play_one_game(mtcs_info)
+
+    def start_parallel_games(self, game_num):
+        """play `game_num` games concurrently. Leaf evaluations of all the games are predicted in one batch.
+
+        Each concurrent game has its own MCTS info, because pruning or eviction of the tree
+        renumbers or frees nodes which the other games may be searching.
+        """
+        loop = asyncio.get_event_loop()
+        batcher = self.shared_batcher = PredictionBatcher(self.api, self.config.play.prediction_queue_size * game_num)
+        logger.debug(f"play {game_num} games in parallel")
+
+        async def play_games():
+            mtcs_info = None
+            while True:
+                mtcs_info = await self.play_one_game_async(mtcs_info, batcher)
+
+        coroutine_list = [play_games() for _ in range(game_num)]
+        coroutine_list.append(batcher.worker(until_stopped=True))
+        loop.run_until_complete(asyncio.gather(*coroutine_list))
+
+    def play_one_game(self, mtcs_info):
+        return asyncio.get_event_loop().run_until_complete(self.play_one_game_async(mtcs_info))
+
+    async def play_one_game_async(self, mtcs_info, batcher=None):
+        """play a game and log it
+
+        :return: MCTS info for the next game
+        """
+        self.local_idx += 1
+        local_idx = self.local_idx
+        game_idx = self.shared_var.game_idx
+
+        start_time = time()
+        if mtcs_info is None and self.config.play.share_mtcs_info_in_self_play:
+            mtcs_info = ReversiPlayer.create_mtcs_info()
+
+        # play game
+        env = await self.start_game_async(local_idx, game_idx, mtcs_info, batcher)
+
+        game_idx = self.shared_var.incr_game_idx()
+        # just log
+        end_time = time()
+        time_spent = end_time - start_time
+        games_per_hour = self.counters["games"] / (end_time - self.start_time) * 3600
+        evals_per_sec = self.api.predicted_num / (end_time - self.start_time)
+        logger.debug(f"play game {game_idx} time={time_spent} sec, "
+                     f"turn={env.turn}:{env.board.number_of_black_and_white}:{env.winner}, "
+                     f"games/hour={games_per_hour:.1f} evaluated positions/sec={evals_per_sec:.1f}")
+
+        # log play info to tensor board
+        prefix = "self"
+        log_info = {f"{prefix}/time": time_spent, f"{prefix}/turn": env.turn,
+                    f"{prefix}/games_per_hour": games_per_hour, f"{prefix}/evals_per_sec": evals_per_sec}
+        if mtcs_info is not None:
+            log_info[f"{prefix}/mcts_buffer_size"] = len(mtcs_info)
+            log_info[f"{prefix}/mcts_buffer_bytes"] = mtcs_info.nbytes
+            log_info[f"{prefix}/mcts_hit_rate"] = mtcs_info.hit_rate
+            log_info[f"{prefix}/mcts_evicted_num"] = mtcs_info.evicted_count
+        self.tensor_board.log_scaler(log_info, game_idx)
+        self.shared_var.set_stats(self.worker_index, self.stats_counters())
+        if self.stats_writer is not None:
+            self.stats_writer.write_if_due(self.shared_var.stats)
+
+        # reset MCTS info per X games
+        if self.config.play.reset_mtcs_info_per_game and local_idx % self.config.play.reset_mtcs_info_per_game == 0:
+            logger.debug("reset MCTS info")
+            mtcs_info = None
+
+        with open(self.config.resource.self_play_game_idx_file, "wt") as f:
+            f.write(str(game_idx))
+        return mtcs_info
 
     def start_game(self, local_idx, last_game_idx, mtcs_info):
+        return asyncio.get_event_loop().run_until_complete(self.start_game_async(local_idx, last_game_idx, mtcs_info))
+
+    async def start_game_async(self, local_idx, last_game_idx, mtcs_info, batcher=None):
+        """
+
+        :param PredictionBatcher batcher: if not None, the game is played concurrently with other games.
+        :rtype: ReversiEnv
+        """
         # profiler = cProfile.Profile()
         # profiler.enable()
 
-        self.env.reset()
+        env = self.env if batcher is None else ReversiEnv()
+        env.reset()
         enable_resign = self.config.play.disable_resignation_rate <= random()
         self.config.play.simulation_num_per_move = self.decide_simulation_num_per_move(last_game_idx)
         logger.debug(f"simulation_num_per_move = {self.config.play.simulation_num_per_move}")
-        self.black = self.create_reversi_player(enable_resign=enable_resign, mtcs_info=mtcs_info)
-        self.white = self.create_reversi_player(enable_resign=enable_resign, mtcs_info=mtcs_info)
+        black = self.create_reversi_player(enable_resign=enable_resign, mtcs_info=mtcs_info, batcher=batcher)
+        white = self.create_reversi_player(enable_resign=enable_resign, mtcs_info=mtcs_info, batcher=batcher)
         if not enable_resign:
             logger.debug("Resignation is disabled in the next game.")
-        observation = self.env.observation  # type: Board
-        self.move_history = MoveHistory()
+        observation = env.observation  # type: Board
+        move_history = MoveHistory()
+        tables = list({id(p.table): p.table for p in (black, white)}.values())
+        mcts_lookups = sum(t.lookup_count for t in tables)
+        mcts_hits = sum(t.hit_count for t in tables)
 
         # game loop
-        while not self.env.done:
-            # logger.debug(f"turn={self.env.turn}")
-            if self.env.next_player == Player.black:
-                action = self.black.action_with_evaluation(observation.black, observation.white)
+        while not env.done:
+            # logger.debug(f"turn={env.turn}")
+            move_start_time = time()
+            if env.next_player == Player.black:
+                action = await black.action_with_evaluation_async(observation.black, observation.white)
             else:
-                action = self.white.action_with_evaluation(observation.white, observation.black)
-            self.move_history.move(self.env, action)
-            observation, info = self.env.step(action.action)
-
+                action = await white.action_with_evaluation_async(observation.white, observation.black)
+            self.counters["moves"] += 1
+            self.counters["move_sec"] += time() - move_start_time
+            move_history.move(env, action)
+            observation, info = env.step(action.action)
+
+        # no await below, so other games do not change them
+        self.env, self.black, self.white, self.move_history = env, black, white, move_history
+        self.counters["games"] += 1
+        self.counters["mcts_lookups"] += sum(t.lookup_count for t in tables) - mcts_lookups
+        self.counters["mcts_hits"] += sum(t.hit_count for t in tables) - mcts_hits
+        for player in (black, white):
+            self.counters["simulations"] += player.simulation_num
+            self.counters["symmetry_saved_evals"] += player.symmetry_saved_evaluation_num
+            self.counters["solver_sec"] += player.solver_sec
+            self.counters["solver_count"] += player.solver_count
+            if player.own_batcher:
+                self.counters["prediction_wait_sec"] += player.batcher.prediction_wait_sec
+                self.counters["prediction_wait_count"] += player.batcher.prediction_wait_count
         self.finish_game(resign_enabled=enable_resign)
         self.save_play_data(write=local_idx % self.config.play_data.nb_game_in_file == 0)
         self.remove_play_data()
@@ -169,13 +296,29 @@ class SelfPlayWorker:
             is_write = local_idx % self.config.play_data.nb_game_in_ggf_file == 0
             is_write |= local_idx <= 5
             self.save_ggf_data(write=is_write)
+        black.close()
+        white.close()
 
         # profiler.disable()
         # profiler.dump_stats(f"profile-worker-{self.worker_index}-{local_idx}")
-        return self.env
-
-    def create_reversi_player(self, enable_resign=None, mtcs_info=None):
-        return ReversiPlayer(self.config, None, enable_resign=enable_resign, mtcs_info=mtcs_info, api=self.api)
+        return env
+
+    def stats_counters(self):
+        """cumulative counters of this worker"""
+        counters = Counter(self.counters)
+        counters["evals"] = self.api.predicted_num
+        counters["api_sec"] = self.api.predict_sec
+        if self.solver_cache is not None:
+            counters["solver_cache_lookups"] = self.solver_cache.lookup_count
+            counters["solver_cache_hits"] = self.solver_cache.hit_count
+        if self.shared_batcher is not None:
+            counters["prediction_wait_sec"] += self.shared_batcher.prediction_wait_sec
+            counters["prediction_wait_count"] += self.shared_batcher.prediction_wait_count
+        return dict(counters)
+
+    def create_reversi_player(self, enable_resign=None, mtcs_info=None, batcher=None):
+        return ReversiPlayer(self.config, None, enable_resign=enable_resign, mtcs_info=mtcs_info, api=self.api,
+                             batcher=batcher, solver_cache=self.solver_cache)
 
     def save_play_data(self, write=True):
         # drop draw game by drop_draw_game_rate
@@ -187,6 +330,15 @@ class SelfPlayWorker:
             return
 
         rc = self.config.resource
+        pd = self.config.play_data
+        if pd.use_replay_store:
+            if self.replay_store is None:
+                self.replay_store = ReplayStore.open(rc.replay_store_path, pd.replay_store_capacity)
+            self.replay_store.append(*game_data_to_arrays(self.buffer))
+            logger.info(f"append {len(self.buffer)} samples to {rc.replay_store_path}")
+            self.buffer = []
+            return
+
         game_id = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
         path = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % game_id)
         logger.info(f"save play data to {path}")
@@ -207,6 +359,8 @@ class SelfPlayWorker:
         self.move_history_buffer = []
 
     def remove_play_data(self):
+        if self.config.play_data.use_replay_store:  # the oldest samples are overwritten in the replay store
+            return
         files = get_game_data_filenames(self.config.resource)
         if len(files) < self.config.play_data.max_file_num:
             return
@@ -0,0 +1,136 @@
+import os
+import pickle
+from multiprocessing import connection
+from threading import Thread
+from unittest.mock import patch
+
+from nose.tools.trivial import eq_, ok_
+
+import numpy as np
+
+from reversi_zero.agent.api import MultiProcessReversiModelAPIServer, SharedMemoryBuffer, \
+    SharedMemoryReversiModelAPIClient, ReversiModelAPI, to_planes
+from reversi_zero.config import Config
+from reversi_zero.env.reversi_env import ReversiEnv
+from reversi_zero.lib.bitboard import bits_to_arrays, bit_to_array, find_correct_moves
+
+
+class DummyKerasModel:
+    """policy = own + 2 * enemy, value = number of own stones"""
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict_on_batch(self, x):
+        self.batch_sizes.append(len(x))
+        x = x.reshape((-1, 2, 64))
+        return x[:, 0] + 2 * x[:, 1], np.sum(x[:, 0], axis=1, keepdims=True)
+
+
+class DummyModel:
+    def __init__(self):
+        self.model = DummyKerasModel()
+        self.digest = "dummy"
+
+
+def create_server(transport):
+    config = Config()
+    config.play_data.api_transport = transport
+    config.play_data.api_shared_memory_batch_size = 4
+    config.play_data.api_eval_cache_size_mb = 0
+    server = MultiProcessReversiModelAPIServer(config)
+    server.model = DummyModel()
+    return server
+
+
+def predict_through_server(server, client, x):
+    """predict x by client in another thread, and serve the requests in this thread"""
+    result = []
+    client_thread = Thread(target=lambda: result.append(client.predict(x)))
+    client_thread.start()
+    while client_thread.is_alive():
+        ready_conns = connection.wait(server.connections, timeout=0.1)
+        if ready_conns:
+            server.handle_requests(ready_conns)
+    client_thread.join()
+    return result[0]
+
+
+def random_states(n):
+    rng = np.random.RandomState(0)
+    own = rng.randint(0, 1 << 62, size=n, dtype=np.int64).astype(np.uint64) << np.uint64(2)
+    enemy = ~own & (rng.randint(0, 1 << 62, size=n, dtype=np.int64).astype(np.uint64) << np.uint64(2))
+    return np.stack([own, enemy], axis=1)
+
+
+def expected_output(x):
+    return DummyKerasModel().predict_on_batch(bits_to_arrays(x, dtype=np.float32))
+
+
+def test_shared_memory_round_trip():
+    server = create_server("shared_memory")
+    client = server.get_api_client()
+    ok_(isinstance(client, SharedMemoryReversiModelAPIClient))
+    x = random_states(10)  # 3 chunks of api_shared_memory_batch_size=4
+
+    policy, value = predict_through_server(server, client, x)
+    expected_policy, expected_value = expected_output(x)
+    eq_((10, 64), policy.shape)
+    eq_((10, 1), value.shape)
+    ok_(np.array_equal(expected_policy, policy))
+    ok_(np.array_equal(expected_value, value))
+    eq_([4, 4, 2], server.model.model.batch_sizes)
+
+    policy, value = predict_through_server(server, client, x[3])  # single state
+    ok_(np.array_equal(expected_policy[3], policy))
+    ok_(np.array_equal(expected_value[3], value))
+
+
+def test_shared_memory_buffer_is_pickled_by_path():
+    buffer = SharedMemoryBuffer.create(4)
+    buffer.state[:2] = [[1, 2], [3, 1 << 63]]
+    copied = pickle.loads(pickle.dumps(buffer))
+    eq_(buffer.path, copied.path)
+    eq_([[1, 2], [3, 1 << 63]], copied.state[:2].tolist())
+    copied.policy[1, 5] = 0.5
+    eq_(0.5, buffer.policy[1, 5])
+
+
+def test_shared_memory_buffer_without_dev_shm():
+    isdir = os.path.isdir
+    with patch("reversi_zero.agent.api.os.path.isdir", lambda path: path != "/dev/shm" and isdir(path)):
+        buffer = SharedMemoryBuffer.create(4)
+    ok_(not buffer.path.startswith("/dev/shm"))
+    ok_(os.path.exists(buffer.path))
+    eq_(SharedMemoryBuffer.calc_size(4), os.path.getsize(buffer.path))
+
+    buffer.state[0] = [5, 6]
+    eq_([5, 6], pickle.loads(pickle.dumps(buffer)).state[0].tolist())
+
+
+def float_planes(own, enemy):
+    """input planes made from bitboards bit by bit, as before the model API took bitboards"""
+    return np.array([[(x >> i) & 1 for i in range(64)] for x in (own, enemy)], dtype=np.float32).reshape((2, 8, 8))
+
+
+def test_to_planes_is_same_as_float_planes():
+    rng = np.random.RandomState(1)
+    initial = ReversiEnv().reset().board
+    env = ReversiEnv().reset()
+    while env.turn < 30:  # mid-game position by random moves
+        own, enemy = env.get_own_and_enemy()
+        env.step(int(rng.choice(np.nonzero(bit_to_array(find_correct_moves(own, enemy), 64))[0])))
+    ok_(not env.done)
+
+    api = ReversiModelAPI(Config(), DummyModel())
+    for black, white in [(initial.black, initial.white), (env.board.black, env.board.white)]:
+        for own, enemy in [(black, white), (white, black)]:  # black to move, white to move
+            x = np.array([own, enemy], dtype=np.uint64)
+            expected = float_planes(own, enemy)
+            planes = to_planes(x.reshape((1, 2)))
+            eq_(np.float32, planes.dtype)
+            ok_(np.array_equal(expected, planes[0]))
+
+            policy, value = api.predict(x)
+            expected_policy, expected_value = DummyKerasModel().predict_on_batch(expected.reshape((1, 2, 8, 8)))
+            ok_(np.array_equal(expected_policy[0], policy))
+            ok_(np.array_equal(expected_value[0], value))
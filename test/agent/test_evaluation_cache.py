@@ -0,0 +1,58 @@
+from nose.tools.trivial import eq_, ok_
+
+import numpy as np
+
+from reversi_zero.agent.evaluation_cache import EvaluationCache, ENTRY_BYTES
+from reversi_zero.lib.bitboard_backend import flip_vertical, rotate90
+
+
+def test_get_and_put():
+    cache = EvaluationCache(ENTRY_BYTES * 10)
+    x = np.array([[0x0000000810000000, 0x0000001008000000], [1, 2]], dtype=np.uint64)
+    policy = np.random.random((2, 64)).astype(np.float32)
+    value = np.array([[0.5], [-0.5]], dtype=np.float32)
+
+    _, _, miss = cache.get(x)
+    eq_([0, 1], list(miss))
+    cache.put(x, policy, value)
+    p, v, miss = cache.get(x)
+    eq_(0, len(miss))
+    ok_(np.array_equal(policy, p))
+    ok_(np.array_equal(value, v))
+    eq_(0.5, cache.hit_rate)
+
+
+def test_symmetric_positions_are_not_shared():
+    cache = EvaluationCache(ENTRY_BYTES * 10)
+    own, enemy = 0b111, 0b1000
+    cache.put(np.array([[own, enemy]], dtype=np.uint64), np.ones((1, 64)), np.zeros((1, 1)))
+
+    for x in ([[rotate90(own), rotate90(enemy)]], [[flip_vertical(own), flip_vertical(enemy)]]):
+        _, _, miss = cache.get(np.array(x, dtype=np.uint64))
+        eq_([0], list(miss))
+
+
+def test_lru_and_digest():
+    cache = EvaluationCache(ENTRY_BYTES * 2)
+    keys = [np.array([[1 << i, 0]], dtype=np.uint64) for i in [9, 18, 27]]  # not symmetric each other
+    cache.set_digest("a")
+    cache.put(keys[0], np.zeros((1, 64)), np.zeros((1, 1)))
+    cache.put(keys[1], np.zeros((1, 64)), np.zeros((1, 1)))
+    cache.get(keys[0])
+    cache.put(keys[2], np.zeros((1, 64)), np.zeros((1, 1)))  # evict keys[1]
+    eq_(2, len(cache))
+    eq_(0, len(cache.get(keys[0])[2]))
+    eq_(1, len(cache.get(keys[1])[2]))
+    eq_(0, len(cache.get(keys[2])[2]))
+
+    cache.set_digest("a")
+    eq_(2, len(cache))
+    cache.set_digest("b")
+    eq_(0, len(cache))
+
+
+def test_disabled():
+    cache = EvaluationCache(0)
+    x = np.array([[1, 2]], dtype=np.uint64)
+    cache.put(x, np.zeros((1, 64)), np.zeros((1, 1)))
+    eq_([0], list(cache.get(x)[2]))
@@ -0,0 +1,93 @@
+from nose.tools.trivial import eq_, ok_
+
+import numpy as np
+
+from reversi_zero.agent.mcts_table import MCTSTable
+
+
+def test_get_and_find():
+    table = MCTSTable(capacity=16)
+    key1 = (0xFFFFFFFFFFFFFFFF, 1, 1)
+    key2 = (1, 0xFFFFFFFFFFFFFFFF, 2)
+    eq_(-1, table.find(key1))
+    slot1 = table.get(key1)
+    slot2 = table.get(key2)
+    ok_(slot1 != slot2)
+    eq_(slot1, table.get(key1))
+    eq_(slot1, table.find(key1))
+    eq_(2, len(table))
+    ok_(key2 in table)
+    ok_((1, 0xFFFFFFFFFFFFFFFF, 1) not in table)
+
+
+def test_grow():
+    table = MCTSTable(capacity=16)
+    slots = [table.get((i, i * 3, 1)) for i in range(1000)]
+    table.n[slots[10], 5] = 7
+    table.get((10000, 1, 1))  # grow
+    ok_(table.capacity >= 1001)
+    eq_(list(range(1000)), [table.get((i, i * 3, 1)) for i in range(1000)])
+    eq_(7, table.n[slots[10], 5])
+
+
+def test_q_and_hit_rate():
+    table = MCTSTable()
+    slot = table.get((1, 2, 1))
+    table.n[slot, 3] = 2
+    table.w[slot, 3] = 1
+    ok_(np.isclose(0.5, table.q(slot)[3], atol=1e-4))
+    eq_(0, table.q(slot)[0])
+    eq_(slot, table.get((1, 2, 1)))
+    eq_(0.5, table.hit_rate)
+    ok_(table.nbytes > 0)
+
+
+def test_retain():
+    table = MCTSTable(capacity=16)
+    slots = [table.get((i, i * 3, 1)) for i in range(100)]
+    table.n[slots[50], 5] = 7
+    table.expanded[slots[80]] = True
+    table.retain([slots[80], slots[50]])
+    eq_(2, len(table))
+    ok_(table.capacity < 128)
+    eq_(0, table.get((80, 240, 1)))
+    eq_(1, table.get((50, 150, 1)))
+    ok_(table.expanded[0])
+    eq_(7, table.n[1, 5])
+    eq_(-1, table.find((10, 30, 1)))
+    table.retain([])
+    eq_(0, len(table))
+
+
+def test_evict():
+    table = MCTSTable(capacity=16)
+    slots = [table.get((i, i * 3, 1)) for i in range(10)]
+    table.n[slots, 0] = np.arange(10)[::-1]
+    table.evict(3, protected=[slots[9]])
+    eq_(7, len(table))
+    eq_([-1, -1, -1], [table.find((i, i * 3, 1)) for i in [6, 7, 8]])
+    eq_(slots[9], table.find((9, 27, 1)))
+    eq_(slots[5], table.find((5, 15, 1)))
+
+    slot = table.get((100, 1, 2))
+    ok_(slot in [slots[6], slots[7], slots[8]])
+    eq_(0, table.n[slot, 0])
+    eq_(8, len(table))
+
+    table.generation += 1
+    table.get((0, 0, 1))
+    table.get((100, 1, 2))
+    table.evict(6, policy="oldest")
+    eq_(2, len(table))
+    ok_((100, 1, 2) in table)
+    eq_(9, table.evicted_count)
+
+
+def test_index_after_evict():
+    table = MCTSTable(capacity=16)
+    keys = [((i * 0x9E3779B9) & 0xFFFFFFFFFFFFFFFF, i << 40, 1 + i % 2) for i in range(3000)]
+    slots = [table.get(key) for key in keys]
+    table.n[slots, 0] = np.arange(3000)
+    table.evict(1000)
+    eq_([-1] * 1000, [table.find(key) for key in keys[:1000]])
+    eq_(slots[1000:], [table.find(key) for key in keys[1000:]])
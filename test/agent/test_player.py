@@ -1,11 +1,16 @@
+import asyncio
+from time import sleep, time
+
 from nose.tools.trivial import eq_, ok_
 
 import numpy as np
 
 
 from reversi_zero.config import Config
-from reversi_zero.agent.player import ReversiPlayer
+from reversi_zero.agent.player import ReversiPlayer, CounterKey, PredictionBatcher, SolverResult
+from reversi_zero.env.reversi_env import ReversiEnv, Player
 from reversi_zero.lib.bitboard import bit_count
+from reversi_zero.lib.util import parse_to_bitboards
 
 
 def test_add_data_to_move_buffer_with_8_symmetries():
@@ -75,6 +80,250 @@ def test_add_data_to_move_buffer_with_8_symmetries():
     eq_(p[idx(7, 0)], 0.2)
 
 
+def test_prune_tree():
+    config = Config()
+    player = ReversiPlayer(config, None)
+    env = ReversiEnv().reset()
+    root = player.counter_key(env)
+    player.update_n_w(player.get_node(root), 19, 1, 0)
+    player.update_n_w(player.get_node(root), 26, 1, 0)
+    env.step(19)
+    child = player.counter_key(env)
+    player.get_node(child)
+    player.get_node(player.another_side_counter_key(env))
+    player.get_node(CounterKey(1, 2, Player.black.value))  # unreachable
+    eq_(4, len(player.table))
+
+    player.prune_tree(root)
+    eq_(3, len(player.table))
+    ok_(child in player.table)
+    ok_(CounterKey(1, 2, Player.black.value) not in player.table)
+    eq_(1, player.var_n(player.get_node(root))[19])
+
+    player.prune_tree(child)
+    eq_(2, len(player.table))
+    ok_(root not in player.table)
+
+
+class DummySearchingPlayer:
+    def __init__(self, simulation_num):
+        self.play_config = Config().play
+        self.play_config.parallel_search_num = simulation_num
+        self.running_simulation_num = simulation_num
+
+
+class BatchSizeAPI:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, x):
+        self.batch_sizes.append(len(x))
+        return np.ones((len(x), 64)) / 64, x[:, :1].astype(np.float64)
+
+
+def run_batcher(batcher, *coroutines):
+    async def predict_all():
+        try:
+            return await asyncio.wait_for(asyncio.gather(*coroutines, return_exceptions=True), timeout=10)
+        finally:
+            batcher.stop()
+
+    return asyncio.get_event_loop().run_until_complete(
+        asyncio.gather(predict_all(), batcher.worker(until_stopped=True)))[0]
+
+
+def test_prediction_batcher_flushes_full_queue():
+    api = BatchSizeAPI()
+    batcher = PredictionBatcher(api, queue_size=2)
+    batcher.active_players.add(DummySearchingPlayer(10))  # not all of the simulations are waiting
+    results = run_batcher(batcher, *[batcher.predict(np.array([i, 0], dtype=np.uint64)) for i in range(2)])
+    eq_([2], api.batch_sizes)
+    eq_([0, 1], [v[0] for p, v in results])  # each waiter gets its own result
+    eq_(0, batcher.blocked_simulation_num)
+    eq_(2, batcher.prediction_wait_count)
+
+
+def test_prediction_batcher_flushes_when_all_simulations_wait():
+    api = BatchSizeAPI()
+    batcher = PredictionBatcher(api, queue_size=100)
+    batcher.active_players.add(DummySearchingPlayer(3))
+    results = run_batcher(batcher, *[batcher.predict(np.array([i, 0], dtype=np.uint64)) for i in range(3)])
+    eq_([3], api.batch_sizes)  # flushed by the last waiter, not by the queue size
+    eq_([0, 1, 2], [v[0] for p, v in results])
+
+
+def test_prediction_batcher_raises_error_in_waiters():
+    class BrokenAPI:
+        def predict(self, x):
+            raise RuntimeError("broken model")
+
+    batcher = PredictionBatcher(BrokenAPI(), queue_size=2)
+    batcher.active_players.add(DummySearchingPlayer(2))
+    results = run_batcher(batcher, *[batcher.predict(np.array([i, 0], dtype=np.uint64)) for i in range(2)])
+    eq_(2, len(results))
+    for result in results:
+        ok_(isinstance(result, RuntimeError))
+        eq_("broken model", str(result))
+
+
+def test_shared_prediction_batcher():
+    class DummyAPI:
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict(self, x):
+            self.batch_sizes.append(len(x))
+            return np.ones((len(x), 64)) / 64, np.zeros((len(x), 1))
+
+    config = Config()
+    config.play.simulation_num_per_move = 4
+    config.play.parallel_search_num = 4
+    config.play.use_solver_turn = None
+    config.play.noise_eps = 0
+    api = DummyAPI()
+    batcher = PredictionBatcher(api, queue_size=100)
+    players = [ReversiPlayer(config, None, api=api, batcher=batcher) for _ in range(3)]
+    env = ReversiEnv().reset()
+    env.step(19)
+    own, enemy = env.board.white, env.board.black
+
+    async def search_all():
+        await asyncio.gather(*[p.action_with_evaluation_async(own, enemy) for p in players])
+        batcher.stop()
+
+    asyncio.get_event_loop().run_until_complete(asyncio.gather(search_all(), batcher.worker(until_stopped=True)))
+    eq_(3 * 4, sum(api.batch_sizes))
+    eq_(3, api.batch_sizes[0])  # the first leaf of each player is predicted together
+    for player in players:
+        eq_(3, np.sum(player.var_n(player.get_node(player.counter_key(env)))))  # the first one expands the root
+        eq_(1, len(player.moves))
+
+
+def test_evict_nodes_while_searching():
+    class DummyAPI:
+        def predict(self, x):
+            return np.ones((len(x), 64)) / 64, np.zeros((len(x), 1))
+
+    config = Config()
+    config.play.simulation_num_per_move = 100
+    config.play.parallel_search_num = 8
+    config.play.use_solver_turn = None
+    config.play.mcts_node_budget = 300
+    player = ReversiPlayer(config, None, api=DummyAPI())
+    for i in range(300):  # nodes of the previous searches
+        player.table.get((i, i << 32, 1))
+    env = ReversiEnv().reset()
+    own, enemy = env.board.black, env.board.white
+
+    player.search_moves(own, enemy)
+    ok_(player.table.evicted_count > 0)
+    ok_(len(player.table) <= 300 + 2 * 8, len(player.table))
+    eq_(100 - 1, np.sum(player.var_n(player.get_node(player.counter_key(env)))))  # the first one expands the root
+
+
+def endgame_key():
+    """white wins by 2 discs with 57"""
+    black, white = parse_to_bitboards('''
+    ##########
+    #XXXX    #
+    #XOXX    #
+    #XOXXOOOO#
+    #XOXOXOOO#
+    #XOXXOXOO#
+    #OOOOXOXO#
+    # OOOOOOO#
+    #  XXXXXO#
+    ##########''')
+    return CounterKey(black, white, Player.white.value)
+
+
+def test_solve_in_simulation():
+    config = Config()
+    player = ReversiPlayer(config, None)
+    key = endgame_key()
+    run = asyncio.get_event_loop().run_until_complete
+
+    player.solver_deadline = 0  # no time budget
+    eq_((None, None), run(player.solve_in_simulation(key)))
+    ok_(key not in player.solver_futures)
+
+    player.solver_deadline = time() + 30
+    player.solver_executor.submit(sleep, 0.2)  # the solver is busy
+    config.play.wait_solver_in_simulation = False
+    eq_((None, None), run(player.solve_in_simulation(key)))  # evaluated by the model while solving
+    move, score = player.solver_futures[key].result()
+    eq_(57, move)
+    ok_(score > 0)
+    eq_((move, score), run(player.solve_in_simulation(key)))
+
+    config.play.wait_solver_in_simulation = True
+    player.solver_futures = {}
+    player.solver_executor.submit(sleep, 0.2)
+    eq_((move, score), run(player.solve_in_simulation(key)))
+
+
+def test_cancel_solving_and_close():
+    config = Config()
+    config.play.wait_solver_in_simulation = False
+    player = ReversiPlayer(config, None)
+    key = endgame_key()
+    run = asyncio.get_event_loop().run_until_complete
+
+    player.solver_deadline = time() + 30
+    player.solver_executor.submit(sleep, 0.2)
+    eq_((None, None), run(player.solve_in_simulation(key)))
+    future = player.solver_futures[key]
+    player.cancel_solving()
+    ok_(future.cancelled())
+    eq_({}, player.solver_futures)
+
+    # cancelled after the solve is taken from the queue but before the solver starts
+    class SlowSolverCache:
+        def get(self, *args):
+            sleep(0.3)
+
+    player.solver_cache = SlowSolverCache()
+    board = ReversiEnv().reset().board  # too early to solve
+    opening_key = CounterKey(board.black, board.white, Player.black.value)
+    eq_((None, None), run(player.solve_in_simulation(opening_key)))
+    future = player.solver_futures[opening_key]
+    while not future.running():
+        sleep(0.01)
+    player.cancel_solving()
+    start_time = time()
+    eq_((None, None), future.result(timeout=10))
+    ok_(time() - start_time < 1)
+
+    player.close()
+    try:
+        player.submit_solve(key, exactly=True)
+        ok_(False, "the solver thread is not stopped")
+    except RuntimeError:
+        pass
+
+
+def test_solve_by_deepening():
+    player = ReversiPlayer(Config(), None)
+    key = endgame_key()
+    results = []
+    eq_(SolverResult(57, 2, True), player.solve_by_deepening(key, 30, callback=results.append))
+    eq_([False, True], [r.exact for r in results])
+    eq_(57, results[0].action)
+    ok_(results[0].score > 0)
+
+    eq_(None, player.solve_by_deepening(key, 0))
+
+
+def test_solve_by_deepening_returns_win_loss_result_if_exact_search_times_out():
+    class WinLossOnlySolver:
+        def solve(self, black, white, next_player, timeout, exactly, cancel=None):
+            return (None, None) if exactly else (57, 1)
+
+    player = ReversiPlayer(Config(), None)
+    player.solver = WinLossOnlySolver()
+    eq_(SolverResult(57, 1, False), player.solve_by_deepening(endgame_key(), 30))
+
+
 def idx(x, y):
     return y*8 + x
 
@@ -4,7 +4,7 @@ from nose.tools import assert_almost_equal
 from nose.tools.trivial import ok_, eq_
 
 from reversi_zero.lib.bitboard import find_correct_moves, board_to_string, bit_count, dirichlet_noise_of_mask, \
-    bit_to_array
+    bit_to_array, bits_to_arrays, arrays_to_bits
 from reversi_zero.lib.util import parse_to_bitboards
 
 
@@ -120,3 +120,23 @@ def test_dirichlet_noise_of_mask():
     eq_(bc, np.sum(noise > 0))
     ary = bit_to_array(legal_moves, 64)
     eq_(list(noise), list(noise * ary))
+
+
+def test_bit_to_array():
+    eq_([0, 1, 0, 0], list(bit_to_array(0b0010, 4)))
+    eq_([1, 0, 1], list(bit_to_array(0b1101, 3)))
+    ary = bit_to_array((1 << 63) | 1, 64)
+    eq_((64, ), ary.shape)
+    eq_(2, np.sum(ary))
+    ok_(ary[0] == 1 and ary[63] == 1)
+
+
+def test_bits_to_arrays_and_arrays_to_bits():
+    bits = np.array([[0, 0xFFFFFFFFFFFFFFFF], [1 << 63, 0x0123456789ABCDEF]], dtype=np.uint64)
+    ary = bits_to_arrays(bits)
+    eq_((2, 2, 64), ary.shape)
+    for i in range(2):
+        for j in range(2):
+            eq_(list(bit_to_array(int(bits[i, j]), 64)), list(ary[i, j]))
+    eq_(bits.tolist(), arrays_to_bits(ary).tolist())
+    eq_(np.float32, bits_to_arrays(bits, dtype=np.float32).dtype)
@@ -0,0 +1,94 @@
+import random
+
+import numpy as np
+
+from nose import SkipTest
+from nose.tools.trivial import eq_, ok_
+
+import reversi_zero.lib.bitboard as python_bitboard
+from reversi_zero.lib.util import parse_to_bitboards
+
+
+def _cython_bitboard():
+    try:
+        import reversi_zero.lib.alt.bitboard as cython_bitboard
+        return cython_bitboard
+    except ImportError as e:
+        raise SkipTest(f"cython bitboard is not available: {e}")
+
+
+def _random_boards(n=300, seed=1):
+    rnd = random.Random(seed)
+    boards = []
+    for _ in range(n):
+        own = rnd.getrandbits(64) & rnd.getrandbits(64)
+        enemy = rnd.getrandbits(64) & ~own & 0xFFFFFFFFFFFFFFFF
+        boards.append((own, enemy))
+    boards.append(parse_to_bitboards('''
+    ##########
+    #OO      #
+    #XOO     #
+    #OXOOO   #
+    #  XOX   #
+    #   XXX  #
+    #  X     #
+    # X      #
+    #       X#
+    ##########'''))
+    boards.append((0, 0))
+    boards.append((0xFFFFFFFFFFFFFFFF, 0))
+    return boards
+
+
+def test_find_correct_moves_and_calc_flip():
+    c = _cython_bitboard()
+    for own, enemy in _random_boards():
+        eq_(python_bitboard.find_correct_moves(own, enemy), c.find_correct_moves(own, enemy))
+        for pos in range(64):
+            if (own | enemy) & (1 << pos) == 0:
+                eq_(python_bitboard.calc_flip(pos, own, enemy), c.calc_flip(pos, own, enemy), f"pos={pos}")
+
+
+def test_transforms_and_bit_count():
+    c = _cython_bitboard()
+    for own, enemy in _random_boards():
+        for name in ["flip_vertical", "flip_diag_a1h8", "rotate90", "rotate180", "bit_count", "b64"]:
+            eq_(getattr(python_bitboard, name)(own), getattr(c, name)(own), name)
+
+
+def test_bit_to_array():
+    c = _cython_bitboard()
+    for own, _ in _random_boards():
+        for size in [1, 8, 13, 64]:
+            p_ary, c_ary = python_bitboard.bit_to_array(own, size), c.bit_to_array(own, size)
+            eq_(p_ary.dtype, c_ary.dtype)
+            eq_(list(p_ary), list(c_ary))
+
+
+def test_dirichlet_noise_of_mask():
+    c = _cython_bitboard()
+    for own, _ in _random_boards(n=30):
+        if own == 0:
+            continue
+        np.random.seed(own % 1000)
+        p_noise = python_bitboard.dirichlet_noise_of_mask(own, 0.5)
+        np.random.seed(own % 1000)
+        c_noise = c.dirichlet_noise_of_mask(own, 0.5)
+        ok_(np.allclose(p_noise, c_noise))
+
+
+def test_backend_exports():
+    from reversi_zero.lib import bitboard_backend
+    ok_(bitboard_backend.BACKEND in ("python", "cython"))
+    own, enemy = parse_to_bitboards('''
+    ##########
+    #        #
+    #        #
+    #        #
+    #   OX   #
+    #   XO   #
+    #        #
+    #        #
+    #        #
+    ##########''')
+    eq_(python_bitboard.find_correct_moves(own, enemy), bitboard_backend.find_correct_moves(own, enemy))
@@ -0,0 +1,68 @@
+import os
+import tempfile
+
+import numpy as np
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.config import ResourceConfig
+from reversi_zero.lib.data_helper import write_game_data_to_file, read_game_data_from_file, \
+    convert_json_game_data_files, get_game_data_filenames, read_game_data_files
+
+
+DATA = [
+    [(0xFFFFFFFFFFFFFFFF, 1), [0.25] * 4 + [0] * 60, 1],
+    [(1 << 63, 2), [0] * 63 + [1], -1],
+    [(3, 4), [1 / 64] * 64, 0],
+]
+
+
+def check_arrays(state, policy, z):
+    eq_([[0xFFFFFFFFFFFFFFFF, 1], [1 << 63, 2], [3, 4]], state.tolist())
+    ok_(np.allclose(np.array([p for _, p, _ in DATA]), policy, atol=1e-3))
+    eq_([1, -1, 0], z.tolist())
+
+
+def test_write_and_read():
+    with tempfile.TemporaryDirectory() as d:
+        for filename in ["play.bin", "play.json"]:
+            path = os.path.join(d, filename)
+            write_game_data_to_file(path, DATA)
+            check_arrays(*read_game_data_from_file(path))
+
+
+def test_get_game_data_filenames_includes_json_files():
+    with tempfile.TemporaryDirectory() as d:
+        rc = ResourceConfig()
+        rc.play_data_dir = d
+        write_game_data_to_file(os.path.join(d, "play_1.json"), DATA)
+        write_game_data_to_file(os.path.join(d, "play_2.bin"), DATA)
+        eq_([os.path.join(d, "play_1.json"), os.path.join(d, "play_2.bin")], get_game_data_filenames(rc))
+
+
+def test_convert_json_game_data_files():
+    with tempfile.TemporaryDirectory() as d:
+        rc = ResourceConfig()
+        rc.play_data_dir = d
+        write_game_data_to_file(os.path.join(d, "play_1.json"), DATA)
+        converted = convert_json_game_data_files(rc)
+        eq_([os.path.join(d, "play_1.bin")], converted)
+        eq_(converted, get_game_data_filenames(rc))
+        ok_(not os.path.exists(os.path.join(d, "play_1.json")))
+        check_arrays(*read_game_data_from_file(converted[0]))
+
+
+def test_read_game_data_files():
+    with tempfile.TemporaryDirectory() as d:
+        paths = [os.path.join(d, f"play_{i}.{ext}") for i in range(3) for ext in ["bin", "json"]]
+        for path in paths:
+            write_game_data_to_file(path, DATA)
+        broken_path = os.path.join(d, "play_9.json")
+        with open(broken_path, "wt") as f:
+            f.write("[")
+
+        for process_num in [1, 2]:
+            results = dict(read_game_data_files(paths + [broken_path], process_num=process_num))
+            eq_(set(paths + [broken_path]), set(results))
+            ok_(isinstance(results.pop(broken_path), Exception))
+            for data in results.values():
+                check_arrays(*data)
@@ -0,0 +1,45 @@
+import numpy as np
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.lib.replay_buffer import ReplayBuffer
+
+
+def make_samples(value, n):
+    state = np.full((n, 2), value % 2, dtype=np.uint64)
+    policy = np.full((n, 64), value, dtype=np.float32)
+    z = np.full(n, value, dtype=np.float32)
+    return state, policy, z
+
+
+def check_buffer(buffer, expected_counts):
+    state, policy, z = buffer.arrays
+    eq_(sum(expected_counts.values()), len(z))
+    eq_(expected_counts, {v: int(np.sum(z == v)) for v in np.unique(z)})
+    ok_(np.array_equal(policy[:, 0], z))
+    ok_(np.array_equal(state[:, 0], z % 2))
+
+
+def test_add_and_remove():
+    buffer = ReplayBuffer(capacity=4)
+    buffer.add("a", *make_samples(1, 3))
+    buffer.add("b", *make_samples(2, 5))  # grow
+    buffer.add("c", *make_samples(3, 2))
+    ok_(buffer.capacity >= 10)
+    check_buffer(buffer, {1: 3, 2: 5, 3: 2})
+
+    eq_([9, 8, 7, 6, 5, 4, 3, 2, 1, 0], list(buffer.ages()))
+    buffer.remove("a")
+    check_buffer(buffer, {2: 5, 3: 2})
+    eq_([0, 1], sorted(buffer.ages()[buffer.arrays[2] == 3]))
+    eq_([2, 3, 4, 5, 6], sorted(buffer.ages()[buffer.arrays[2] == 2]))
+    buffer.add("d", *make_samples(4, 1))
+    buffer.remove("b")
+    check_buffer(buffer, {3: 2, 4: 1})
+    ok_("b" not in buffer)
+    buffer.remove("d")
+    buffer.remove("c")
+    eq_(0, len(buffer))
+
+    buffer.add("e", *make_samples(5, 2))
+    buffer.add("e", *make_samples(6, 3))  # replace
+    check_buffer(buffer, {6: 3})
@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+import numpy as np
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.lib.replay_store import ReplayStore
+
+
+def make_samples(start, n):
+    state = np.array([[i, 1 << 63] for i in range(start, start + n)], dtype=np.uint64)
+    policy = np.zeros((n, 64))
+    policy[:, 3] = 0.5
+    z = np.array([(i % 3) - 1 for i in range(start, start + n)])
+    return state, policy, z
+
+
+def test_append_and_read():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "store.bin")
+        store = ReplayStore.open(path, 10)
+        eq_(0, len(store))
+        store.append(*make_samples(0, 4))
+        eq_(4, len(store))
+        eq_([3, 2, 1, 0], list(store.ages()))
+
+        state, policy, z = store.read([3, 1])
+        eq_([[3, 1 << 63], [1, 1 << 63]], state.tolist())
+        eq_([0.5, 0.5], policy[:, 3].tolist())
+        eq_([-1, 0], z.tolist())
+
+        reader = ReplayStore.open(path, 999)
+        eq_(10, reader.capacity)
+        eq_(4, len(reader))
+        store.append(*make_samples(4, 3))
+        eq_(3, reader.refresh())
+        eq_(7, len(reader))
+        eq_([6, 1 << 63], reader.read([6])[0][0].tolist())
+
+
+def test_ring_buffer():
+    with tempfile.TemporaryDirectory() as d:
+        store = ReplayStore.open(os.path.join(d, "store.bin"), 10)
+        store.append(*make_samples(0, 8))
+        store.append(*make_samples(8, 5))  # 10, 11, 12 overwrite 0, 1, 2
+        eq_(10, len(store))
+        eq_(13, store.appended_num)
+        eq_([2, 1, 0, 9], list(store.ages()[:4]))
+        eq_([10, 11, 12, 3], store.read([0, 1, 2, 3])[0][:, 0].tolist())
+
+        store.append(*make_samples(13, 25))  # only the last 10 samples are kept
+        ok_(set(store.read(np.arange(10))[0][:, 0].tolist()) == set(range(28, 38)))
+        eq_(37, store.read([37 % 10])[0][0, 0])
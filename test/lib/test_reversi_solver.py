@@ -0,0 +1,146 @@
+import random
+import threading
+from time import time
+
+from nose import SkipTest
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.env.reversi_env import Player, ReversiEnv
+from reversi_zero.lib.bitboard import find_correct_moves, bit_count
+from reversi_zero.lib.reversi_solver import ReversiSolver
+from reversi_zero.lib.util import parse_to_bitboards
+
+
+def _cython_solver():
+    try:
+        from reversi_zero.lib.alt.reversi_solver import ReversiSolver as CythonReversiSolver
+        return CythonReversiSolver
+    except ImportError as e:
+        raise SkipTest(f"cython solver is not available: {e}")
+
+
+PROBLEMS = [  # O: black, X: white. (board, next_player, best moves, score of next_player)
+    ('''
+    ##########
+    #XXXX    #
+    #XOXX    #
+    #XOXXOOOO#
+    #XOXOXOOO#
+    #XOXXOXOO#
+    #OOOOXOXO#
+    # OOOOOOO#
+    #  XXXXXO#
+    ##########''', Player.white, [57], 2),
+    ('''
+    ##########
+    #XXXX    #
+    #XXXX X  #
+    #XXXXXXOO#
+    #XXXXXXOO#
+    #XXXXOXOO#
+    #OXOOXOXO#
+    # OOOOOOO#
+    #OOOOOOOO#
+    ##########''', Player.black, [4, 14], -2),
+    ('''
+    ##########
+    #  X OOO #
+    #X XOXO O#
+    #XXXXOXOO#
+    #XOXOOXXO#
+    #XOOOOXXO#
+    #XOOOXXXO#
+    # OOOOXX #
+    #  OOOOX #
+    ##########''', Player.white, [3], 2),
+]
+
+
+def _check_problems(solver_class):
+    for board, next_player, moves, score in PROBLEMS:
+        black, white = parse_to_bitboards(board)
+        move, exact_score = solver_class().solve(black, white, next_player, exactly=True)
+        ok_(move in moves, (move, moves))
+        eq_(score, exact_score)
+        move, wld_score = solver_class().solve(black, white, next_player, exactly=False)
+        eq_(score > 0, wld_score > 0)
+        eq_(score < 0, wld_score < 0)
+
+        # the transposition table is reused, and small table works too
+        solver = solver_class(table_bits=4)
+        solver.solve(black, white, next_player, exactly=False)
+        move, exact_score = solver.solve(black, white, next_player, exactly=True)
+        ok_(move in moves, (move, moves))
+        eq_(score, exact_score)
+        solver = solver_class()
+        solver.solve(black, white, next_player, exactly=True)
+        eq_((move, exact_score), solver.solve(black, white, next_player, exactly=True))
+
+        # the root is not answered from the table without a move
+        solver = solver_class()
+        first = solver.solve(black, white, next_player, exactly=False)
+        eq_(first, solver.solve(black, white, next_player, exactly=False))
+        ok_(first[0] is not None)
+
+
+def test_solve():
+    _check_problems(ReversiSolver)
+
+
+def test_solve_cython():
+    _check_problems(_cython_solver())
+
+
+def _check_cancel(solver_class):
+    solver = solver_class()
+    env = ReversiEnv().reset()  # too early to solve
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    start_time = time()
+    eq_((None, None), solver.solve(env.board.black, env.board.white, Player.black, timeout=30, exactly=True,
+                                   cancel=cancel))
+    ok_(time() - start_time < 10)
+
+
+def _check_cancel_before_solve(solver_class):
+    solver = solver_class()
+    env = ReversiEnv().reset()
+    cancel = threading.Event()
+    cancel.set()
+    start_time = time()
+    eq_((None, None), solver.solve(env.board.black, env.board.white, Player.black, timeout=30, exactly=True,
+                                   cancel=cancel))
+    ok_(time() - start_time < 1)
+    ok_(cancel.is_set())
+
+    board, next_player, moves, score = PROBLEMS[0]  # a new token is not cancelled
+    black, white = parse_to_bitboards(board)
+    eq_((moves[0], score), solver.solve(black, white, next_player, exactly=True, cancel=threading.Event()))
+
+
+def test_cancel():
+    _check_cancel(ReversiSolver)
+    _check_cancel_before_solve(ReversiSolver)
+
+
+def test_cancel_cython():
+    solver_class = _cython_solver()
+    _check_cancel(solver_class)
+    _check_cancel_before_solve(solver_class)
+
+
+def test_cython_solver_is_same_as_python():
+    cython_solver_class = _cython_solver()
+    rng = random.Random(1)
+    for _ in range(5):
+        env = ReversiEnv().reset()
+        while not env.done and bit_count(env.board.black | env.board.white) < 54:
+            own, enemy = env.board.black, env.board.white
+            if env.next_player == Player.white:
+                own, enemy = enemy, own
+            legal_moves = find_correct_moves(own, enemy)
+            env.step(rng.choice([i for i in range(64) if legal_moves >> i & 1]))
+        if env.done:
+            continue
+        args = env.board.black, env.board.white, env.next_player
+        eq_(ReversiSolver().solve(*args, exactly=True)[1], cython_solver_class().solve(*args, exactly=True)[1])
@@ -0,0 +1,33 @@
+import json
+import os
+import tempfile
+
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.lib.self_play_stats import SelfPlayStatsWriter
+
+
+def test_write():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "stats.jsonl")
+        writer = SelfPlayStatsWriter(path, interval_sec=3600)
+        worker_counters = {
+            0: dict(games=1, moves=60, move_sec=6, mcts_lookups=100, mcts_hits=50, evals=60, symmetry_saved_evals=20),
+            1: dict(games=1, moves=40, move_sec=2, mcts_lookups=100, mcts_hits=100, evals=120),
+        }
+        ok_(writer.write_if_due(worker_counters) is None)
+        stats = writer.write(worker_counters)
+        eq_(0.08, stats["sec_per_move"])
+        eq_(0.75, stats["mcts_hit_rate"])
+        eq_(0.1, stats["symmetry_saved_eval_rate"])
+
+        worker_counters[0] = dict(games=2, moves=80, move_sec=10, mcts_lookups=100, mcts_hits=50)
+        stats = writer.write(worker_counters)
+        eq_(0.2, stats["sec_per_move"])  # only the increase since the last write
+        eq_(0, stats["mcts_hit_rate"])
+
+        with open(path, "rt") as f:
+            lines = [json.loads(line) for line in f]
+        eq_(2, len(lines))
+        eq_(2, lines[0]["worker_num"])
+        eq_(0.2, lines[1]["sec_per_move"])
@@ -0,0 +1,36 @@
+import pickle
+
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.env.reversi_env import Player
+from reversi_zero.lib.solver_cache import SharedSolverCache
+
+BLACK = 0x0000000810000000
+WHITE = 0x0000001008000000
+
+
+def test_get_and_put():
+    cache = SharedSolverCache.create(1024)
+    eq_(None, cache.get(BLACK, WHITE, Player.black, exactly=False))
+    cache.put(BLACK, WHITE, Player.black, False, 19, 2)
+    eq_((19, 2), cache.get(BLACK, WHITE, Player.black, exactly=False))
+    eq_(None, cache.get(BLACK, WHITE, Player.black, exactly=True))  # win/loss result is not exact
+    eq_(None, cache.get(BLACK, WHITE, Player.white, exactly=False))
+
+    cache.put(BLACK, WHITE, Player.black, True, 26, -6)
+    eq_((26, -6), cache.get(BLACK, WHITE, Player.black, exactly=True))
+    cache.put(BLACK, WHITE, Player.black, False, 19, 2)  # does not overwrite the exact result
+    eq_((26, -6), cache.get(BLACK, WHITE, Player.black, exactly=False))
+
+    # the same position of the player to move
+    cache.put(WHITE, BLACK, Player.white, True, 37, 10)
+    eq_((37, 10), cache.get(BLACK, WHITE, Player.black, exactly=True))
+    eq_((7, 4), (cache.lookup_count, cache.hit_count))
+
+
+def test_shared_by_pickle():
+    cache = SharedSolverCache.create(1024)
+    other = pickle.loads(pickle.dumps(cache))
+    other.put(BLACK, WHITE, Player.black, True, 26, 64)
+    eq_((26, 64), cache.get(BLACK, WHITE, Player.black, exactly=True))
+    ok_(other.path == cache.path)
@@ -0,0 +1,75 @@
+import numpy as np
+
+from nose.tools.trivial import eq_, ok_
+
+from reversi_zero.lib.bitboard import flip_vertical, rotate90, bit_to_array
+from reversi_zero.lib.symmetry import ACTION_PERMUTATIONS, transform_bitboard, canonicalize, transform_arrays
+from reversi_zero.lib.util import parse_to_bitboards
+
+
+BOARD = '''
+##########
+#OO      #
+#XOO     #
+#OXOOO   #
+#  XOX   #
+#   XXX  #
+#  X     #
+# X      #
+#       X#
+##########'''
+
+
+def test_action_permutations():
+    black, white = parse_to_bitboards(BOARD)
+    for t in range(8):
+        eq_(list(range(64)), list(sorted(ACTION_PERMUTATIONS[t])))
+        transformed = transform_bitboard(black, t)
+        ary = np.zeros(64)
+        ary[ACTION_PERMUTATIONS[t]] = bit_to_array(black, 64)
+        eq_(list(bit_to_array(transformed, 64)), list(ary))
+
+
+def test_transform_bitboard_matches_policy_transform():
+    # same as add_data_to_move_buffer_with_8_symmetries: flip -> rotate right
+    policy = np.arange(64)
+    for flip in [False, True]:
+        for rot_right in range(4):
+            t = flip * 4 + rot_right
+            expected = policy.reshape((8, 8))
+            if flip:
+                expected = np.flipud(expected)
+            expected = np.rot90(expected, k=-rot_right).reshape((64, ))
+            transformed = np.zeros(64, dtype=int)
+            transformed[ACTION_PERMUTATIONS[t]] = policy
+            eq_(list(expected), list(transformed))
+
+
+def test_canonicalize():
+    black, white = parse_to_bitboards(BOARD)
+    canonical = canonicalize(black, white)
+    for t in range(8):
+        b, w = transform_bitboard(black, t), transform_bitboard(white, t)
+        cb, cw, ct = canonicalize(b, w)
+        eq_(canonical[:2], (cb, cw))
+        eq_((cb, cw), (transform_bitboard(b, ct), transform_bitboard(w, ct)))
+
+    b, w = flip_vertical(rotate90(black)), flip_vertical(rotate90(white))
+    ok_(canonicalize(b, w)[:2] <= (b, w))
+
+
+def test_transform_arrays():
+    black, white = parse_to_bitboards(BOARD)
+    x = np.array([[bit_to_array(black, 64), bit_to_array(white, 64)]] * 8)
+    policy = np.array([np.arange(64)] * 8)
+    t = np.arange(8)
+    tx = transform_arrays(x, t)
+    tp = transform_arrays(policy, t)
+    for i in range(8):
+        eq_(list(bit_to_array(transform_bitboard(black, i), 64)), list(tx[i, 0]))
+        eq_(list(bit_to_array(transform_bitboard(white, i), 64)), list(tx[i, 1]))
+        eq_(list(ACTION_PERMUTATIONS[i]), [list(tp[i]).index(a) for a in range(64)])
+
+    x = x.reshape((8, 2, 8, 8))
+    eq_(x.shape, transform_arrays(x, t).shape)
+    ok_(np.array_equal(np.rot90(x[0], k=-1, axes=(1, 2)), transform_arrays(x, t)[1]))
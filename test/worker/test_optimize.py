@@ -1,6 +1,12 @@
-from nose.tools import eq_
+import os
+import tempfile
+
+import numpy as np
+from nose.tools import eq_, ok_, raises
 
 from reversi_zero.config import Config
+from reversi_zero.lib.bitboard import arrays_to_bits
+from reversi_zero.lib.replay_store import ReplayStore
 from reversi_zero.worker.optimize import OptimizeWorker
 
 
@@ -19,3 +25,121 @@ def test_decide_learning_rate():
     eq_(0.002, optimizer.decide_learning_rate(100001))
     eq_(0.002, optimizer.decide_learning_rate(199999))
     eq_(0.0002, optimizer.decide_learning_rate(200001))
+
+
+def test_generate_batches():
+    config = Config()
+    optimizer = OptimizeWorker(config)
+    state_ary = np.array([[1 << 1, 0]] * 10, dtype=np.uint64)
+    policy_ary = np.zeros((10, 64))
+    policy_ary[:, 1] = 1
+    z_ary = np.arange(10)
+
+    config.trainer.batch_size = 4
+    config.trainer.symmetry_augmentation = "random"
+    state, (policy, z) = next(optimizer.generate_batches(state_ary, policy_ary, z_ary))
+    eq_((4, 2, 8, 8), state.shape)
+    eq_(4, len(set(z)))
+    ok_(np.array_equal(state[:, 0].reshape((4, 64)), policy))
+
+    config.trainer.batch_size = 16
+    config.trainer.symmetry_augmentation = "all"
+    state, (policy, z) = next(optimizer.generate_batches(state_ary, policy_ary, z_ary))
+    eq_((16, 2, 8, 8), state.shape)
+    eq_((16, 64), policy.shape)
+    eq_(2, len(set(z)))
+    eq_(8, len(set(np.argmax(policy[:8], axis=1))))  # (0, 1) is moved to 8 squares
+
+    # fewer samples than a batch
+    for symmetry_augmentation, weights in [("random", None), ("all", None), ("random", np.ones(10) / 10)]:
+        config.trainer.batch_size = 256
+        config.trainer.symmetry_augmentation = symmetry_augmentation
+        state, (policy, z) = next(optimizer.generate_batches(state_ary, policy_ary, z_ary, weights=weights))
+        eq_(256, len(state))
+        ok_(set(z) <= set(z_ary))
+
+
+def test_load_play_data_from_replay_store():
+    with tempfile.TemporaryDirectory() as d:
+        config = Config()
+        config.resource.replay_store_path = os.path.join(d, "store.bin")
+        config.play_data.use_replay_store = True
+        optimizer = OptimizeWorker(config)
+        optimizer.load_play_data()
+        eq_(0, optimizer.dataset_size)
+
+        store = ReplayStore.open(config.resource.replay_store_path, 100)
+        store.append(np.array([[1, 2]] * 10, dtype=np.uint64), np.ones((10, 64)) / 64, np.ones(10))
+        optimizer.load_play_data()
+        eq_(10, optimizer.dataset_size)
+
+
+def test_sample_weights():
+    config = Config()
+    optimizer = OptimizeWorker(config)
+    ages = np.array([0, 10, 20])
+    eq_(None, optimizer.sample_weights(ages, np.ones(3)))
+
+    config.trainer.recency_half_life = 10
+    ok_(np.allclose(np.array([4, 2, 1]) / 7, optimizer.sample_weights(ages)))
+
+    config.trainer.loss_priority_alpha = 1
+    weights = optimizer.sample_weights(ages, np.array([0, 2, 4]))
+    ok_(np.isclose(1, np.sum(weights)))
+    ok_(weights[0] < weights[2] < weights[1])
+
+    config.trainer.batch_size = 2
+    state, (policy, z) = next(optimizer.generate_batches(np.zeros((3, 2), dtype=np.uint64), np.zeros((3, 64)),
+                                                         np.arange(3), weights=np.array([0, 1, 0])))
+    eq_([1, 1], list(z))
+
+
+def test_update_priority():
+    class DummyModel:
+        def predict(self, x, batch_size):
+            return np.ones((len(x), 64)) / 64, np.zeros((len(x), 1))
+
+    config = Config()
+    optimizer = OptimizeWorker(config)
+    optimizer.model = type("ReversiModel", (), {"model": DummyModel()})()
+    optimizer.replay_buffer.add("a", np.zeros((3, 2), dtype=np.uint64), np.ones((3, 64)) / 64, np.array([0, 1, -1]))
+    optimizer.dataset = optimizer.replay_buffer.arrays
+    optimizer.update_priority(np.array([0, 2]))
+    ok_(np.allclose([np.log(64), 1, np.log(64) + 1], optimizer.replay_buffer.priority[:3]))
+
+
+def test_update_priority_of_trained_batches_only():
+    class DummyModel:
+        def __init__(self):
+            self.trained = set()  # own bitboards of trained samples
+
+        def fit_generator(self, generator, steps_per_epoch, epochs, max_queue_size, **kwargs):
+            batches = [next(generator) for _ in range(steps_per_epoch * epochs + max_queue_size)]  # with prefetch
+            for state_ary, _ in batches[:steps_per_epoch * epochs]:
+                self.trained.update(arrays_to_bits(state_ary[:, 0].reshape((-1, 64))).tolist())
+
+    config = Config()
+    config.trainer.batch_size = 4
+    config.trainer.symmetry_augmentation = None
+    config.trainer.prefetch_batch_num = 3
+    config.trainer.loss_priority_alpha = 1
+    optimizer = OptimizeWorker(config)
+    model = DummyModel()
+    optimizer.model = type("ReversiModel", (), {"model": model})()
+    own = np.arange(1, 41, dtype=np.uint64)
+    optimizer.replay_buffer.add("a", np.stack([own, np.zeros(40, dtype=np.uint64)], axis=1),
+                                np.ones((40, 64)) / 64, np.zeros(40))
+    optimizer.dataset = optimizer.replay_buffer.arrays
+    updated = []
+    optimizer.update_priority = lambda indices: updated.extend(indices.tolist())
+
+    eq_(10, optimizer.train_epoch(1, []))
+    eq_(model.trained, set(int(own[i]) for i in updated))
+
+
+@raises(ValueError)
+def test_loss_priority_is_not_supported_with_replay_store():
+    config = Config()
+    config.play_data.use_replay_store = True
+    config.trainer.loss_priority_alpha = 1
+    OptimizeWorker(config).start()
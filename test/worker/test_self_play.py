@@ -0,0 +1,83 @@
+import asyncio
+import os
+import tempfile
+
+from nose.tools.trivial import eq_, ok_
+
+import numpy as np
+
+from reversi_zero.agent.api import MultiProcessReversiModelAPIServer, LocalReversiModelAPIClient
+from reversi_zero.agent.player import PredictionBatcher
+from reversi_zero.config import Config
+from reversi_zero.env.reversi_env import ReversiEnv, Winner
+from reversi_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
+from reversi_zero.worker.self_play import SelfPlayWorker, LocalVar
+
+
+class DummyKerasModel:
+    def __init__(self):
+        self.predicted_num = 0
+
+    def predict_on_batch(self, x):
+        self.predicted_num += len(x)
+        return np.ones((len(x), 64), dtype=np.float32) / 64, np.zeros((len(x), 1), dtype=np.float32)
+
+
+class DummyModel:
+    def __init__(self):
+        self.model = DummyKerasModel()
+        self.digest = "dummy"
+
+
+def create_worker(data_dir):
+    config = Config()
+    rc = config.resource
+    rc.play_data_dir = data_dir
+    rc.force_simulation_num_file = os.path.join(data_dir, ".force-sim")
+    config.play_data.nb_game_in_file = 1
+    config.play_data.enable_ggf_data = False
+    config.play.schedule_of_simulation_num_per_move = [(0, 8)]
+    config.play.use_solver_turn = config.play.use_solver_turn_in_simulation = None
+    config.play.disable_resignation_rate = 1
+    server = MultiProcessReversiModelAPIServer(config)
+    server.model = DummyModel()
+    api = server.get_local_api_client()
+    ok_(isinstance(api, LocalReversiModelAPIClient))
+    return SelfPlayWorker(config, env=ReversiEnv(), api=api, shared_var=LocalVar(game_idx=0)), server
+
+
+def test_play_game_with_local_api_client():
+    with tempfile.TemporaryDirectory() as d:
+        worker, server = create_worker(d)
+        env = worker.start_game(1, 0, None)
+        ok_(env.done)
+        eq_(1, worker.counters["games"])
+        eq_(env.turn, worker.counters["moves"])
+        ok_(server.model.model.predicted_num > 0)
+        ok_(server.model.model.predicted_num <= server.predicted_num)  # the rest are hits of the evaluation cache
+        eq_(server.predicted_num, worker.stats_counters()["evals"])
+
+        files = get_game_data_filenames(worker.config.resource)
+        eq_(1, len(files))
+        state_ary, policy_ary, z_ary = read_game_data_from_file(files[0])
+        ok_(0 < len(state_ary) <= env.turn)
+        eq_({-1, 1} if env.winner != Winner.draw else {0}, set(z_ary.tolist()))
+
+
+def test_play_parallel_games_with_local_api_client():
+    with tempfile.TemporaryDirectory() as d:
+        worker, server = create_worker(d)
+        batcher = PredictionBatcher(worker.api, worker.config.play.prediction_queue_size * 2)
+
+        async def play_games():
+            envs = await asyncio.gather(worker.start_game_async(1, 0, None, batcher),
+                                        worker.start_game_async(2, 0, None, batcher))
+            batcher.stop()
+            return envs
+
+        envs, _ = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(play_games(), batcher.worker(until_stopped=True)))
+        ok_(all(env.done for env in envs))
+        eq_(2, worker.counters["games"])
+        ok_(server.request_num < server.predicted_num)  # leaves of the games are predicted together
+        eq_(2, len(get_game_data_filenames(worker.config.resource)))